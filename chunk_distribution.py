@@ -1,4 +1,6 @@
-from sorted_coll import SortedCollection
+from sorted_coll import SortedCollection, BlockedSortedCollection, _check_sorted
+from persistent_coll import PersistentSortedCollection
+from key_encoding import encode_key, encode_value
 
 from pymongo import MongoClient, DESCENDING
 
@@ -6,79 +8,330 @@ from bson.min_key import MinKey
 from bson.max_key import MaxKey
 
 import json
+import struct
+from hashlib import md5
+from itertools import izip, islice
 
-# Monkey-patch MinKey and MaxKey comparison (for now, see PYTHON-604)
 
-MinKey.__le__ = lambda self, other: True
-MinKey.__lt__ = lambda self, other: other != MinKey()
-MinKey.__gt__ = lambda self, other: False
-MinKey.__ge__ = lambda self, other: other == MinKey()
-
-MaxKey.__le__ = lambda self, other: other == MaxKey()
-MaxKey.__lt__ = lambda self, other: False
-MaxKey.__gt__ = lambda self, other: other != MaxKey()
-MaxKey.__ge__ = lambda self, other: True
+def fingerprint(chunk):
+    """ 64-bit hash of the fields that ChunkDistribution equality compares: range, shard and namespace. """
+    data = '\x00'.join( (chunk.key, (chunk.shard or u'').encode('utf-8'), (chunk.namespace or u'').encode('utf-8')) )
+    return struct.unpack('<Q', md5(data).digest()[:8])[0]
 
 
 class ChunkDistribution(SortedCollection):
-    """ Holds a collection of chunks, sorted by chunk.range, which is a tuple of tuple of values. This class is 
-        a SortedCollection with some extras, like validation (check()) and equality checks. """
+    """ Holds a collection of chunks, sorted by chunk.key, the order-preserving binary encoding of chunk.range
+        (see key_encoding.py). Finding a chunk by range is therefore done with find(encode_range(range)). This class 
+        is a SortedCollection with some extras, like validation (check()) and equality checks. 
+
+        Each distribution keeps a fingerprint, the sum of the fingerprints of its chunks. It is computed once 
+        and then updated with every insert and remove, so comparing two distributions is O(1). Sums over the 
+        first i chunks locate the first difference between two distributions with a binary search.
+    """
 
     def __init__(self, iterable=(), key=None):
-        """ constructor, sets key of SortedCollection to chunk.range, then call superclass' __init__. """
-        key = lambda chunk: chunk.range
-        SortedCollection.__init__(self, iterable=iterable, key=key)
+        """ constructor, sets key of SortedCollection to chunk.key, then call superclass' __init__. """
+        key = lambda chunk: chunk.key
+        super(ChunkDistribution, self).__init__(iterable=iterable, key=key)
 
         self.time = None
         self.applied_change = None
 
+        # (removed, inserted) chunks relative to the previous distribution, set by replace()
+        self.delta = None
+
+        # sum of chunk fingerprints and list of prefix sums, computed on demand
+        self._fingerprint = None
+        self._prefix_fingerprints = None
+
+
+    def fingerprint(self):
+        """ returns the sum of the fingerprints of all chunks. Equal distributions have equal fingerprints. """
+        if self._fingerprint is None:
+            self._fingerprint = sum(fingerprint(chunk) for chunk in self)
+        return self._fingerprint
+
+    def _prefix_fingerprint(self, i):
+        """ returns the sum of the fingerprints of the first i chunks. The prefix sums are computed in O(n) once 
+            per version of the distribution, PersistentChunkDistribution keeps them in its tree instead. 
+        """
+        if self._prefix_fingerprints is None:
+            sums = [0]
+            for chunk in self:
+                sums.append(sums[-1] + fingerprint(chunk))
+            self._prefix_fingerprints = sums
+        return self._prefix_fingerprints[i]
+
+    def _changed(self, fingerprint_before, removed=(), inserted=()):
+        """ updates the fingerprint after removing and inserting chunks. """
+        if fingerprint_before is not None:
+            self._fingerprint = fingerprint_before - sum(fingerprint(chunk) for chunk in removed) + sum(fingerprint(chunk) for chunk in inserted)
+        self._prefix_fingerprints = None
+
+    def insert(self, chunk):
+        fp = self._fingerprint
+        super(ChunkDistribution, self).insert(chunk)
+        self._changed(fp, inserted=[chunk])
+
+    def insert_right(self, chunk):
+        fp = self._fingerprint
+        super(ChunkDistribution, self).insert_right(chunk)
+        self._changed(fp, inserted=[chunk])
+
+    def remove(self, chunk):
+        fp = self._fingerprint
+        super(ChunkDistribution, self).remove(chunk)
+        self._changed(fp, removed=[chunk])
+
+    def update(self, remove=(), insert=()):
+        remove, insert = list(remove), list(insert)
+        fp = self._fingerprint
+        try:
+            super(ChunkDistribution, self).update(remove, insert)
+        except ValueError:
+            # the collection is unchanged, but some backends remove items one by one before failing
+            self._fingerprint = fp
+            raise
+        self._changed(fp, remove, insert)
+
+    def clear(self):
+        super(ChunkDistribution, self).clear()
+        self._fingerprint = 0
+        self._prefix_fingerprints = None
+
+    def copy(self):
+        """ returns a copy, which keeps the fingerprints. """
+        other = super(ChunkDistribution, self).copy()
+        other._fingerprint = self._fingerprint
+        other._prefix_fingerprints = self._prefix_fingerprints
+        return other
+
+
+    def first_difference(self, other):
+        """ returns the first position where this distribution and `other` differ, or None if they are equal. 
+            Uses a binary search over prefix fingerprints, with O(log n) prefix lookups. 
+        """
+        if self == other:
+            return None
+
+        # longest common prefix
+        lo, hi = 0, min(len(self), len(other))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._prefix_fingerprint(mid) == other._prefix_fingerprint(mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def differences(self, other):
+        """ returns the chunks of this distribution and of `other` between the first and the last difference, 
+            as two lists. Both lists are empty if the distributions are equal. 
+        """
+        first = self.first_difference(other)
+        if first is None:
+            return [], []
+
+        # longest common suffix that doesn't overlap the common prefix
+        n, m = len(self), len(other)
+        total, other_total = self.fingerprint(), other.fingerprint()
+        lo, hi = 0, min(n, m) - first
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if total - self._prefix_fingerprint(n - mid) == other_total - other._prefix_fingerprint(m - mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        return self[first : n - lo], other[first : m - lo]
+
     def check(self, verbose=False):
         """ check that chunk distribution is complete and correct. Needs to go from MinKey to MaxKey without gaps and overlaps, 
             and all be of the same namespace. 
         """
-        ret = True
         msgs = []
 
-        # check that range starts with MinKey on all fields
-        if not all([value == MinKey() for value in self[0].min]):
-            ret = False
-            msgs.append('chunk range does not start with MinKey')
-
-        # check that range ends with MaxKey on all fields
-        if not all([value == MaxKey() for value in self[-1].max]):  
-            ret = False
-            msgs.append('chunk range does not end with MaxKey')
+        # check that range starts with MinKey and ends with MaxKey on all fields
+        self._check_pair(None, self[0], msgs)
+        self._check_pair(self[-1], None, msgs)
 
         # check that range has no gaps or overlaps (last chunks max needs to be equal to next chunks min for all chunks)
-        for c1, c2 in zip(self[:-1], self[1:]):
-            # if c1.namespace == "blab_store_timed.posts20131126T040000":
-            #     print c2.min, c1.max, c2.min == c1.max
-
-            if c2.min != c1.max:
-                ret = False
-                msgs.append('discontinuity in chunk range between %s and %s' % 
-                    (str(dict(zip(c1.shardkey_fields, c1.max))), 
-                     str(dict(zip(c2.shardkey_fields, c2.min))))
-                )
+        for c1, c2 in izip(self, islice(self, 1, None)):
+            self._check_pair(c1, c2, msgs, namespace=False)
 
         # check that all chunks have the same namespace
         ns_set = set([ch.namespace for ch in self])
         if len(ns_set) > 1:
-            ret = False
             msgs.append('chunk range has different namespaces: %s' % ', '.join(ns_set))
 
-        if ret:
-            msgs = ['ok']
-        return ret, msgs
+        if not msgs:
+            return True, ['ok']
+        return False, msgs
+
+
+    def check_delta(self):
+        """ incremental version of check(), only checks around the chunks that were removed and inserted by the 
+            replace() call that created this distribution. Assuming the previous distribution was correct, this 
+            is equivalent to a full check(), but only costs O(log n) per changed chunk. Namespace consistency is 
+            checked by comparing each inserted chunk to its neighbours. 
+        """
+        if self.delta is None:
+            return self.check()
+
+        msgs = []
+        removed, inserted = self.delta
+
+        # inserted chunks need to continue their predecessor and be continued by their successor
+        for chunk in inserted:
+            prev_chunk, next_chunk = self._neighbours(chunk.key, inclusive=False)
+            self._check_pair(prev_chunk, chunk, msgs)
+            self._check_pair(chunk, next_chunk, msgs)
+
+        # where a chunk was removed and nothing inserted at the same range, its former neighbours have to meet
+        inserted_keys = set(chunk.key for chunk in inserted)
+        for chunk in removed:
+            if chunk.key in inserted_keys:
+                continue
+            prev_chunk, next_chunk = self._neighbours(chunk.key, inclusive=True)
+            if prev_chunk is None and next_chunk is None:
+                msgs.append('chunk distribution is empty')
+            else:
+                self._check_pair(prev_chunk, next_chunk, msgs)
+
+        if not msgs:
+            return True, ['ok']
+        return False, msgs
+
+
+    def _neighbours(self, k, inclusive):
+        """ returns the chunks before and after key k (None if there is none). If inclusive, a chunk with key k 
+            itself is returned as the next chunk. 
+        """
+        try:
+            prev_chunk = self.find_lt(k)
+        except ValueError:
+            prev_chunk = None
+        try:
+            next_chunk = self.find_ge(k) if inclusive else self.find_gt(k)
+        except ValueError:
+            next_chunk = None
+        return prev_chunk, next_chunk
+
+
+    def _check_pair(self, c1, c2, msgs, namespace=True):
+        """ checks that chunk c2 directly follows chunk c1, and appends messages for any violation to msgs. 
+            c1 = None means c2 is the first chunk, c2 = None means c1 is the last chunk. 
+        """
+        msg = None
+
+        if c1 is None:
+            if not all([value == MinKey() for value in c2.min]):
+                msg = 'chunk range does not start with MinKey'
+        elif c2 is None:
+            if not all([value == MaxKey() for value in c1.max]):  
+                msg = 'chunk range does not end with MaxKey'
+        elif c2.min != c1.max:
+            msg = 'discontinuity in chunk range between %s and %s' % (
+                str(dict(zip(c1.shardkey_fields, c1.max))), 
+                str(dict(zip(c2.shardkey_fields, c2.min))))
+        elif namespace and c1.namespace != c2.namespace:
+            msg = 'chunk range has different namespaces: %s, %s' % (c1.namespace, c2.namespace)
+
+        if msg and msg not in msgs:
+            msgs.append(msg)
+
+
+    def replace(self, old_chunks, new_chunks):
+        """ returns a copy of this distribution where `old_chunks` are removed and `new_chunks` are 
+            inserted. The change is recorded in the `delta` attribute of the new distribution.
+        """
+        new_dist = self.copy()
+        new_dist.update(old_chunks, new_chunks)
+
+        new_dist.delta = (list(old_chunks), list(new_chunks))
+        return new_dist
 
 
     def max_shard_version(self):
         return max(chunk.shard_version for chunk in self)
+
+
+    def _shard_key_encoder(self):
+        """ returns a function that encodes the shard key of a document, with values in the order of the 
+            shard key fields. Missing fields are routed like null, as mongos does. 
+        """
+        if not len(self):
+            raise ValueError('Cannot route shard keys in empty distribution.')
+        fields = self[0].shardkey_fields
+        if len(fields) == 1:
+            field = fields[0]
+            return lambda key_doc: encode_value(key_doc.get(field))
+        return lambda key_doc: encode_key([key_doc.get(field) for field in fields])
+
+
+    def route(self, key_doc):
+        """ returns the chunk that owns the shard key document `key_doc`, e.g. {'_id': 123}, in O(log n). The 
+            chunk is the last one with min <= key, which owns the key if key < max. For hashed shard keys, 
+            key_doc needs to contain the hashed value. Raises ValueError if no chunk owns the key.
+        """
+        return self._route_encoded(self._shard_key_encoder()(key_doc), key_doc)
+
+    def _route_encoded(self, encoded, key_doc):
+        # chunk keys start with the encoded min, '\xff' sorts after any continuation of the encoded key
+        try:
+            chunk = self.find_le(encoded + '\xff')
+        except ValueError:
+            chunk = None
+        if chunk is None or encode_key(chunk.max) <= encoded:
+            raise ValueError('No chunk found for shard key %r.' % (key_doc,))
+        return chunk
+
+
+    def route_sorted(self, key_docs):
+        """ routes a list of shard key documents, sorted ascending by shard key, in a single merge pass over
+            the chunks. Returns the list of owning chunks, in the order of `key_docs`. Raises ValueError if 
+            the documents are not sorted or a key has no owning chunk.
+        """
+        key_docs = list(key_docs)
+        encode = self._shard_key_encoder()
+        encoded = [encode(key_doc) for key_doc in key_docs]
+        if not encoded:
+            return []
+        _check_sorted(encoded)
+
+        # start at the chunk owning the smallest key, then advance alongside the keys
+        chunk = self._route_encoded(encoded[0], key_docs[0])
+        chunks = islice(self, self.index(chunk), None)
+        chunk_max = None
+
+        owners = []
+        for key_doc, key in izip(key_docs, encoded):
+            while chunk_max is None or chunk_max <= key:
+                chunk = next(chunks, None)
+                if chunk is None or encode_key(chunk.min) > key:
+                    raise ValueError('No chunk found for shard key %r.' % (key_doc,))
+                chunk_max = encode_key(chunk.max)
+            owners.append(chunk)
+        return owners
+
+
+    def overlapping(self, min_doc, max_doc):
+        """ returns all chunks that overlap the shard key interval [min_doc, max_doc), in order. """
+        encode = self._shard_key_encoder()
+        encoded_min, encoded_max = encode(min_doc), encode(max_doc)
+        if encoded_max <= encoded_min:
+            return []
+
+        # chunks with min < max_doc have a key below the encoded max_doc
+        first = self._route_encoded(encoded_min, min_doc)
+        last = self.find_lt(encoded_max)
+        return self[self.index(first) : self.index(last) + 1]
         
 
     def __eq__(self, other):
-        """ One chunk distribution is "equal" to another, if all chunks match on range, shard, namespace """
-        return isinstance(other, ChunkDistribution) and all( s._is_equal(o, equality_fields=['range', 'shard', 'namespace'] ) for s,o in zip(self, other) )
+        """ One chunk distribution is "equal" to another, if all chunks match on range, shard, namespace. This
+            compares the fingerprints, which is O(1) once they are known. 
+        """
+        return isinstance(other, ChunkDistribution) and len(self) == len(other) and self.fingerprint() == other.fingerprint()
 
     def __ne__(self, other):
         """ inequality is the opposite of equality. """
@@ -102,5 +355,156 @@ class ChunkDistribution(SortedCollection):
 
 
 
+class PersistentChunkDistribution(ChunkDistribution, PersistentSortedCollection):
+    """ ChunkDistribution backed by a PersistentSortedCollection. Copies share all chunks with the
+        original, and each insert or remove only copies O(log n) tree nodes. Use this when many 
+        versions of a distribution are kept around, like in ConfigParser.build_full_history(). Each tree 
+        node also keeps the sum of the fingerprints in its subtree, so prefix fingerprints are O(log n).
+    """
+    _weigh = staticmethod(fingerprint)
+
+    def _prefix_fingerprint(self, i):
+        return self._prefix_weight(i)
+
+
+class BlockedChunkDistribution(ChunkDistribution, BlockedSortedCollection):
+    """ ChunkDistribution backed by a BlockedSortedCollection. Each insert or remove only shifts the
+        chunks of one block, which makes the steps of a walk cheaper for namespaces with many chunks.
+    """
+    pass
+
+
+if __name__ == '__main__':
+
+    from chunk import Chunk
+    from bson import ObjectId, Timestamp
+    from bson.son import SON
+    from random import Random
+
+    def make_chunks(fields, points):
+        """ chunks from MinKey to MaxKey with the sorted split points in between, on three shards in turn. """
+        bounds = [ (MinKey(),) * len(fields) ] + sorted(points, key=encode_key) + [ (MaxKey(),) * len(fields) ]
+        epoch = ObjectId()
+        return [ Chunk({'ns': 'mydb.mycoll', 'shard': 'shard%04i' % (i % 3), 'lastmod': Timestamp(1, i), 'lastmodEpoch': epoch,
+                        'min': SON(zip(fields, lo)), 'max': SON(zip(fields, hi))}) for i, (lo, hi) in enumerate(zip(bounds, bounds[1:])) ]
+
+    def owner(chunks, fields, key_doc):
+        """ brute force: the chunk whose range contains the key, missing fields count as null. """
+        key = encode_key([ key_doc.get(field) for field in fields ])
+        for chunk in chunks:
+            if encode_key(chunk.min) <= key < encode_key(chunk.max):
+                return chunk
+        return None
+
+    def keys(fields, values):
+        """ all combinations of values for the fields, with and without each field. """
+        docs = [{}]
+        for field in fields:
+            docs = [ dict(doc, **{field: value}) for doc in docs for value in values ] + docs
+        return docs
+
+    classes = [ChunkDistribution, PersistentChunkDistribution, BlockedChunkDistribution]
+    values = [ MinKey(), None, -20, -10, -3, 0, 0.5, 3, 7, 8, u'a', u'x', u'y', MaxKey() ]
+    setups = [ (('a',), [ (None,), (-10,), (0,), (7,), (u'x',) ]),
+               (('a', 'b'), [ (None, MinKey()), (-10, 5), (0, MinKey()), (0, 0), (0, 5), (7, None), (u'x', 0), (MaxKey(), 0) ]) ]
+
+    for fields, points in setups:
+        chunks = make_chunks(fields, points)
+        probes = keys(fields, values) + [ dict(zip(fields, point)) for point in points ]
+
+        for cls in classes:
+            chunk_dist = cls(chunks)
+
+            # single keys, including exact chunk bounds, missing fields and MinKey/MaxKey
+            routable = []
+            for key_doc in probes:
+                expected = owner(chunks, fields, key_doc)
+                try:
+                    chunk = chunk_dist.route(key_doc)
+                except ValueError:
+                    chunk = None
+                assert chunk is expected, (cls, key_doc, chunk, expected)
+                if expected is not None:
+                    routable.append(key_doc)
+            assert routable and len(routable) < len(probes)
+
+            # sorted keys in one pass, unsorted keys and keys without owner are rejected
+            encode = lambda key_doc: encode_key([ key_doc.get(field) for field in fields ])
+            routable.sort(key=encode)
+            assert chunk_dist.route_sorted(routable) == [ owner(chunks, fields, key_doc) for key_doc in routable ]
+            assert chunk_dist.route_sorted([]) == []
+            for bad in ([ routable[-1], routable[0] ], routable + [ dict((field, MaxKey()) for field in fields) ]):
+                try:
+                    chunk_dist.route_sorted(bad)
+                    assert False, bad
+                except ValueError:
+                    pass
+
+            # intervals [lo, hi), from single points up to MinKey to MaxKey
+            for lo in probes[::3] + [ dict((field, MinKey()) for field in fields) ]:
+                for hi in probes[1::4] + [ dict((field, MaxKey()) for field in fields) ]:
+                    if owner(chunks, fields, lo) is None:
+                        continue
+                    expected = [ chunk for chunk in chunks if encode_key(chunk.min) < encode(hi) and encode(lo) < encode_key(chunk.max)
+                                 and encode(lo) < encode(hi) ]
+                    assert list(chunk_dist.overlapping(lo, hi)) == expected, (cls, lo, hi)
+
+    # fingerprints and diffs of distributions derived with replace(), across all backends
+    rnd = Random(0)
+
+    def same_chunk(a, b):
+        return (a.key, a.shard, a.namespace) == (b.key, b.shard, b.namespace)
+
+    def brute_differences(a, b):
+        """ the chunks between the longest common prefix and the longest common suffix that doesn't overlap it. """
+        a, b = list(a), list(b)
+        first = 0
+        while first < min(len(a), len(b)) and same_chunk(a[first], b[first]):
+            first += 1
+        if first == len(a) == len(b):
+            return None, [], []
+        last = 0
+        while last < min(len(a), len(b)) - first and same_chunk(a[-1 - last], b[-1 - last]):
+            last += 1
+        return first, a[first : len(a) - last], b[first : len(b) - last]
+
+    def change(chunk_dist):
+        """ one random migration, split or merge of adjacent chunks, applied with replace(). """
+        i = rnd.randrange(len(chunk_dist))
+        chunk = chunk_dist[i]
+        r = rnd.random()
+        if r < 0.4:
+            return chunk_dist.replace([chunk], [chunk.derive('shard%04i' % rnd.randrange(4), chunk.shard_version)])
+        lo = -2000 if isinstance(chunk.min[0], MinKey) else chunk.min[0]
+        hi = 2000 if isinstance(chunk.max[0], MaxKey) else chunk.max[0]
+        if r < 0.7 and hi - lo > 1:
+            point = rnd.randrange(lo + 1, hi)
+            left, right = chunk.derive(chunk.shard, chunk.shard_version), chunk.derive(chunk.shard, chunk.shard_version)
+            left.range, right.range = (chunk.min, (point,)), ((point,), chunk.max)
+            return chunk_dist.replace([chunk], [left, right])
+        if i + 1 < len(chunk_dist):
+            merged = chunk.derive(chunk.shard, chunk.shard_version)
+            merged.range = (chunk.min, chunk_dist[i + 1].max)
+            return chunk_dist.replace([chunk, chunk_dist[i + 1]], [merged])
+        return chunk_dist
+
+    chunks = make_chunks(('a',), [ (k,) for k in rnd.sample(xrange(-1000, 1000), 40) ])
+    for k in range(200):
+        a_cls, b_cls = rnd.choice(classes), rnd.choice(classes)
+        a, b = a_cls(chunks), b_cls(chunks)
+
+        # with a known fingerprint, replace() updates it incrementally
+        if rnd.random() < 0.5:
+            a.fingerprint(), b.fingerprint()
+        for n in range(rnd.randrange(6)):
+            a = change(a)
+        for n in range(rnd.randrange(6)):
+            b = change(b)
 
+        first, mine, theirs = brute_differences(a, b)
+        assert a.fingerprint() == sum(fingerprint(chunk) for chunk in a)
+        assert (a == b) == (first is None)
+        assert a.first_difference(b) == first and b.first_difference(a) == first
+        assert [ list(d) for d in a.differences(b) ] == [mine, theirs], (a_cls, b_cls)
 
+    print 'ok'
@@ -0,0 +1,300 @@
+from array import array
+from bisect import bisect_right
+from collections import Counter
+
+from key_encoding import encode_key
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Python 2's array has no 'Q' typecode. Where unsigned long only has 32 bits, use doubles, which hold
+# packed versions exactly up to a major version of 2**21.
+_VERSION_TYPECODE = 'L' if array('L').itemsize == 8 else 'd'
+
+
+def pack_version(shard_version):
+    """ packs a (major, minor) shard version into a single 64-bit int. Unknown versions (None) become 0. """
+    if shard_version is None:
+        return 0
+    return (shard_version[0] << 32) | shard_version[1]
+
+def unpack_version(packed):
+    """ inverse of pack_version(). """
+    packed = int(packed)
+    if packed == 0:
+        return None
+    return (packed >> 32, packed & 0xffffffff)
+
+
+def _pack_keys(keys):
+    """ packs byte strings into a single string and the array of their n + 1 offsets in it. """
+    offsets = array('L', [0])
+    end = 0
+    for key in keys:
+        end += len(key)
+        offsets.append(end)
+    return ''.join(keys), offsets
+
+
+class ColumnarChunkDistribution(object):
+    """ Read-only, columnar representation of a chunk distribution, for fast statistics. Instead of a list
+        of Chunk objects, it stores the shard of each chunk as a small int (index into `shard_names`), the
+        shard versions as packed 64-bit ints and the range boundaries as packed columns of their encoded
+        keys (see key_encoding.py), all in chunk order. Each boundary column is a single string with an
+        array of offsets, so that the boundaries don't need a Python object per chunk, and routing a shard
+        key is a binary search over that string.
+
+        The columns are NumPy arrays if NumPy is installed, `array` objects otherwise. The statistics methods
+        are vectorized with NumPy and fall back to plain Python loops without it.
+
+        It can be created from any iterable of chunks, e.g. ColumnarChunkDistribution(chunk_dist), and keeps
+        the `time` and `applied_change` of a ChunkDistribution.
+    """
+
+    def __init__(self, iterable=()):
+        chunks = sorted(iterable, key=lambda chunk: chunk.key)
+
+        self.shard_names = []
+        shard_ids = {}
+        for chunk in chunks:
+            if chunk.shard not in shard_ids:
+                shard_ids[chunk.shard] = len(self.shard_names)
+                self.shard_names.append(chunk.shard)
+
+        shards = array('H', (shard_ids[chunk.shard] for chunk in chunks))
+        versions = array(_VERSION_TYPECODE, (pack_version(chunk.shard_version) for chunk in chunks))
+
+        if numpy is not None:
+            self.shards = numpy.array(shards, dtype=numpy.uint16)
+            self.versions = numpy.array(versions, dtype=numpy.uint64)
+        else:
+            self.shards = shards
+            self.versions = versions
+
+        self._mins, self._min_offsets = _pack_keys([ encode_key(chunk.min) for chunk in chunks ])
+        self._maxs, self._max_offsets = _pack_keys([ encode_key(chunk.max) for chunk in chunks ])
+        self.namespace = chunks[0].namespace if chunks else None
+        self.shardkey_fields = chunks[0].shardkey_fields if chunks else None
+
+        self.time = getattr(iterable, 'time', None)
+        self.applied_change = getattr(iterable, 'applied_change', None)
+
+
+    def __len__(self):
+        return len(self._min_offsets) - 1
+
+
+    def min_key(self, i):
+        """ returns the encoded min of chunk i. """
+        return self._mins[self._min_offsets[i] : self._min_offsets[i + 1]]
+
+    def max_key(self, i):
+        """ returns the encoded max of chunk i. """
+        return self._maxs[self._max_offsets[i] : self._max_offsets[i + 1]]
+
+
+    def route(self, key_doc):
+        """ returns the position of the chunk that owns the shard key document `key_doc`, e.g. {'_id': 123},
+            in O(log n), like ChunkDistribution.route(). Raises ValueError if no chunk owns the key.
+        """
+        if not len(self):
+            raise ValueError('Cannot route shard keys in empty distribution.')
+        encoded = encode_key([ key_doc.get(field) for field in self.shardkey_fields ])
+
+        # the last chunk with min <= key
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if encoded < self.min_key(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+
+        if lo == 0 or not encoded < self.max_key(lo - 1):
+            raise ValueError('No chunk owns shard key %r.' % (key_doc,))
+        return lo - 1
+
+
+    def chunk_counts(self):
+        """ returns a dict mapping each shard name to its number of chunks. """
+        if numpy is not None:
+            counts = numpy.bincount(self.shards, minlength=len(self.shard_names))
+        else:
+            counts = [0] * len(self.shard_names)
+            for shard_id in self.shards:
+                counts[shard_id] += 1
+
+        return dict( (name, int(count)) for name, count in zip(self.shard_names, counts) )
+
+
+    def max_shard_version(self):
+        """ returns the highest shard version of all chunks, as (major, minor) tuple. """
+        if not len(self):
+            raise ValueError('max_shard_version() of empty distribution')
+        return unpack_version(self.versions.max() if numpy is not None else max(self.versions))
+
+
+    def chunk_counts_by_major_version(self):
+        """ returns a dict mapping each major shard version to the number of chunks with that major version.
+            Each migration starts a new major version, so this groups chunks by the migration they were last
+            changed after. This is not the collection epoch (lastmodEpoch), which is not stored here. Chunks
+            with unknown versions are counted under None.
+        """
+        if numpy is not None:
+            majors, counts = numpy.unique(self.versions >> numpy.uint64(32), return_counts=True)
+            counts = dict( (int(major), int(count)) for major, count in zip(majors, counts) )
+        else:
+            counts = dict( Counter(int(version) >> 32 for version in self.versions) )
+
+        # packed version 0 means unknown, 0 is not a valid major version otherwise
+        if 0 in counts:
+            counts[None] = counts.pop(0)
+        return counts
+
+
+    def __repr__(self):
+        return 'ColumnarChunkDistribution( ns=%s, %i chunks on %i shards )' % (self.namespace, len(self), len(self.shard_names))
+
+
+
+class ChunkCountSeries(object):
+    """ Time series of the number of chunks per shard of a namespace, one row per change of its history.
+        It is computed from the deltas of a walk, counting -1 for each removed and +1 for each inserted
+        chunk on its shard, so only the counters and the rows are kept, not the distributions. Memory is 
+        proportional to shards x changes.
+
+        `times` and `whats` are lists in ascending time (the first row is the oldest distribution, with time
+        datetime.min), `shard_names` the shards in order of first appearance in the walk. `counts` is a 2D
+        NumPy array (changes x shards) if NumPy is installed, a list of `array` columns (one per shard)
+        otherwise. Use column(shard) to get the counts of a single shard either way.
+    """
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace
+        self.shard_names = []
+        self.times = []
+        self.whats = []
+        self.counts = []
+
+
+    @classmethod
+    def from_walk(cls, distributions, namespace=None):
+        """ creates the series from distributions in walk order (descending time), as yielded by
+            ConfigParser.walk_distributions(). Each distribution after the first one needs a `delta`.
+        """
+        series = cls(namespace)
+        counts = Counter()
+        shard_ids = {}
+        columns = []
+
+        for chunk_dist in distributions:
+            if chunk_dist.delta is None:
+                counts.update( chunk.shard for chunk in chunk_dist )
+            else:
+                removed, inserted = chunk_dist.delta
+                counts.subtract( chunk.shard for chunk in removed )
+                counts.update( chunk.shard for chunk in inserted )
+
+            # a shard that appears further back in time had no chunks in all newer rows
+            for shard in counts:
+                if shard not in shard_ids:
+                    shard_ids[shard] = len(series.shard_names)
+                    series.shard_names.append(shard)
+                    columns.append(array('L', [0]) * len(series.times))
+
+            for shard, column in zip(series.shard_names, columns):
+                column.append(counts[shard])
+            series.times.append(chunk_dist.time)
+            series.whats.append(getattr(chunk_dist, 'what', None))
+
+        # reverse once into ascending time. A migration gets the time of its commit, but is applied at its
+        # end, so that the times of a walk can be out of order around migrations. Like TimeIndexedHistory,
+        # rows with the same time stay in ascending order of the walk.
+        order = range(len(series.times) - 1, -1, -1)
+        order.sort(key=series.times.__getitem__)
+        series.times = [ series.times[w] for w in order ]
+        series.whats = [ series.whats[w] for w in order ]
+        columns = [ array('L', ( column[w] for w in order )) for column in columns ]
+
+        if numpy is not None:
+            series.counts = numpy.array(columns, dtype=numpy.uint32).reshape(len(columns), len(series.times)).T
+        else:
+            series.counts = columns
+        return series
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def column(self, shard):
+        """ returns the chunk counts of shard over time, as NumPy array or `array`. """
+        i = self.shard_names.index(shard)
+        return self.counts[:, i] if numpy is not None else self.counts[i]
+
+
+    def at(self, t):
+        """ returns a dict mapping each shard to its number of chunks at time t. """
+        i = bisect_right(self.times, t)
+        if i == 0:
+            raise ValueError('No distribution found with time at or below: %r' % (t,))
+        return dict( (shard, int(self.column(shard)[i - 1])) for shard in self.shard_names )
+
+
+    def drain_start(self, shard):
+        """ returns the time of the first decrease of the number of chunks of shard after which it never
+            increased again, e.g. when the balancer started draining it. Returns None if it didn't decrease
+            at the end of the series.
+        """
+        column = self.column(shard)
+        last = len(column) - 1
+
+        # start of the non-increasing tail, then skip over rows with the same count
+        i = last
+        while i > 0 and column[i - 1] >= column[i]:
+            i -= 1
+        while i < last and column[i + 1] == column[i]:
+            i += 1
+
+        if i == last:
+            return None
+        return self.times[i + 1]
+
+
+    def __repr__(self):
+        return 'ChunkCountSeries( ns=%s, %i changes on %i shards )' % (self.namespace, len(self), len(self.shard_names))
+
+
+
+if __name__ == '__main__':
+
+    from config_parser import ConfigParser
+    from fake_cluster import FakeCluster
+    from datetime import timedelta
+
+    namespace = 'mydb.mycoll'
+    cluster = FakeCluster(seed=1)
+    cluster.shard_collection(namespace)
+    cluster.random_changes(namespace, 20)
+
+    # migrations whose moveChunk.from is written after later changes are out of time order in the walk
+    for k in range(10):
+        cluster.move(namespace, hold=1)
+        cluster.split(namespace)
+        cluster.flush()
+        cluster.random_changes(namespace, 2)
+
+    cfg_parser = ConfigParser(cluster.config_db)
+    series = cfg_parser.chunk_count_series([namespace])[namespace]
+    history = cfg_parser.build_full_history(namespace)
+    assert series.times == sorted(series.times) and len(series) == len(history)
+
+    probes = sorted(set(series.times)) + [ t + timedelta(milliseconds=500) for t in series.times ]
+    for t in probes:
+        counts = dict( (shard, count) for shard, count in series.at(t).items() if count )
+        assert counts == dict(Counter( chunk.shard for chunk in history.at(t) )), t
+
+    print 'ok'
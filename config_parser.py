@@ -1,9 +1,16 @@
-from chunk import Chunk
-from chunk_distribution import ChunkDistribution
-from sorted_coll import SortedCollection
-from pymongo import DESCENDING
+from chunk import Chunk, _intern
+from key_encoding import encode_range
+from chunk_distribution import ChunkDistribution, PersistentChunkDistribution
+from history import DistributionHistory, TimeIndexedHistory
+from columnar import ChunkCountSeries
+from lineage import LineageIndex
+from pymongo import ASCENDING, DESCENDING
 from datetime import datetime
-from copy import copy, deepcopy
+from collections import deque
+from itertools import chain, groupby, izip
+from operator import itemgetter
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
 
 from pprint import pprint
 
@@ -16,51 +23,141 @@ class ConfigParser(object):
         of ChunkDistributions, sorted by time.
     """
 
-    def __init__(self, config_db):
+    # changelog entries used when walking backwards
+    walk_changes = ['multi-split', 'split', 'moveChunk.from', 'moveChunk.to', 'moveChunk.start', 'moveChunk.commit']
+
+    def __init__(self, config_db, full_checks=False):
+        """ constructor, takes the config database, or a config dump or snapshot file opened with 
+            snapshot.open_config(). By default, each step of a walk only validates the 
+            resulting distribution around the changed chunks. Set `full_checks` to validate the whole 
+            distribution after each step instead (O(n) per step).
+        """
         self.config_db = config_db
-        self.processed_multisplits = set()
+        self.full_checks = full_checks
     
 
-    def get_chunk_distribution(self, namespace): 
+    def get_chunk_distribution(self, namespace, distribution_class=ChunkDistribution): 
         """ returns a single ChunkDistribution object based on the current state of the
-            cluster given by its config.chunks collection. 
+            cluster given by its config.chunks collection. `distribution_class` can be any 
+            ChunkDistribution subclass, e.g. PersistentChunkDistribution.
         """       
-        chunks = self.config_db['chunks'].find({'ns': namespace})
-        chunk_dist = ChunkDistribution()
+        cursor = self.config_db['chunks'].find({'ns': namespace}).sort([('min', ASCENDING)])
+        return self._distribution_from_docs(cursor, distribution_class)
+
 
-        for ch_doc in chunks:
-            chunk = Chunk(ch_doc)
-            chunk_dist.insert(chunk)  
+    def _distribution_from_docs(self, chunk_docs, distribution_class=ChunkDistribution):
+        """ creates a distribution from config.chunks documents, preferably sorted by min. """
+        chunks = [ Chunk(ch_doc) for ch_doc in chunk_docs ]
+
+        # chunks sorted by min on the server are in chunk.key order, only sort them again if that's not the case
+        try:
+            chunk_dist = distribution_class.from_sorted(chunks)
+        except ValueError:
+            chunk_dist = distribution_class(chunks)
 
         return chunk_dist          
 
 
-    def walk_distributions(self, namespace):
-        """ iterator over chunk distributions backwards in time. """
+    def _partition(self, cursor, namespaces):
+        """ partitions the documents of a cursor sorted by ns in a single pass. Yields (namespace, documents) 
+            for each of the sorted `namespaces`, with an empty list for namespaces without documents. The
+            documents of each namespace can only be used until the next one is requested.
+        """
+        namespaces = iter(namespaces)
+        namespace = next(namespaces, None)
+
+        for ns, docs in groupby(cursor, itemgetter('ns')):
+            while namespace is not None and namespace < ns:
+                yield namespace, []
+                namespace = next(namespaces, None)
+            if namespace == ns:
+                yield namespace, docs
+                namespace = next(namespaces, None)
+
+        while namespace is not None:
+            yield namespace, []
+            namespace = next(namespaces, None)
+
+
+    def get_all_chunk_distributions(self, namespaces=None, distribution_class=ChunkDistribution):
+        """ iterator over (namespace, distribution) for all `namespaces` (default: all sharded collections)
+            in sorted order, like get_chunk_distribution() for each of them. config.chunks is read in a 
+            single query sorted by (ns, min) instead of one query per namespace, and only the chunks of 
+            one namespace are held at a time.
+        """
+        if namespaces is None:
+            namespaces = self.sharded_namespaces()
+        namespaces = sorted(set(namespaces))
+
+        cursor = self.config_db['chunks'].find({'ns': {'$in': namespaces}}).sort([('ns', ASCENDING), ('min', ASCENDING)])
+        for namespace, chunk_docs in self._partition(cursor, namespaces):
+            yield namespace, self._distribution_from_docs(chunk_docs, distribution_class)
+
+
+    def walk_all_distributions(self, namespaces=None, distribution_class=ChunkDistribution):
+        """ iterator over (namespace, walk) for all `namespaces` (default: all sharded collections) in sorted
+            order, where each walk iterates over the distributions of the namespace like walk_distributions().
+            config.chunks and config.changelog are each read once, sorted by namespace, and partitioned per
+            namespace in a single pass, instead of two queries per namespace. Only the chunks and the 
+            changelog of one namespace are held at a time, each walk can be used independently.
+        """
+        if namespaces is None:
+            namespaces = self.sharded_namespaces()
+        namespaces = sorted(set(namespaces))
+
+        chunks = self.config_db['chunks'].find({'ns': {'$in': namespaces}}).sort([('ns', ASCENDING), ('min', ASCENDING)])
+        changelog = self.config_db['changelog'].find({'ns': {'$in': namespaces}, 'what': {'$in': self.walk_changes}}).sort([('ns', ASCENDING), ('time', DESCENDING)])
+
+        for (namespace, chunk_docs), (_, changelog_docs) in izip(self._partition(chunks, namespaces), self._partition(changelog, namespaces)):
+            chunk_dist = self._distribution_from_docs(chunk_docs, distribution_class)
+            yield namespace, self._walk(chunk_dist, self._indexed_events(list(changelog_docs)))
+
+
+    def walk_distributions(self, namespace, distribution_class=ChunkDistribution, stream=False, batch_size=1000, lookahead=1000, since=None):
+        """ iterator over chunk distributions backwards in time. With a PersistentChunkDistribution
+            as `distribution_class`, consecutive distributions share all chunks that did not change.
+
+            By default, the changelog of the namespace is loaded completely before the first step. With
+            `stream=True`, the changelog cursor is consumed in batches of `batch_size` documents instead,
+            and only up to `lookahead` documents are buffered to match multi-splits and migrations.
+
+            With `since`, only changelog entries newer than that time are applied, and the last distribution
+            is the one that was current at `since`. Migrations that started before `since` are incomplete
+            within that range and not applied.
+        """
 
         # get original chunk distribution
-        chunk_dist = self.get_chunk_distribution(namespace)
-        self.processed_multisplits = set()
+        chunk_dist = self.get_chunk_distribution(namespace, distribution_class)
         
         # now get changelog ( only splits and moveChunk.* )
-        changelog = list( self.config_db['changelog'].find({'ns': namespace, 'what': {'$in': ['multi-split', 'split', 'moveChunk.from', 'moveChunk.to', 'moveChunk.start', 'moveChunk.commit']}}).sort([('time', DESCENDING)]) ) 
+        query = {'ns': namespace, 'what': {'$in': self.walk_changes}}
+        if since is not None:
+            query['time'] = {'$gt': since}
+        cursor = self.config_db['changelog'].find(query).sort([('time', DESCENDING)])
 
-        for i, chl in enumerate(changelog):
+        if stream:
+            events = self._stream_events(cursor.batch_size(batch_size), lookahead)
+        else:
+            events = self._indexed_events(list(cursor))
+
+        for chunk_dist in self._walk(chunk_dist, events):
+            yield chunk_dist
+
+
+    def _walk(self, chunk_dist, events):
+        """ walks backwards from chunk_dist, applying the events of _indexed_events() or _stream_events(). """
+        for chl, what, docs in events:
             # process a chunk split
-            if chl['what'] == 'split':
+            if what == 'split':
                 new_dist = self._process_split(chl, chunk_dist)
 
             # process a chunk multi-split
-            elif chl['what'] == 'multi-split':
-                new_dist = self._process_multi_split(changelog[i:], chunk_dist)
+            elif what == 'multi-split':
+                new_dist = self._process_multi_split(docs, chunk_dist)
 
             # process a chunk move
-            elif chl['what'] == 'moveChunk.from':
-                new_dist = self._process_move(changelog[i:], chunk_dist)
-
-            # none of that? go to next doc, no yield
-            else:
-                continue
+            elif what == 'move':
+                new_dist = self._process_move(docs, chunk_dist)
 
             if new_dist:
                 # attach changelog entry to chunk distribution
@@ -76,21 +173,151 @@ class ConfigParser(object):
 
 
 
-    def build_full_history(self, namespace):
+    def build_full_history(self, namespace, checkpoint_interval=None):
         """ Builds an initial ChunkDistribution from the config.chunks collection, then walks
             the changelog backwards and creates a new ChunkDistribution for each step (either 
-            a split or a move). All these ChunkDistributions are inserted into a SortedCollection
-            and returned.
+            a split or a move). All these ChunkDistributions are returned as a TimeIndexedHistory,
+            a SortedCollection keyed by time. The distributions are persistent and share untouched
+            chunks with their neighbours, so each step only costs O(log n) time and memory.
+
+            If `checkpoint_interval` is given, a DistributionHistory is returned instead, which only
+            stores a full checkpoint every `checkpoint_interval` steps and the deltas in between. 
+            Distributions are then rebuilt on lookup, e.g. with history.find_le(time). Raises ValueError
+            if `checkpoint_interval` is less than 1.
         """
 
-        history = SortedCollection(key=lambda dist: dist.time)
+        if checkpoint_interval is not None:
+            history = DistributionHistory(checkpoint_interval)
+            for chunk_dist in self.walk_distributions(namespace, PersistentChunkDistribution):
+                history.append(chunk_dist)
+            return history
+
+        return TimeIndexedHistory.from_walk(self.walk_distributions(namespace, PersistentChunkDistribution))
+
 
-        for chunk_dist in self.walk_distributions(namespace):
-            history.insert(chunk_dist)
+    def build_lineage(self, namespace):
+        """ walks the changelog of namespace backwards and returns a LineageIndex of its chunks. """
+        lineage = LineageIndex()
+        for chunk_dist in lineage.track(self.walk_distributions(namespace, PersistentChunkDistribution)):
+            pass
+        return lineage
 
-        return history
+
+    def sharded_namespaces(self):
+        """ returns the namespaces of all sharded collections that are not dropped. """
+        return [ coll['_id'] for coll in self.config_db['collections'].find({'dropped': {'$ne': True}}) ]
+
+
+    def chunk_count_series(self, namespaces=None):
+        """ returns a dict mapping each namespace (default: all sharded collections) to a ChunkCountSeries,
+            the number of chunks per shard after each change. Only the counters are kept during the walk, 
+            not the distributions. All namespaces are walked with walk_all_distributions().
+        """
+        return dict( (namespace, ChunkCountSeries.from_walk(walk, namespace)) 
+            for namespace, walk in self.walk_all_distributions(namespaces, PersistentChunkDistribution) )
 
 
+    def last_change_time(self, namespace):
+        """ returns the time of the newest changelog entry of the namespace, or None if there is none. """
+        for chl in self.config_db['changelog'].find({'ns': namespace}).sort([('time', DESCENDING)]).limit(1):
+            return chl['time']
+        return None
+
+
+    def replay_distributions(self, namespace, start=None, distribution_class=ChunkDistribution):
+        """ iterator over chunk distributions forwards in time, the opposite of walk_distributions(). It 
+            starts from `start`, a distribution that was current at `start.time`, e.g. the distribution of
+            a saved snapshot or one from a history, and applies all splits, multi-splits and committed 
+            migrations after that time in time order. Without `start`, it starts from the initial chunk 
+            of the collection (MinKey to MaxKey) and replays the whole changelog.
+
+            The first distribution yielded is the start, the last one should equal the current distribution
+            from get_chunk_distribution(), see check_replay(). Moved chunks get an unknown shard version 
+            (None) until they are split again.
+        """
+        if start is None:
+            chunk_dist = self._initial_distribution(namespace, distribution_class)
+        else:
+            chunk_dist = distribution_class.from_sorted(list(start))
+            chunk_dist.time = getattr(start, 'time', None) or datetime.min
+
+        # only the commit of a migration is needed, it also covers migrations that started before `start`
+        query = {'ns': namespace, 'what': {'$in': ['multi-split', 'split', 'moveChunk.commit']}}
+        if chunk_dist.time != datetime.min:
+            query['time'] = {'$gt': chunk_dist.time}
+        changelog = list(self.config_db['changelog'].find(query).sort([('time', ASCENDING)]))
+
+        multi_splits = self._group_multi_splits(changelog)
+
+        for chl in changelog:
+            # only the last document of each multi-split group triggers the multi-split, the others are skipped
+            multi_split_docs = None
+            if chl['what'] == 'multi-split':
+                multi_split_docs = multi_splits[self._multi_split_key(chl)]
+                if chl is not multi_split_docs[-1]:
+                    continue
+
+            new_dist = self.apply_change(chl, chunk_dist, multi_split_docs)
+            yield chunk_dist
+            chunk_dist = new_dist
+
+        yield chunk_dist
+
+
+    def apply_change(self, chl, chunk_dist, multi_split_docs=None):
+        """ applies a single changelog entry forwards: a split, a multi-split (`multi_split_docs` are all 
+            documents of the multi-split, in time order) or a moveChunk.commit. Returns the new distribution 
+            with `time` and `applied_change` of the entry. Raises ValueError if the change doesn't fit 
+            chunk_dist.
+        """
+        if chl['what'] == 'split':
+            children = [Chunk(chl, 'left'), Chunk(chl, 'right')]
+            new_dist = self._replay_split(Chunk(chl, 'before'), children, chunk_dist, 'split')
+
+        elif chl['what'] == 'multi-split':
+            children = [ Chunk(doc, 'chunk') for doc in multi_split_docs or [chl] ]
+            new_dist = self._replay_split(Chunk(chl, 'before'), children, chunk_dist, 'multi-split')
+
+        elif chl['what'] == 'moveChunk.commit':
+            new_dist = self._replay_move(chl, chunk_dist)
+
+        else:
+            raise ValueError("Error replaying change: can't apply a %s." % chl['what'])
+
+        new_dist.time = chl['time']
+        new_dist.applied_change = chl
+        return new_dist
+
+
+    def check_replay(self, namespace, start=None):
+        """ cross-validates the changelog against config.chunks: replays the changelog forwards from `start`
+            (default: the initial chunk) and compares the result to the current distribution. Returns a tuple
+            (ok, msgs) like ChunkDistribution.check(). 
+        """
+        try:
+            for chunk_dist in self.replay_distributions(namespace, start):
+                pass
+        except ValueError as e:
+            return False, [str(e)]
+
+        current = self.get_chunk_distribution(namespace)
+        first = chunk_dist.first_difference(current)
+        if first is None:
+            return True, ['ok']
+
+        replayed = chunk_dist[first] if first < len(chunk_dist) else None
+        return False, ['replayed distribution differs from config.chunks at chunk %i: %s <--> %s' % 
+            (first, replayed, current[first] if first < len(current) else None)]
+
+
+    def _check(self, chunk_dist):
+        """ validates a distribution created by one of the _process_* methods, either fully or only 
+            around the changed chunks. 
+        """
+        if self.full_checks:
+            return chunk_dist.check(verbose=True)
+        return chunk_dist.check_delta()
+
 
     def _process_split(self, split_doc, chunk_dist):
         """ Processes a single split event, transforming a given ChunkDistribution into a new one,
@@ -109,12 +336,12 @@ class ConfigParser(object):
 
         # Chunk objects found in the distribution
         try:
-            left_chunk = chunk_dist.find( left_split.range )
+            left_chunk = chunk_dist.find( left_split.key )
         except ValueError:
             raise ValueError("Error processing split: can't find left chunk in distribution.")
 
         try: 
-            right_chunk = chunk_dist.find( right_split.range )
+            right_chunk = chunk_dist.find( right_split.key )
         except ValueError:
             raise ValueError("Error processing split: can't find right chunk in distribution.")
         
@@ -131,48 +358,189 @@ class ConfigParser(object):
         if right_split != right_chunk:
             print ValueError("Error processing split: right chunks not the same. %s <--> %s" % (right_split, right_chunk))
 
-        # create a shallow copy of the original chunk distribution
-        new_dist = copy(chunk_dist)
-
-        # now remove these two chunks and insert a new one
-        new_dist.remove(left_chunk)
-        new_dist.remove(right_chunk)
-
         # link before chunk to the left and right (parent / children relationship)
         before_split.shard = left_chunk.shard
         left_chunk.parent = before_split
         right_chunk.parent = before_split
         before_split.children = [left_chunk, right_chunk]
 
-        new_dist.insert(before_split)
+        # create a copy of the original chunk distribution, remove these two chunks and insert a new one
+        new_dist = chunk_dist.replace([left_chunk, right_chunk], [before_split])
 
         # update time of new distribution
         chunk_dist.time = split_doc['time']
         chunk_dist.what = 'split'
 
         # another sanity check: make sure new chunk distribution is correct
-        if not new_dist.check(verbose=True):
-            raise ValueError('Error processing split: resulting chunk distribution check failed.')
+        ret, msgs = self._check(new_dist)
+        if not ret:
+            raise ValueError('Error processing split: resulting chunk distribution check failed: %s' % ', '.join(msgs))
         
         return new_dist
 
 
-    def _process_multi_split(self, changelog, chunk_dist):
-        """ Processes a multi-split event, transforming a given ChunkDistribution into a new one,
-            where all the children chunks are merged back into one original (split backwards).
+    def _indexed_events(self, changelog):
+        """ generates the changes of a fully loaded changelog (sorted descending by time) as tuples
+            (changelog doc, what, docs), where what is 'split', 'multi-split' or 'move' and docs are 
+            the documents needed to process the change. Multi-splits and migrations are matched with
+            indexes built in a single pass over the changelog.
         """
-        # check if this multi-split has already been processed (only process first one for each shard version)
-        split_doc = changelog[0]
-        lastmod = (split_doc['details']['before']['lastmod'].time, split_doc['details']['before']['lastmod'].inc)
 
-        if lastmod in self.processed_multisplits:
-            return False
-        else:
-            self.processed_multisplits.add(lastmod)
+        # group all multi-split documents by the shard version of the chunk they split
+        multi_splits = self._group_multi_splits(changelog)
 
-        # find all documents in the changelog belonging to this multi-split
-        multi_split_docs = filter( lambda chl: chl['what'] == 'multi-split' and
-                                               chl['details']['before']['lastmod'] == split_doc['details']['before']['lastmod'], changelog) 
+        # match the moveChunk.* documents of each migration
+        moves = self._index_moves(changelog)
+
+        for i, chl in enumerate(changelog):
+            if chl['what'] == 'split':
+                yield chl, 'split', chl
+
+            elif chl['what'] == 'multi-split':
+                # only the first document of each group triggers the multi-split, the others are skipped
+                multi_split_docs = multi_splits.pop(self._multi_split_key(chl), None)
+                if multi_split_docs:
+                    yield chl, 'multi-split', multi_split_docs
+
+            elif chl['what'] == 'moveChunk.from':
+                # aborted and incomplete migrations did not change the distribution, skip them
+                status, move_docs = moves[i]
+                if status == 'complete':
+                    yield chl, 'move', move_docs
+
+
+    def _stream_events(self, changelog, lookahead):
+        """ same as _indexed_events(), but consumes the changelog as an iterator. Only the window of documents
+            needed to complete the current multi-split or migration is buffered, at most `lookahead` documents. 
+            Multi-splits are complete once all `of` documents are found, migrations once `commit`, `to` and 
+            `start` are found. If the window is full before that, the rest of the changelog is loaded and
+            processed like _indexed_events() does.
+        """
+        changelog = iter(changelog)
+        window = deque()
+
+        # number of documents still to skip for each multi-split that was already processed
+        skip_multi_splits = {}
+
+        # set when lookahead_docs() stopped at the end of the window, not at the end of the changelog
+        window_full = [False]
+
+        def fill(n):
+            """ reads documents into the window until it holds more than n, returns False if exhausted. """
+            while len(window) <= n:
+                try:
+                    window.append(next(changelog))
+                except StopIteration:
+                    return False
+            return True
+
+        def lookahead_docs():
+            """ generates the documents after the current one, reading more as needed. """
+            j = 0
+            window_full[0] = False
+            while fill(j):
+                if j == lookahead:
+                    window_full[0] = True
+                    return
+                yield window[j]
+                j += 1
+
+        def indexed_rest(chl):
+            """ processes chl and the rest of the changelog with _indexed_events(), without the documents
+                of multi-splits that were already processed.
+            """
+            rest = []
+            for doc in chain([chl], window, changelog):
+                if doc['what'] == 'multi-split' and skip_multi_splits.get(self._multi_split_key(doc)):
+                    skip_multi_splits[self._multi_split_key(doc)] -= 1
+                    continue
+                rest.append(doc)
+            return self._indexed_events(rest)
+
+        while fill(0):
+            chl = window.popleft()
+
+            if chl['what'] == 'split':
+                yield chl, 'split', chl
+
+            elif chl['what'] == 'multi-split':
+                key = self._multi_split_key(chl)
+
+                if key in skip_multi_splits:
+                    skip_multi_splits[key] -= 1
+                    if skip_multi_splits[key] == 0:
+                        del skip_multi_splits[key]
+                    continue
+
+                multi_split_docs = [chl]
+                total = chl['details'].get('of')
+                for doc in lookahead_docs():
+                    if doc['what'] == 'multi-split' and self._multi_split_key(doc) == key:
+                        multi_split_docs.append(doc)
+                        if len(multi_split_docs) == total:
+                            break
+
+                if window_full[0] and len(multi_split_docs) != total:
+                    for event in indexed_rest(chl):
+                        yield event
+                    return
+
+                if len(multi_split_docs) > 1:
+                    skip_multi_splits[key] = len(multi_split_docs) - 1
+                yield chl, 'multi-split', multi_split_docs
+
+            elif chl['what'] == 'moveChunk.from':
+                # aborted migrations did not change the distribution, skip them
+                if self._is_aborted(chl):
+                    continue
+
+                key = self._move_key(chl)
+                move_docs = {'from': chl}
+                for doc in lookahead_docs():
+                    if not doc['what'].startswith('moveChunk.') or self._move_key(doc) != key:
+                        continue
+
+                    # an older `from` for the same range means this migration is incomplete, and `start` is 
+                    # the oldest document of a migration
+                    what = doc['what'].split('.')[1]
+                    if what == 'from':
+                        break
+                    move_docs.setdefault(what, doc)
+                    if len(move_docs) == 4 or what == 'start':
+                        break
+
+                if window_full[0]:
+                    for event in indexed_rest(chl):
+                        yield event
+                    return
+
+                if len(move_docs) == 4:
+                    yield chl, 'move', move_docs
+
+
+    def _multi_split_key(self, split_doc):
+        """ multi-split documents that belong together share the shard version of the "before" chunk. """
+        lastmod = split_doc['details']['before']['lastmod']
+        return (lastmod.time, lastmod.inc)
+
+
+    def _group_multi_splits(self, changelog):
+        """ groups all multi-split documents of the changelog in a single pass. Returns a dict mapping
+            _multi_split_key() to the list of documents, in changelog order.
+        """
+        groups = {}
+        for chl in changelog:
+            if chl['what'] == 'multi-split':
+                groups.setdefault(self._multi_split_key(chl), []).append(chl)
+        return groups
+
+
+    def _process_multi_split(self, multi_split_docs, chunk_dist):
+        """ Processes a multi-split event, transforming a given ChunkDistribution into a new one,
+            where all the children chunks are merged back into one original (split backwards).
+            `multi_split_docs` are all changelog documents belonging to this multi-split.
+        """
+        split_doc = multi_split_docs[0]
 
         # "before" doc and its chunk
         before_doc = split_doc['details']['before']
@@ -183,7 +551,7 @@ class ConfigParser(object):
         for doc in multi_split_docs:
             split = Chunk(doc, 'chunk')
             try:
-                chunk = chunk_dist.find( split.range )
+                chunk = chunk_dist.find( split.key )
             except ValueError:
                 raise ValueError("Error processing multi-split: can't find a chunk in distribution.")
 
@@ -198,95 +566,105 @@ class ConfigParser(object):
 
             chunks.append(chunk)
 
-        # create a shallow copy of the original chunk distribution
-        new_dist = copy(chunk_dist)
-
-        # now remove all chunks and insert a new one
-        for chunk in chunks:
-            new_dist.remove(chunk)
-
         # link before chunk to all children chunks
         before_split.shard = chunks[0].shard
         for c, chunk in enumerate(chunks):
             chunks[c].parent = before_split
         before_split.children = chunks
 
-        new_dist.insert(before_split)
+        # create a copy of the original chunk distribution, remove all chunks and insert a new one
+        new_dist = chunk_dist.replace(chunks, [before_split])
 
         # update time of new distribution
         chunk_dist.time = split_doc['time']
         chunk_dist.what = 'multi-split'
 
         # another sanity check: make sure new chunk distribution is correct
-        if not new_dist.check(verbose=True):
-            raise ValueError('Error processing multi-split: resulting chunk distribution check failed.')
+        ret, msgs = self._check(new_dist)
+        if not ret:
+            raise ValueError('Error processing multi-split: resulting chunk distribution check failed: %s' % ', '.join(msgs))
         
         return new_dist
 
 
-    def _process_move(self, changelog, chunk_dist):
-        """ Processes a single chunk move event, transforming a ChunkDistribution into a new ChunkDistribution,
-            where the chunk that is moved is replaced by a chunk with same range, but the previous shard.
+    def _move_key(self, move_doc):
+        """ all moveChunk.* documents of a migration share namespace and chunk range. """
+        details = move_doc['details']
+        return (move_doc['ns'], encode_range( (tuple(details['min'].values()), tuple(details['max'].values())) ))
+
+
+    def _is_aborted(self, from_doc):
+        """ mongod notes 'aborted' in the moveChunk.from document of a migration that did not commit, older 
+            changelogs may have 'abort'.
         """
+        return from_doc['details'].get('note') in ('aborted', 'abort')
 
-        docs = {}
 
-        # search for the relevant changelog events for a move
-        docs['from'] = changelog[0]
+    def _index_moves(self, changelog):
+        """ matches the moveChunk.* documents of all migrations in a single pass over the changelog (which is
+            sorted descending by time). Each `from` document is completed by the next older `commit`, `to` 
+            and `start` documents with the same namespace and range. A migration without `commit` or `to`
+            is incomplete once its `start` is found.
 
-        # skip aborted moves
-        if 'note' in docs['from']['details'] and docs['from']['details']['note'] == 'abort':
-            return False
+            Returns a dict mapping the changelog position of each `from` document to a tuple (status, docs), 
+            where status is 'complete', 'aborted' or 'incomplete', and docs maps 'from', 'commit', 'to', 
+            'start' to the documents found.
+        """
+        moves = {}
 
-        # search changelog from the `from` document backwards in time to find `commit`, `to`, `start`.
-        for chl in changelog[1:]:
-            what = chl['what']
+        # migrations per _move_key() still waiting for older documents, as (position, docs)
+        pending = {}
 
-            # only accept docs that start with moveChunk.
-            if not what.startswith('moveChunk.'):
-                return False
-            what = what.split('.')[1]
+        for i, chl in enumerate(changelog):
+            if not chl['what'].startswith('moveChunk.'):
+                continue
 
-            # only consider entries that match the range 
-            if chl['details']['min'] != docs['from']['details']['min'] or chl['details']['max'] != docs['from']['details']['max']:
-                return False
+            what = chl['what'].split('.')[1]
+            key = self._move_key(chl)
 
-            # once another from is found, abort here (we need start, to, commit)
-            if chl['what'] == 'from':
-                return False
+            if what == 'from':
+                # an older `from` for the same range means the newer migration can't be completed anymore
+                if key in pending:
+                    moves[pending[key][0]] = ('incomplete', pending.pop(key)[1])
 
-            # only find one single doc for each what
-            if what in docs:
-                return False
-            else:
+                if self._is_aborted(chl):
+                    moves[i] = ('aborted', {'from': chl})
+                else:
+                    pending[key] = (i, {'from': chl})
+
+            # documents of aborted migrations or duplicates don't have a pending migration and are ignored
+            elif key in pending and what not in pending[key][1]:
+                docs = pending[key][1]
                 docs[what] = chl
 
-            if len(set(docs.keys())) == 4:
-                break
+                if len(docs) == 4:
+                    moves[pending.pop(key)[0]] = ('complete', docs)
+                elif what == 'start':
+                    moves[pending.pop(key)[0]] = ('incomplete', docs)
+
+        for position, docs in pending.itervalues():
+            moves[position] = ('incomplete', docs)
 
-        # not all 4 doc types (start, to, commit, from) found
-        if len(set(docs.keys())) != 4:
-            return 
+        return moves
 
-        # we have a full set of all 4 doc types here, go ahead
+
+    def _process_move(self, docs, chunk_dist):
+        """ Processes a single chunk move event, transforming a ChunkDistribution into a new ChunkDistribution,
+            where the chunk that is moved is replaced by a chunk with same range, but the previous shard. `docs`
+            maps 'from', 'commit', 'to' and 'start' to the changelog documents of the migration.
+        """
 
         # find chunk that is being moved
         chunk_range = tuple(docs['from']['details']['min'].values()), tuple(docs['from']['details']['max'].values())
-        chunk = chunk_dist.find( chunk_range )
+        chunk = chunk_dist.find( encode_range(chunk_range) )
 
-        # duplicate chunk (deep copy) and update (remove shard version as it is unknown)
-        new_chunk = deepcopy(chunk)
-        new_chunk.shard_version = None
-        new_chunk.shard = docs['start']['details']['from']
+        # same chunk on the previous shard (remove shard version as it is unknown)
+        new_chunk = chunk.derive(docs['start']['details']['from'])
         new_chunk.children = [chunk]
         chunk.parent = new_chunk
 
-        # create a shallow copy of the original chunk distribution
-        new_dist = copy(chunk_dist)
-
-        # delete old chunk and insert new chunk
-        new_dist.remove(chunk)
-        new_dist.insert(new_chunk)
+        # create a copy of the original chunk distribution, delete old chunk and insert new chunk
+        new_dist = chunk_dist.replace([chunk], [new_chunk])
         
         chunk_dist.time = docs['commit']['time']
         chunk_dist.what = 'move'
@@ -294,3 +672,140 @@ class ConfigParser(object):
         return new_dist
 
 
+
+
+    def _initial_distribution(self, namespace, distribution_class=ChunkDistribution):
+        """ returns the distribution of a newly sharded collection, a single chunk from MinKey to MaxKey. 
+            Until the first migration, all chunks stay on the shard of that chunk, so its shard is the 
+            `from` shard of the first migration, or the shard of any current chunk if there never was one.
+        """
+        chunk_doc = self.config_db['chunks'].find_one({'ns': namespace})
+        if chunk_doc is None:
+            raise ValueError("Error replaying %s: no chunks found." % namespace)
+
+        chunk = Chunk(chunk_doc)
+        for chl in self.config_db['changelog'].find({'ns': namespace, 'what': 'moveChunk.commit'}).sort([('time', ASCENDING)]).limit(1):
+            chunk.shard = _intern(chl['details']['from'])
+
+        chunk.shard_version = (1, 0)
+        chunk.range = ( tuple(MinKey() for f in chunk.shardkey_fields), tuple(MaxKey() for f in chunk.shardkey_fields) )
+
+        chunk_dist = distribution_class([chunk])
+        chunk_dist.time = datetime.min
+        return chunk_dist
+
+
+    def _replay_split(self, before_split, children, chunk_dist, what):
+        """ Replays a split or multi-split forwards, the chunk `before_split` is replaced by the `children`
+            chunks (created from the changelog documents) in a new ChunkDistribution.
+        """
+        try:
+            before_chunk = chunk_dist.find( before_split.key )
+        except ValueError:
+            raise ValueError("Error replaying %s: can't find chunk in distribution. %s" % (what, before_split))
+
+        # set shards to be equal (they are not in split_doc), update unknown shard versions of moved chunks
+        before_split.shard = before_chunk.shard
+        before_chunk.shard_version = before_split.shard_version
+
+        if before_split != before_chunk:
+            raise ValueError("Error replaying %s: chunks not the same. %s <--> %s" % (what, before_split, before_chunk))
+
+        # link children to the chunk they were split from
+        for chunk in children:
+            chunk.shard = before_chunk.shard
+            chunk.parent = before_chunk
+        before_chunk.children = children
+
+        new_dist = chunk_dist.replace([before_chunk], children)
+        new_dist.what = what
+
+        ret, msgs = self._check(new_dist)
+        if not ret:
+            raise ValueError('Error replaying %s: resulting chunk distribution check failed: %s' % (what, ', '.join(msgs)))
+
+        return new_dist
+
+
+    def _replay_move(self, commit_doc, chunk_dist):
+        """ Replays a committed migration forwards, the moved chunk is replaced by a chunk with the same range
+            on the `to` shard, with unknown shard version.
+        """
+        details = commit_doc['details']
+        chunk_range = tuple(details['min'].values()), tuple(details['max'].values())
+        try:
+            chunk = chunk_dist.find( encode_range(chunk_range) )
+        except ValueError:
+            raise ValueError("Error replaying move: can't find chunk in distribution. %s --> %s" % chunk_range)
+
+        if chunk.shard != details['from']:
+            raise ValueError("Error replaying move: chunk is on shard %s, not %s. %s" % (chunk.shard, details['from'], chunk))
+
+        new_chunk = chunk.derive(details['to'])
+        new_chunk.parent = chunk
+        chunk.children = [new_chunk]
+
+        new_dist = chunk_dist.replace([chunk], [new_chunk])
+        new_dist.what = 'move'
+
+        return new_dist
+
+
+if __name__ == '__main__':
+
+    from fake_cluster import FakeCluster
+
+    namespace = 'mydb.mycoll'
+    cluster = FakeCluster(seed=2)
+    cluster.shard_collection(namespace)
+    cluster.random_changes(namespace, 20)
+
+    def elsewhere(docs, n):
+        """ makes n splits and migrations on chunks that are not among the chunks of docs. """
+        held = set( repr(doc['details'].get('chunk', doc['details'])['min']) for doc in docs )
+        for k in range(n):
+            chunks = cluster.chunks[namespace]
+            index = cluster.random.choice([ i for i, chunk in enumerate(chunks) if repr({'_id': chunk[0]}) not in held
+                                            and cluster._bounds(chunk)[1] - cluster._bounds(chunk)[0] >= 2 ])
+            if k % 3 == 2:
+                cluster.move(namespace, index=index)
+            else:
+                cluster.split(namespace, index=index)
+
+    # multi-splits and migrations whose documents are further apart than the lookahead window
+    docs = cluster.multi_split(namespace, 4, hold=3)
+    elsewhere(docs, 6)
+    cluster.flush(1)
+    elsewhere(docs, 6)
+    cluster.flush()
+    docs = cluster.move(namespace, hold=3)
+    elsewhere(docs, 8)
+    cluster.flush(2)
+    elsewhere(docs, 3)
+    cluster.flush()
+    cluster.random_changes(namespace, 10)
+
+    def chunks(walk):
+        return [ (chunk_dist.time, [ (chunk.min, chunk.max, chunk.shard) for chunk in chunk_dist ]) for chunk_dist in walk ]
+
+    cfg_parser = ConfigParser(cluster.config_db)
+    indexed = chunks(cfg_parser.walk_distributions(namespace))
+    for lookahead in (0, 1, 3, 10, 1000):
+        assert chunks(cfg_parser.walk_distributions(namespace, stream=True, batch_size=7, lookahead=lookahead)) == indexed
+
+    # aborted migrations, and one whose moveChunk.from has no note, are decided within the window instead of
+    # loading the rest of the changelog
+    since = cluster.time
+    cluster.move(namespace, abort=True)
+    cluster.random_changes(namespace, 20)
+    del cluster.move(namespace, abort=True)[-1]['details']['note']
+    cluster.random_changes(namespace, 20)
+
+    def no_fallback(changelog):
+        raise AssertionError('lookahead window exceeded')
+
+    indexed = chunks(cfg_parser.walk_distributions(namespace, since=since))
+    cfg_parser._indexed_events = no_fallback
+    assert chunks(cfg_parser.walk_distributions(namespace, stream=True, lookahead=10, since=since)) == indexed
+
+    print 'ok'
@@ -0,0 +1,265 @@
+""" In-memory config database and a simulated sharded cluster that writes config.chunks and config.changelog
+    like mongos does, for the self-tests of the modules that read them.
+
+    FakeConfigDB answers the same queries as a config dump opened with snapshot.open_config(), with
+    documents that can be inserted and removed at any time. FakeCluster shards collections, splits and
+    migrates chunks and drops collections on such a database:
+
+        cluster = FakeCluster()
+        cluster.shard_collection('mydb.mycoll')
+        cluster.split('mydb.mycoll')
+        cluster.move('mydb.mycoll', to='shard0001')
+
+    Each change updates config.chunks first and then writes its changelog entries, `step` (one second by
+    default) apart. With `hold=n`, the last n changelog entries of a change are held back until flush(),
+    e.g. to look at the config database while a migration is committed but its moveChunk.from entry is
+    not written yet.
+"""
+
+from bson import ObjectId, Timestamp
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from bson.son import SON
+
+from snapshot import SnapshotCursor, match, _compile, _project, _candidates, _get_field
+from key_encoding import encode_value
+
+from datetime import datetime, timedelta
+import random
+
+
+class FakeCollection(object):
+    """ collection of a FakeConfigDB, a list of documents in insertion order. """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+
+    def insert(self, doc_or_docs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        self.docs.extend(docs)
+
+    def remove(self, spec):
+        spec = _compile(spec)
+        self.docs = [ doc for doc in self.docs if not match(doc, spec) ]
+
+    def find(self, spec=None, fields=None, projection=None, **kwargs):
+        fields = projection if projection is not None else fields
+        compiled = _compile(spec or {})
+        docs = [ doc for doc in self.docs if match(doc, compiled) ]
+        if fields is not None:
+            docs = [ _project(doc, fields) for doc in docs ]
+        return SnapshotCursor(iter(docs))
+
+    def find_one(self, spec=None, **kwargs):
+        for doc in self.find(spec, **kwargs):
+            return doc
+        return None
+
+    def count(self):
+        return len(self.docs)
+
+    def distinct(self, field):
+        values = {}
+        for doc in self.docs:
+            for value in _candidates(_get_field(doc, field)):
+                values.setdefault(encode_value(value), value)
+        return [ values[k] for k in sorted(values) ]
+
+
+class FakeConfigDB(object):
+    """ database-like object holding FakeCollections, missing collections are created on first access. """
+
+    def __init__(self, name='config'):
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name)
+        return self._collections[name]
+
+    def collection_names(self):
+        return sorted(self._collections)
+
+
+
+class FakeCluster(object):
+    """ simulates the changes of the chunks of sharded collections on a FakeConfigDB (a new one by default).
+        Shard keys are {_id: <int>} between MinKey and MaxKey, chunks are split at random points between
+        -1000000 and 1000000, drawn from a random generator with `seed`.
+    """
+
+    def __init__(self, config_db=None, shards=('shard0000', 'shard0001', 'shard0002'), start=datetime(2013, 11, 1), seed=0):
+        self.config_db = config_db if config_db is not None else FakeConfigDB()
+        self.shards = list(shards)
+        self.time = start
+        self.step = timedelta(seconds=1)
+        self.random = random.Random(seed)
+
+        # changelog entries held back by hold=n, in the order they are written
+        self.pending = []
+
+        # per namespace, the chunks as [min, max, shard, lastmod] sorted by min, and the collection epoch
+        self.chunks = {}
+        self.epochs = {}
+
+        for shard in self.shards:
+            self.config_db['shards'].insert({'_id': shard, 'host': '%s/localhost' % shard})
+
+
+    def _tick(self):
+        self.time += self.step
+        return self.time
+
+    def _bounds(self, chunk):
+        lo = -1000000 if isinstance(chunk[0], MinKey) else chunk[0]
+        hi = 1000000 if isinstance(chunk[1], MaxKey) else chunk[1]
+        return lo, hi
+
+    def _pick(self, namespace, index, min_width=2):
+        """ returns the index of a chunk that is at least min_width wide, a random one if index is None. """
+        chunks = self.chunks[namespace]
+        if index is None:
+            index = self.random.choice([ i for i, chunk in enumerate(chunks) if self._bounds(chunk)[1] - self._bounds(chunk)[0] >= min_width ])
+        return index
+
+    def _version(self, namespace, major=False):
+        """ returns the next shard version of namespace, a new major version for migrations. """
+        top = max( chunk[3] for chunk in self.chunks[namespace] )
+        if major:
+            return Timestamp(top.time + 1, 0)
+        return Timestamp(top.time, top.inc + 1)
+
+    def _chunk_doc(self, namespace, chunk):
+        return SON([ ('_id', '%s-_id_%s' % (namespace, chunk[0])), ('lastmod', chunk[3]), ('lastmodEpoch', self.epochs[namespace]),
+                     ('ns', namespace), ('min', {'_id': chunk[0]}), ('max', {'_id': chunk[1]}), ('shard', chunk[2]) ])
+
+    def _details(self, namespace, chunk):
+        return {'min': {'_id': chunk[0]}, 'max': {'_id': chunk[1]}, 'lastmod': chunk[3], 'lastmodEpoch': self.epochs[namespace]}
+
+    def _write_chunks(self, namespace):
+        self.config_db['chunks'].remove({'ns': namespace})
+        self.config_db['chunks'].insert([ self._chunk_doc(namespace, chunk) for chunk in self.chunks[namespace] ])
+
+    def _log(self, namespace, changes, hold=0):
+        """ writes a changelog entry per (what, details) of changes, holding back the last `hold` of them. """
+        docs = [ {'_id': 'fake-%s' % ObjectId(), 'server': 'localhost', 'clientAddr': '127.0.0.1:27017', 'what': what, 'ns': namespace,
+                  'time': None, 'details': details} for what, details in changes ]
+        written = docs[:len(docs) - hold]
+        for doc in written:
+            doc['time'] = self._tick()
+        self.config_db['changelog'].insert(written)
+        self.pending.extend(docs[len(written):])
+        return docs
+
+
+    def flush(self, n=None):
+        """ writes the first n (default: all) changelog entries held back so far. """
+        n = len(self.pending) if n is None else n
+        docs, self.pending = self.pending[:n], self.pending[n:]
+        for doc in docs:
+            doc['time'] = self._tick()
+        self.config_db['changelog'].insert(docs)
+        return docs
+
+
+    def shard_collection(self, namespace, shard=None):
+        """ shards a collection with a single chunk from MinKey to MaxKey on `shard` (default: the first). """
+        self.epochs[namespace] = ObjectId()
+        self.chunks[namespace] = [ [MinKey(), MaxKey(), shard or self.shards[0], Timestamp(1, 0)] ]
+        self.config_db['collections'].remove({'_id': namespace})
+        self.config_db['collections'].insert({'_id': namespace, 'lastmod': self.time, 'dropped': False, 'key': {'_id': 1},
+                                              'unique': False, 'lastmodEpoch': self.epochs[namespace]})
+        self._write_chunks(namespace)
+        return self._log(namespace, [('shardCollection', {'shard': shard or self.shards[0]})])
+
+
+    def split(self, namespace, index=None, hold=0):
+        """ splits the chunk at `index` (default: a random one) into two, returns the changelog entries. """
+        chunks = self.chunks[namespace]
+        i = self._pick(namespace, index)
+        before = chunks[i]
+        lo, hi = self._bounds(before)
+        point = self.random.randint(lo + 1, hi - 1)
+
+        left = [before[0], point, before[2], self._version(namespace)]
+        right = [point, before[1], before[2], Timestamp(left[3].time, left[3].inc + 1)]
+        chunks[i : i + 1] = [left, right]
+        self._write_chunks(namespace)
+
+        details = {'before': self._details(namespace, before), 'left': self._details(namespace, left), 'right': self._details(namespace, right)}
+        return self._log(namespace, [('split', details)], hold)
+
+
+    def multi_split(self, namespace, parts=3, index=None, hold=0):
+        """ splits the chunk at `index` (default: a random one) into `parts` chunks, with one multi-split
+            entry per new chunk. Returns the changelog entries.
+        """
+        chunks = self.chunks[namespace]
+        i = self._pick(namespace, index, parts)
+        before = chunks[i]
+        lo, hi = self._bounds(before)
+        points = sorted(self.random.sample(xrange(lo + 1, hi), parts - 1))
+        bounds = [before[0]] + points + [before[1]]
+
+        version = self._version(namespace)
+        children = [ [bounds[j], bounds[j + 1], before[2], Timestamp(version.time, version.inc + j)] for j in range(parts) ]
+        chunks[i : i + 1] = children
+        self._write_chunks(namespace)
+
+        changes = [ ('multi-split', {'before': self._details(namespace, before), 'number': j + 1, 'of': parts, 'chunk': self._details(namespace, child)})
+                    for j, child in enumerate(children) ]
+        return self._log(namespace, changes, hold)
+
+
+    def move(self, namespace, to=None, index=None, abort=False, hold=0):
+        """ migrates the chunk at `index` (default: a random one) to shard `to` (default: a random other
+            shard), with the moveChunk.start, .to, .commit and .from entries. An aborted migration only
+            writes moveChunk.start and moveChunk.from. Returns the changelog entries.
+        """
+        chunks = self.chunks[namespace]
+        i = self._pick(namespace, index, 1)
+        chunk = chunks[i]
+        to = to or self.random.choice([ shard for shard in self.shards if shard != chunk[2] ])
+        key = {'min': {'_id': chunk[0]}, 'max': {'_id': chunk[1]}}
+
+        start = ('moveChunk.start', dict(key, **{'from': chunk[2], 'to': to}))
+        if abort:
+            return self._log(namespace, [start, ('moveChunk.from', dict(key, step1=1, note='aborted'))], hold)
+
+        # config.chunks changes with the commit
+        chunks[i] = [chunk[0], chunk[1], to, self._version(namespace, major=True)]
+        self._write_chunks(namespace)
+
+        return self._log(namespace, [start, ('moveChunk.to', dict(key, step1=1)), ('moveChunk.commit', dict(key, **{'from': chunk[2], 'to': to})),
+                                     ('moveChunk.from', dict(key, step1=1))], hold)
+
+
+    def drop(self, namespace):
+        """ drops a sharded collection, its chunks are removed and it is marked as dropped. """
+        del self.chunks[namespace]
+        self.config_db['chunks'].remove({'ns': namespace})
+        for coll in self.config_db['collections'].docs:
+            if coll['_id'] == namespace:
+                coll['dropped'] = True
+        return self._log(namespace, [('dropCollection', {})])
+
+
+    def random_changes(self, namespace, n):
+        """ makes n random splits, multi-splits and migrations, returns all their changelog entries. """
+        docs = []
+        for k in range(n):
+            r = self.random.random()
+            if r < 0.45:
+                docs.extend(self.split(namespace))
+            elif r < 0.6:
+                docs.extend(self.multi_split(namespace, self.random.randint(3, 5)))
+            else:
+                docs.extend(self.move(namespace, abort=(r > 0.95)))
+        return docs
+
+
+    def current(self, namespace):
+        """ returns the chunks of namespace as (min, max, shard) tuples, in the form of Chunk.min/max. """
+        return [ ((chunk[0],), (chunk[1],), chunk[2]) for chunk in self.chunks[namespace] ]
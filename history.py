@@ -0,0 +1,469 @@
+from chunk_distribution import BlockedChunkDistribution
+from sorted_coll import SortedCollection
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from operator import attrgetter
+
+
+class _TimeQueries(object):
+    """ time-based queries shared by the history types. Subclasses provide len(), the ascending index of
+        a time with _bisect_time() and the distributions of an index range with _iter_range().
+    """
+
+    def at(self, t):
+        """ returns the distribution that was current at time t. Raise ValueError if there was none. """
+        i = self._bisect_time(t, right=True)
+        if i == 0:
+            raise ValueError('No distribution found with time at or below: %r' % (t,))
+        return self[i - 1]
+
+
+    def times(self):
+        """ returns the times of all distributions in ascending order, without looking up any of them. """
+        return [ self._time(i) for i in xrange(len(self)) ]
+
+
+    def window(self, t0, t1):
+        """ iterates over the distributions created by changes in [t0, t1), in ascending time. """
+        return self._iter_range(self._bisect_time(t0), self._bisect_time(t1))
+
+
+    def sample(self, interval, start=None, end=None):
+        """ iterates over (t, distribution) pairs for t = start, start + interval, ... up to end, where 
+            `interval` is a timedelta and each distribution is the one that was current at t. Only the
+            sampled distributions are looked up, none of the ones in between. `start` defaults to the time 
+            of the first change, `end` to the time of the last change. 
+        """
+        if not len(self):
+            return
+
+        if start is None:
+            # the oldest distribution of a walk has time datetime.min, it's not a change
+            start = self._time(0)
+            if start == datetime.min and len(self) > 1:
+                start = self._time(1)
+        if end is None:
+            end = self._time(len(self) - 1)
+
+        t = start
+        while t <= end:
+            i = self._bisect_time(t, right=True)
+            if i > 0:
+                yield t, self[i - 1]
+            t += interval
+
+
+
+class TimeIndexedHistory(_TimeQueries, SortedCollection):
+    """ History of a namespace as ChunkDistributions sorted by time. Unlike inserting each distribution of
+        a walk into a SortedCollection, which is O(n) per insert as the walk goes backwards in time, it is 
+        built with from_walk() in a single pass: the distributions are collected in walk order, then put in
+        ascending time order once.
+
+        It is a SortedCollection keyed by time, e.g. history.find_le(t), with the time queries at(t), 
+        window(t0, t1) and sample(interval).
+    """
+
+    def __init__(self, iterable=(), key=None):
+        SortedCollection.__init__(self, iterable, key or attrgetter('time'))
+
+
+    @classmethod
+    def from_walk(cls, distributions):
+        """ creates the history from distributions in walk order (descending time), as yielded by 
+            ConfigParser.walk_distributions().
+        """
+        items = list(distributions)
+        items.reverse()
+
+        # a migration gets the time of its commit, but is applied at its end, so that the times of a walk 
+        # can be out of order around migrations. This stable sort is linear on (nearly) sorted input.
+        items.sort(key=attrgetter('time'))
+        return cls.from_sorted(items)
+
+
+    def _time(self, i):
+        return self._keys[i]
+
+    def _bisect_time(self, t, right=False):
+        return bisect_right(self._keys, t) if right else bisect_left(self._keys, t)
+
+    def _iter_range(self, i, j):
+        for k in xrange(i, j):
+            yield self._items[k]
+
+
+
+class DistributionHistory(_TimeQueries):
+    """ Holds the history of a namespace as a series of ChunkDistributions, without materialising all
+        of them. Every `checkpoint_interval` steps, a full checkpoint (the list of chunks) is stored, and in
+        between only the delta (removed and inserted chunks) of each step. A distribution is rebuilt on
+        request by replaying the deltas from the nearest checkpoint.
+
+        A larger `checkpoint_interval` needs less memory but makes each lookup slower, as up to
+        `checkpoint_interval` deltas have to be replayed. Distributions are rebuilt as `distribution_class`,
+        by default a BlockedChunkDistribution, which is cheap to bulk load from a checkpoint and where each
+        delta only shifts the chunks of one block.
+
+        Distributions are appended in the order ConfigParser.walk_distributions() yields them, i.e.
+        backwards in time. Indexing and iteration are in ascending time, like a SortedCollection keyed
+        by time. The deltas are kept for every step, also the ones with a checkpoint, so that the whole
+        history can be replayed from its first checkpoint, see extend().
+
+        The time queries at(t), window(t0, t1) and sample(interval) are the same as for a
+        TimeIndexedHistory. window() only rebuilds its first distribution and derives the others.
+    """
+
+    def __init__(self, checkpoint_interval=100, distribution_class=BlockedChunkDistribution):
+        if checkpoint_interval < 1:
+            raise ValueError('checkpoint_interval must be at least 1.')
+
+        self.checkpoint_interval = checkpoint_interval
+        self.distribution_class = distribution_class
+
+        # all lists are in walk order (descending time)
+        self._times = []
+        self._changes = []
+        self._whats = []
+        self._checkpoints = []
+        self._deltas = []
+
+        # the most recently rebuilt distribution, as (walk index, distribution)
+        self._cached = None
+
+        # the walk indexes sorted by time and their times, built on first use, see _sorted()
+        self._order = None
+
+
+    def append(self, chunk_dist):
+        """ appends the next (older) distribution of a walk. Every distribution after the first one needs
+            a `delta` relative to its predecessor, as ChunkDistribution.replace() records it.
+        """
+        i = len(self._times)
+
+        if i > 0:
+            if chunk_dist.delta is None:
+                raise ValueError('Error appending to history: distribution has no delta to its predecessor.')
+            self._deltas.append(chunk_dist.delta)
+
+        if i % self.checkpoint_interval == 0:
+            self._checkpoints.append(list(chunk_dist))
+
+        self._times.append(chunk_dist.time)
+        self._changes.append(chunk_dist.applied_change)
+        self._whats.append(getattr(chunk_dist, 'what', None))
+        self._order = None
+
+
+    def _rebuild(self, w):
+        """ rebuilds the distribution at walk index w from its checkpoint and the following deltas. """
+        if self._cached and self._cached[0] == w:
+            return self._cached[1]
+
+        K = self.checkpoint_interval
+        c = w // K
+        chunk_dist = self.distribution_class.from_sorted(self._checkpoints[c])
+
+        # the delta of walk index i is stored at i - 1
+        for removed, inserted in self._deltas[c * K : w]:
+            chunk_dist.update(removed, inserted)
+
+        chunk_dist.time = self._times[w]
+        chunk_dist.applied_change = self._changes[w]
+        chunk_dist.what = self._whats[w]
+
+        self._cached = (w, chunk_dist)
+        return chunk_dist
+
+
+    def extend(self, other):
+        """ appends all distributions of `other`, the history of an older period that starts where this
+            history ends. The step from the last distribution of this history to the first one of `other`
+            is made of all chunks that differ between the two, including chunks that only differ in their
+            shard version. The distributions of `other` are replayed from its first checkpoint, a full copy
+            is only made for the checkpoints of this history.
+        """
+        if not len(other):
+            return
+
+        chunk_dist = other.distribution_class.from_sorted(other._checkpoints[0])
+
+        # an empty history starts with the first distribution of `other`, without a step to it
+        removed, inserted = [], []
+        if len(self):
+            # match the chunks of both distributions by their encoded range
+            unmatched = {}
+            for chunk in chunk_dist:
+                unmatched.setdefault(chunk.key, []).append(chunk)
+
+            removed = []
+            for chunk in self._rebuild(len(self) - 1):
+                candidates = unmatched.get(chunk.key, [])
+                if chunk in candidates:
+                    candidates.remove(chunk)
+                else:
+                    removed.append(chunk)
+            inserted = [ chunk for candidates in unmatched.itervalues() for chunk in candidates ]
+
+        for w in range(len(other)):
+            i = len(self._times)
+            step = (removed, inserted) if w == 0 else other._deltas[w - 1]
+            if w > 0:
+                chunk_dist.update(*step)
+
+            if i > 0:
+                self._deltas.append(step)
+            if i % self.checkpoint_interval == 0:
+                self._checkpoints.append(list(chunk_dist))
+
+            self._times.append(other._times[w])
+            self._changes.append(other._changes[w])
+            self._whats.append(other._whats[w])
+
+        self._cached = None
+        self._order = None
+
+
+    def _sorted(self):
+        """ returns (order, times), the walk indexes sorted by time and their times. A migration gets the 
+            time of its commit, but is applied at its end, so that the times of a walk can be out of order
+            around migrations. Like TimeIndexedHistory, distributions with the same time stay in ascending
+            order of the walk, and the stable sort is linear on (nearly) sorted input.
+        """
+        if self._order is None:
+            order = range(len(self._times) - 1, -1, -1)
+            order.sort(key=self._times.__getitem__)
+            self._order = (order, [ self._times[w] for w in order ])
+        return self._order
+
+
+    def _walk_index(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('history index out of range')
+        return self._sorted()[0][i]
+
+
+    def find_le(self, t):
+        """ Return the distribution that was current at time t (the last one with time <= t).
+            Raise ValueError if not found.
+        """
+        i = self._bisect_time(t, right=True)
+        if i == 0:
+            raise ValueError('No distribution found with time at or below: %r' % (t,))
+        return self[i - 1]
+
+
+    def _time(self, i):
+        return self._times[self._walk_index(i)]
+
+    def _bisect_time(self, t, right=False):
+        """ returns the number of distributions with time < t (or <= t with `right`). """
+        times = self._sorted()[1]
+        return bisect_right(times, t) if right else bisect_left(times, t)
+
+
+    def _step(self, chunk_dist, v, w):
+        """ turns chunk_dist, the distribution at walk index v, into the one at walk index w. """
+        # the delta at walk index u leads from u to u + 1, undo the ones from v down to w, or apply the
+        # ones from v up to w
+        for u in xrange(v - 1, w - 1, -1):
+            removed, inserted = self._deltas[u]
+            chunk_dist.update(inserted, removed)
+        for u in xrange(v, w):
+            removed, inserted = self._deltas[u]
+            chunk_dist.update(removed, inserted)
+
+
+    def _iter_range(self, i, j):
+        """ iterates over the distributions i to j - 1 (ascending). Only distribution i is rebuilt, each
+            following one is derived from its predecessor by undoing the steps of the walk in between.
+        """
+        order = self._sorted()[0]
+        chunk_dist = None
+        for k in xrange(i, j):
+            w = order[k]
+            if chunk_dist is None or abs(w - v) > self.checkpoint_interval:
+                chunk_dist = self._rebuild(w).copy()
+            else:
+                chunk_dist = chunk_dist.copy()
+                self._step(chunk_dist, v, w)
+            v = w
+            chunk_dist.time = self._times[w]
+            chunk_dist.applied_change = self._changes[w]
+            chunk_dist.what = self._whats[w]
+            yield chunk_dist
+
+
+    def __len__(self):
+        return len(self._times)
+
+    def __getitem__(self, i):
+        return self._rebuild(self._walk_index(i))
+
+    def __iter__(self):
+        """ iterates over all distributions in ascending time. Distributions whose time is out of order in 
+            the walk are held back until their turn.
+        """
+        order = self._sorted()[0]
+        pending = {}
+        k = 0
+        for w, chunk_dist in self._iter_walk():
+            pending[w] = chunk_dist
+            while k < len(order) and order[k] in pending:
+                yield pending.pop(order[k])
+                k += 1
+
+
+    def _iter_walk(self):
+        """ iterates over (walk index, distribution) in reverse walk order. Each checkpoint segment is 
+            rebuilt once and then yielded in reverse.
+        """
+        K = self.checkpoint_interval
+        for c in reversed(range(len(self._checkpoints))):
+            segment = []
+            last = min(len(self), (c + 1) * K)
+            for w in range(c * K, last):
+                chunk_dist = self._rebuild(w).copy() if w == c * K else segment[-1].copy()
+                if w > c * K:
+                    removed, inserted = self._deltas[w - 1]
+                    chunk_dist.update(removed, inserted)
+                chunk_dist.time = self._times[w]
+                chunk_dist.applied_change = self._changes[w]
+                chunk_dist.what = self._whats[w]
+                segment.append(chunk_dist)
+
+            for w in reversed(range(c * K, last)):
+                yield w, segment[w - c * K]
+
+    def __repr__(self):
+        return 'DistributionHistory( %i distributions, %i checkpoints, checkpoint_interval=%i )' % (
+            len(self), len(self._checkpoints), self.checkpoint_interval)
+
+
+def find_divergence(histories):
+    """ binary-searches the histories of the same namespace (e.g. from different config servers) for the 
+        point where they diverged. Returns (agreed, diverged), the time of the last change after which all
+        histories still agreed (None if they never did) and the time of the first change after which they 
+        differ. Returns None if they agree at the latest time. 
+
+        Assumes that histories stay different once they diverged. Each step looks up one distribution per
+        history, so this needs O(log m) lookups for m changes. That only pays off for histories that already
+        exist, e.g. from a HistoryCache: building them walks all m changes, while ConfigParser.walk_distributions()
+        in lockstep can stop at the divergence.
+    """
+    times = sorted(set( t for history in histories for t in history.times() ))
+
+    def agree(t):
+        dists = [ history.at(t) for history in histories ]
+        return all( dist == dists[0] for dist in dists )
+
+    if not times or agree(times[-1]):
+        return None
+    if not agree(times[0]):
+        return None, times[0]
+
+    # invariant: histories agree at times[lo], but not at times[hi]
+    lo, hi = 0, len(times) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if agree(times[mid]):
+            lo = mid
+        else:
+            hi = mid
+    return times[lo], times[hi]
+
+
+
+if __name__ == '__main__':
+
+    from config_parser import ConfigParser
+    from fake_cluster import FakeCluster
+    from datetime import timedelta
+    import random
+
+    namespace = 'mydb.mycoll'
+    cluster = FakeCluster(seed=1)
+    cluster.shard_collection(namespace)
+    cluster.random_changes(namespace, 40)
+    cfg_parser = ConfigParser(cluster.config_db)
+
+    def same(a, b):
+        return len(a) == len(b) and all( x == y and x.time == y.time and getattr(x, 'what', None) == getattr(y, 'what', None) for x, y in zip(a, b) )
+
+    full = cfg_parser.build_full_history(namespace, checkpoint_interval=4)
+
+    # extending an empty history, and extending the newer part of a walk with the older part
+    walk = list(cfg_parser.walk_distributions(namespace))
+    for k in (0, 1, len(walk) // 2, len(walk) - 1):
+        history = DistributionHistory(4)
+        for chunk_dist in walk[:k]:
+            history.append(chunk_dist)
+        older = DistributionHistory(3)
+        for chunk_dist in walk[k:]:
+            older.append(chunk_dist)
+        history.extend(older)
+        assert same(list(history), list(full))
+
+    # migrations whose moveChunk.from is written after later changes are out of time order in the walk, both
+    # history types need to agree on every time query anyway
+    for k in range(5):
+        cluster.move(namespace, hold=1)
+        cluster.split(namespace)
+        cluster.multi_split(namespace)
+        cluster.flush()
+        cluster.random_changes(namespace, 3)
+
+    times = [ chunk_dist.time for chunk_dist in cfg_parser.walk_distributions(namespace) ]
+    assert any( a < b for a, b in zip(times, times[1:]) )
+
+    indexed = cfg_parser.build_full_history(namespace)
+    for interval in (1, 2, 5):
+        history = cfg_parser.build_full_history(namespace, checkpoint_interval=interval)
+        assert same(list(history), list(indexed))
+        assert same([ history[i] for i in range(len(history)) ], list(indexed))
+
+        probes = sorted(set(times)) + [ t + timedelta(milliseconds=500) for t in times ]
+        for t in probes:
+            assert same([history.at(t)], [indexed.at(t)]) and same([history.find_le(t)], [indexed.find_le(t)])
+        for t0, t1 in zip(probes[::7], probes[3::7]):
+            assert same(list(history.window(t0, t1)), list(indexed.window(t0, t1)))
+        assert same([ d for t, d in history.sample(timedelta(seconds=3)) ], [ d for t, d in indexed.sample(timedelta(seconds=3)) ])
+
+    # two clusters with the same changes up to a point, compared to the first change after which they differ
+    other = FakeCluster(seed=1)
+    other.shard_collection(namespace)
+    other.random_changes(namespace, 40)
+    for k in range(5):
+        other.move(namespace, hold=1)
+        other.split(namespace)
+        other.multi_split(namespace)
+        other.flush()
+        other.random_changes(namespace, 3)
+    forked = cluster.time
+    cluster.random, other.random = random.Random(10), random.Random(11)
+    cluster.random_changes(namespace, 10)
+    other.random_changes(namespace, 10)
+
+    other_parser = ConfigParser(other.config_db)
+    mine, theirs = cfg_parser.build_full_history(namespace), other_parser.build_full_history(namespace)
+    times = sorted(set(mine.times() + theirs.times()))
+    differ = [ t for t in times if mine.at(t) != theirs.at(t) ]
+    expected = (times[times.index(differ[0]) - 1], differ[0])
+    assert expected[0] <= forked < expected[1]
+
+    for a, b in [(None, None), (None, 3), (5, 1)]:
+        histories = [ cfg_parser.build_full_history(namespace, a), other_parser.build_full_history(namespace, b) ]
+        assert find_divergence(histories) == expected
+        assert find_divergence(histories[:1] * 2) is None
+
+    try:
+        cfg_parser.build_full_history(namespace, 0)
+        assert False
+    except ValueError:
+        pass
+
+    print 'ok'
@@ -0,0 +1,226 @@
+import os
+import cPickle as pickle
+from urllib import quote
+
+from chunk import Chunk
+from chunk_distribution import PersistentChunkDistribution
+from history import DistributionHistory
+
+from pymongo import DESCENDING
+
+
+# increase when the format of the cache files changes
+CACHE_FORMAT = 1
+
+
+def _chunk_state(chunk):
+    return (chunk.shard_version, chunk.shardkey_fields, chunk.range, chunk.shard, chunk.namespace)
+
+def _chunk_from_state(state):
+    chunk = Chunk()
+    chunk.shard_version, chunk.shardkey_fields, chunk.range, chunk.shard, chunk.namespace = state
+    return chunk
+
+
+class HistoryCache(object):
+    """ On-disk cache of the DistributionHistory of each namespace, in one file per namespace in `directory`.
+
+        Each cached history is keyed by the epoch of the collection and the time of the newest changelog
+        entry of the namespace. get() returns the cached history if both are unchanged. If only newer
+        changelog entries were added, it walks back from the current chunks over these entries only, checks
+        that this arrives at the newest cached distribution (same chunk ranges on the same shards), and
+        extends the new steps with the cached history. A changed epoch, a mismatch or a missing cache file
+        lead to a full rebuild.
+
+        A migration that is not finished yet (without its moveChunk.from entry) can't be walked back. The
+        cache is then keyed by the time before that migration, so that the next refresh walks over all of
+        its entries.
+
+        Chunks are stored without their lineage (parent and children).
+    """
+
+    def __init__(self, directory, checkpoint_interval=100):
+        self.directory = directory
+        self.checkpoint_interval = checkpoint_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def _path(self, namespace):
+        return os.path.join(self.directory, quote(namespace.encode('utf-8'), safe='') + '.history')
+
+
+    def get(self, config_parser, namespace):
+        """ returns the DistributionHistory of namespace, reusing and extending the cached history where
+            possible. The cache file is updated if anything changed.
+        """
+        config_db = config_parser.config_db
+        collection = config_db['collections'].find_one({'_id': namespace}) or {}
+        epoch = collection.get('lastmodEpoch')
+
+        newest = self._high_water(config_parser, namespace)
+
+        cached = self.load(namespace)
+        if cached and cached['epoch'] == epoch and cached['history'].checkpoint_interval == self.checkpoint_interval:
+            if cached['newest'] == newest:
+                return cached['history']
+
+            history = self._refresh(config_parser, namespace, cached['history'], cached['newest'])
+        else:
+            history = None
+
+        if history is None:
+            history = config_parser.build_full_history(namespace, checkpoint_interval=self.checkpoint_interval)
+
+        self.save(namespace, history, epoch, newest)
+        return history
+
+
+    def _high_water(self, config_parser, namespace):
+        """ returns the time of the newest changelog entry of namespace that doesn't belong to an unfinished
+            migration, i.e. one without its moveChunk.from entry yet. The walk of a cached history can't
+            apply such a migration, so the next refresh needs to walk over all its entries again. Changes
+            of a namespace hold its distributed lock, so only the newest migration can be unfinished.
+        """
+        changelog = config_parser.config_db['changelog']
+        query = {'ns': namespace, 'what': {'$in': config_parser.walk_changes}}
+
+        for newest in changelog.find(query).sort([('time', DESCENDING)]).limit(1):
+            if newest['what'] in ('moveChunk.start', 'moveChunk.to', 'moveChunk.commit'):
+                # the entries of the migration start with its moveChunk.start
+                first = newest['time']
+                key = config_parser._move_key(newest)
+                for chl in changelog.find({'ns': namespace, 'what': 'moveChunk.start'}).sort([('time', DESCENDING)]):
+                    if config_parser._move_key(chl) == key:
+                        first = chl['time']
+                        break
+
+                for chl in changelog.find({'ns': namespace, 'time': {'$lt': first}}).sort([('time', DESCENDING)]).limit(1):
+                    return chl['time']
+                return None
+
+        return config_parser.last_change_time(namespace)
+
+
+    def _refresh(self, config_parser, namespace, cached, since):
+        """ walks back over the changelog entries newer than `since` and extends the new steps with the
+            cached history. Returns None if the walk doesn't arrive at the newest cached distribution.
+        """
+        if since is None or not len(cached):
+            return None
+
+        history = DistributionHistory(self.checkpoint_interval, cached.distribution_class)
+        previous = None
+        for chunk_dist in config_parser.walk_distributions(namespace, PersistentChunkDistribution, since=since):
+            if previous is not None:
+                history.append(previous)
+            previous = chunk_dist
+
+        # the last distribution of the walk is the one that was current at `since`
+        if previous is None or previous != cached._rebuild(0):
+            return None
+
+        if not len(history):
+            return cached
+        history.extend(cached)
+        return history
+
+
+    def load(self, namespace):
+        """ returns the cache entry of namespace as dict with `history`, `epoch` and `newest`, or None. """
+        try:
+            with open(self._path(namespace), 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if data.get('format') != CACHE_FORMAT:
+            return None
+
+        chunks = [ _chunk_from_state(state) for state in data['chunks'] ]
+        history = DistributionHistory(data['checkpoint_interval'])
+        history._times = data['times']
+        history._changes = data['changes']
+        history._whats = data['whats']
+        history._checkpoints = [ [ chunks[c] for c in checkpoint ] for checkpoint in data['checkpoints'] ]
+        history._deltas = [ ([ chunks[c] for c in removed ], [ chunks[c] for c in inserted ]) for removed, inserted in data['deltas'] ]
+
+        return {'history': history, 'epoch': data['epoch'], 'newest': data['newest']}
+
+
+    def save(self, namespace, history, epoch, newest):
+        """ writes the history of namespace to its cache file. Chunks shared between checkpoints and deltas
+            are stored once.
+        """
+        chunk_ids = {}
+        states = []
+
+        def ids(chunks):
+            result = []
+            for chunk in chunks:
+                if id(chunk) not in chunk_ids:
+                    chunk_ids[id(chunk)] = len(states)
+                    states.append(_chunk_state(chunk))
+                result.append(chunk_ids[id(chunk)])
+            return result
+
+        data = {
+            'format': CACHE_FORMAT,
+            'namespace': namespace,
+            'epoch': epoch,
+            'newest': newest,
+            'checkpoint_interval': history.checkpoint_interval,
+            'times': history._times,
+            'changes': history._changes,
+            'whats': history._whats,
+            'checkpoints': [ ids(checkpoint) for checkpoint in history._checkpoints ],
+            'deltas': [ (ids(removed), ids(inserted)) for removed, inserted in history._deltas ],
+            'chunks': states
+        }
+
+        # write to a temporary file first, so that an interrupted run doesn't leave a broken cache behind
+        path = self._path(namespace)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+
+
+if __name__ == '__main__':
+
+    import shutil
+    import tempfile
+    from config_parser import ConfigParser
+    from fake_cluster import FakeCluster
+
+    # cache a history while a migration is committed but its moveChunk.from entry is not written yet, later
+    # refreshes have to include that migration, like a full rebuild does
+    namespace = 'mydb.mycoll'
+    for hold in (1, 2, 3):
+        directory = tempfile.mkdtemp()
+        try:
+            cluster = FakeCluster(seed=hold)
+            cluster.shard_collection(namespace)
+            cluster.random_changes(namespace, 30)
+
+            cfg_parser = ConfigParser(cluster.config_db)
+            cache = HistoryCache(directory, checkpoint_interval=10)
+            cache.get(cfg_parser, namespace)
+
+            cluster.move(namespace, hold=hold)
+            cache.get(cfg_parser, namespace)
+
+            cluster.flush()
+            cluster.random_changes(namespace, 10)
+
+            history = cache.get(cfg_parser, namespace)
+            full = cfg_parser.build_full_history(namespace, checkpoint_interval=10)
+            assert len(history) == len(full)
+            for cached_dist, full_dist in zip(history, full):
+                assert cached_dist == full_dist and cached_dist.time == full_dist.time and cached_dist.what == full_dist.what
+
+            # unchanged, the cached history is returned as it is
+            assert cache.get(cfg_parser, namespace)._times == history._times
+        finally:
+            shutil.rmtree(directory)
+
+    print 'ok'
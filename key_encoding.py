@@ -0,0 +1,186 @@
+""" Order-preserving binary encoding of shard key values.
+
+    encode_key() turns a tuple of BSON values into a byte string, so that comparing two encoded keys
+    as plain byte strings gives the same result as comparing the values in BSON order:
+
+        MinKey < null < numbers < strings < objects < arrays < binary data < ObjectId < bool
+               < date < timestamp < regex < MaxKey
+
+    Each value is encoded as a type tag, followed by a self-delimiting body. Numbers of all types
+    (int, long, float) are compared by value. Concatenating encoded keys therefore preserves the order
+    of tuples, which is what encode_range() uses for (min, max) tuples of chunk ranges. Encoded keys
+    are hashable and can be stored or serialised directly.
+"""
+
+import re
+import struct
+import calendar
+from datetime import datetime
+from uuid import UUID
+
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+from bson.binary import Binary
+from bson.regex import Regex
+
+
+# type tags in BSON comparison order. 0x00 terminates objects and arrays, 0xff is never used as a tag,
+# so that a key followed by '\xff' sorts after all keys that start with it.
+TAG_MINKEY = '\x01'
+TAG_NULL = '\x05'
+TAG_NUMBER = '\x10'
+TAG_STRING = '\x20'
+TAG_OBJECT = '\x30'
+TAG_ARRAY = '\x40'
+TAG_BINARY = '\x50'
+TAG_OBJECTID = '\x60'
+TAG_BOOL = '\x70'
+TAG_DATE = '\x80'
+TAG_TIMESTAMP = '\x90'
+TAG_REGEX = '\xa0'
+TAG_MAXKEY = '\xf0'
+
+END = '\x00'
+
+_EPOCH = datetime(1970, 1, 1)
+_RE_TYPE = type(re.compile(''))
+
+
+_DOUBLE = struct.Struct('>d')
+_UINT64 = struct.Struct('>Q')
+_NO_REMAINDER = _UINT64.pack(1 << 63)
+
+
+def _encode_double(f):
+    """ 8 bytes that sort like the double f (with -0.0 == 0.0). """
+    if f == 0.0:
+        f = 0.0
+    bits = _UINT64.unpack(_DOUBLE.pack(f))[0]
+    if bits & (1 << 63):
+        bits = ~bits & 0xffffffffffffffff
+    else:
+        bits |= 1 << 63
+    return _UINT64.pack(bits)
+
+def _encode_number(n):
+    """ numbers are encoded as the nearest double, followed by the exact integer remainder, so that ints
+        larger than 2**53 keep their order, and equal ints and floats get the same encoding. NaN sorts
+        before all other numbers.
+    """
+    if isinstance(n, float):
+        if n != n:
+            return '\x00' * 16
+        return _encode_double(n) + _NO_REMAINDER
+    f = float(n)
+    remainder = n - long(f)
+    return _encode_double(f) + (_UINT64.pack(remainder + (1 << 63)) if remainder else _NO_REMAINDER)
+
+def _encode_string(s):
+    """ UTF-8 bytes with 0x00 escaped as 0x00 0xff, terminated by 0x00 0x01. """
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return s.replace('\x00', '\x00\xff') + '\x00\x01'
+
+def _encode_int64(n):
+    return _UINT64.pack(n + (1 << 63))
+
+
+def encode_value(value):
+    """ returns the order-preserving encoding of a single BSON value. Raises TypeError for values that
+        can't be encoded.
+    """
+    # most shard key values are plain numbers or strings, check those first
+    value_type = type(value)
+    if value_type is int or value_type is long or value_type is float:
+        return TAG_NUMBER + _encode_number(value)
+    if value_type is unicode or value_type is str:
+        return TAG_STRING + _encode_string(value)
+
+    if isinstance(value, MinKey):
+        return TAG_MINKEY
+    if isinstance(value, MaxKey):
+        return TAG_MAXKEY
+    if value is None:
+        return TAG_NULL
+    if isinstance(value, bool):
+        return TAG_BOOL + ('\x01' if value else '\x00')
+    if isinstance(value, (int, long, float)):
+        return TAG_NUMBER + _encode_number(value)
+    if isinstance(value, (Binary, UUID)):
+        # binary data compares by length, then subtype, then data
+        data, subtype = (value.bytes, 3) if isinstance(value, UUID) else (str(value), value.subtype)
+        return TAG_BINARY + struct.pack('>IB', len(data), subtype) + data
+    if isinstance(value, basestring):
+        return TAG_STRING + _encode_string(value)
+    if isinstance(value, dict):
+        # objects compare element by element: type of the value, field name, value
+        elements = []
+        for k, v in value.iteritems():
+            encoded = encode_value(v)
+            elements.append(encoded[0] + _encode_string(k) + encoded[1:])
+        return TAG_OBJECT + ''.join(elements) + END
+    if isinstance(value, (list, tuple)):
+        return TAG_ARRAY + ''.join(encode_value(v) for v in value) + END
+    if isinstance(value, ObjectId):
+        return TAG_OBJECTID + value.binary
+    if isinstance(value, datetime):
+        if value.utcoffset() is not None:
+            millis = calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+        else:
+            delta = value - _EPOCH
+            millis = (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+        return TAG_DATE + _encode_int64(millis)
+    if isinstance(value, Timestamp):
+        return TAG_TIMESTAMP + struct.pack('>II', value.time, value.inc)
+    if isinstance(value, (Regex, _RE_TYPE)):
+        return TAG_REGEX + _encode_string(value.pattern) + _encode_string(str(value.flags))
+
+    raise TypeError("can't encode value %r of type %s" % (value, type(value).__name__))
+
+
+def encode_key(values):
+    """ returns the order-preserving encoding of a tuple of values, e.g. chunk.min. """
+    return ''.join(encode_value(value) for value in values)
+
+
+def encode_range(chunk_range):
+    """ returns the order-preserving encoding of a (min, max) chunk range. Chunk ranges of the same
+        namespace have the same number of fields, so the concatenation sorts like the tuple.
+    """
+    return encode_key(chunk_range[0]) + encode_key(chunk_range[1])
+
+
+
+if __name__ == '__main__':
+
+    # encoded keys need to sort exactly like the values in BSON order
+    from random import shuffle
+    from bson.son import SON
+
+    # groups of equal values, in ascending order
+    groups = [ [MinKey()], [None], [float('nan')], [float('-inf')], [-2**63], [-1.5], [-1], [0, -0.0, 0L], [1, 1.0, 1L], 
+               [1.5], [2**53], [2**53 + 1], [2**62], [2**63 - 1], [float('inf')], [u''], [u'a', 'a'], [u'a\x00'], 
+               [u'a\x00b'], [u'ab'], [u'b'], [u'\xe4'], [{u'a': 1}], [SON([(u'a', 1), (u'b', 1)])], [{u'b': 0}], 
+               [{u'a': u'x'}], [[1]], [[1, 2]], [[2]], [Binary('\x01', 0)], [Binary('\x00', 5)], [Binary('\x00\x00', 0)],
+               [ObjectId('000000000000000000000000')], [ObjectId('ffffffffffffffffffffffff')], [False], [True],
+               [datetime(1960, 1, 1)], [datetime(1970, 1, 1)], [datetime(2013, 11, 19, 16, 59, 32, 700000)],
+               [Timestamp(1, 2)], [Timestamp(2, 1)], [Regex(u'a', 0)], [Regex(u'b', 0)], [MaxKey()] ]
+
+    ordered = [ (v, i) for i, group in enumerate(groups) for v in group ]
+    for _ in range(10):
+        shuffle(ordered)
+        result = sorted(ordered, key=lambda (v, i): encode_value(v))
+        assert [i for v, i in result] == sorted(i for v, i in ordered), result
+
+    for group in groups:
+        assert len(set(encode_value(v) for v in group)) == 1, group
+
+    # tuples keep their order, too
+    values = [ group[0] for group in groups[:12] ]
+    tuples = [ (a, b) for a in values for b in values ]
+    keys = [ encode_key(t) for t in tuples ]
+    assert sorted(range(len(tuples)), key=lambda j: keys[j]) == range(len(tuples))
+
+    print 'ok'
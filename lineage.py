@@ -0,0 +1,208 @@
+from key_encoding import encode_range
+
+from datetime import datetime
+
+
+class LineageIndex(object):
+    """ Index over the lineage of the chunks of a namespace. Walking the changelog backwards links each
+        chunk to the chunk it was split from or moved from (Chunk.parent) and vice versa (Chunk.children).
+        This index finds the chunks of a range and remembers when each chunk was created, so that ancestors,
+        descendants and the migration path of a range follow these links, in O(depth), without walking the
+        history again.
+
+        It is built from the distributions of a walk, either with add() for each of them in walk order, or
+        with track(), which indexes the distributions while passing them on:
+
+            lineage = LineageIndex()
+            history = TimeIndexedHistory.from_walk(lineage.track(cfg_parser.walk_distributions(namespace)))
+    """
+
+    def __init__(self):
+        # all chunks of the walk per encoded range, newest first
+        self._by_key = {}
+
+        # time of the change that created each chunk, by id(chunk). Chunks of the oldest distribution are
+        # not in here, they existed from the start.
+        self._created = {}
+
+        self._previous_time = None
+
+
+    def add(self, chunk_dist):
+        """ indexes the next (older) distribution of a walk. """
+        if chunk_dist.delta is None or self._previous_time is None:
+            chunks = chunk_dist
+        else:
+            # the removed chunks were created by the change of the previous (newer) distribution
+            removed, chunks = chunk_dist.delta
+            for chunk in removed:
+                self._created[id(chunk)] = self._previous_time
+
+        for chunk in chunks:
+            self._by_key.setdefault(chunk.key, []).append(chunk)
+
+        self._previous_time = chunk_dist.time
+
+
+    def track(self, distributions):
+        """ iterates over distributions in walk order and indexes each of them. """
+        for chunk_dist in distributions:
+            self.add(chunk_dist)
+            yield chunk_dist
+
+
+    def find(self, chunk_range, shard_version=None):
+        """ returns the newest chunk with range `chunk_range` (a tuple (min, max) of tuples of values), and
+            with `shard_version` if given. Raise ValueError if there is none.
+        """
+        for chunk in self._by_key.get(encode_range(chunk_range), ()):
+            if shard_version is None or chunk.shard_version == shard_version:
+                return chunk
+        raise ValueError('No chunk found with range %s --> %s' % chunk_range)
+
+
+    def created(self, chunk):
+        """ returns the time of the split or migration that created chunk, datetime.min if it was there from
+            the start of the walk.
+        """
+        return self._created.get(id(chunk), datetime.min)
+
+
+    def ancestors(self, chunk):
+        """ returns all ancestors of chunk, from its parent to the oldest one. """
+        ancestors = []
+        while chunk.parent is not None:
+            chunk = chunk.parent
+            ancestors.append(chunk)
+        return ancestors
+
+
+    def descendants(self, chunk_range, shard_version=None):
+        """ returns all descendants of the oldest chunk with range `chunk_range` (and `shard_version` if
+            given), in depth-first order.
+        """
+        chunk = None
+        for candidate in self._by_key.get(encode_range(chunk_range), ()):
+            if shard_version is None or candidate.shard_version == shard_version:
+                chunk = candidate
+        if chunk is None:
+            raise ValueError('No chunk found with range %s --> %s' % chunk_range)
+
+        descendants = []
+        stack = list(reversed(chunk.children))
+        while stack:
+            chunk = stack.pop()
+            descendants.append(chunk)
+            stack.extend(reversed(chunk.children))
+        return descendants
+
+
+    def migration_path(self, chunk_range, shard_version=None):
+        """ returns the shards the data of a chunk range was on, as a list of (time, shard) from the oldest
+            ancestor to the newest chunk with that range. Each entry is the time the data arrived on the
+            shard, splits that keep the data on the same shard don't add an entry.
+        """
+        chunk = self.find(chunk_range, shard_version)
+        lineage = [chunk] + self.ancestors(chunk)
+
+        path = []
+        for chunk in reversed(lineage):
+            if not path or path[-1][1] != chunk.shard:
+                path.append( (self.created(chunk), chunk.shard) )
+        return path
+
+
+    def __len__(self):
+        return sum( len(chunks) for chunks in self._by_key.itervalues() )
+
+    def __repr__(self):
+        return 'LineageIndex( %i chunks, %i ranges )' % (len(self), len(self._by_key))
+
+
+
+if __name__ == '__main__':
+
+    from config_parser import ConfigParser
+    from fake_cluster import FakeCluster
+    from key_encoding import encode_key
+    import random
+
+    namespace = 'mydb.mycoll'
+    cluster = FakeCluster(seed=6)
+    cluster.shard_collection(namespace)
+
+    def chunks():
+        return set( (((chunk[0],), (chunk[1],)), chunk[2]) for chunk in cluster.chunks[namespace] )
+
+    def contains(outer, inner):
+        return encode_key(outer[0]) <= encode_key(inner[0]) and encode_key(inner[1]) <= encode_key(outer[1])
+
+    # forward model of the lineage, each chunk as a dict with range, shard, parent and the time it was created
+    root = {'range': list(chunks())[0][0], 'shard': cluster.shards[0], 'parent': None, 'created': datetime.min}
+    model = [root]
+    current = {(root['range'], root['shard']): root}
+
+    def run(change, *args, **kwargs):
+        """ applies a change to the cluster, the chunks that replace a chunk are its children. """
+        before = chunks()
+        docs = change(namespace, *args, **kwargs)
+        after = chunks()
+        removed = [ current.pop(chunk) for chunk in before - after ]
+
+        # the walk dates a migration by its commit and a multi-split by its newest document, aborted
+        # migrations don't create chunks
+        created = docs[2]['time'] if change == cluster.move and len(docs) == 4 else docs[-1]['time']
+        for chunk_range, shard in sorted(after - before, key=lambda chunk: encode_key(chunk[0][0])):
+            parent = [ node for node in removed if contains(node['range'], chunk_range) ][0]
+            node = {'range': chunk_range, 'shard': shard, 'parent': parent, 'created': created}
+            model.append(node)
+            current[(chunk_range, shard)] = node
+
+    # splits, multi-splits (merged back into their chunk by the walk), migrations and aborted migrations
+    rnd = random.Random(6)
+    for k in range(60):
+        r = rnd.random()
+        if r < 0.4:
+            run(cluster.split)
+        elif r < 0.55:
+            run(cluster.multi_split, rnd.randint(3, 5))
+        else:
+            run(cluster.move, abort=(r > 0.9))
+
+    lineage = ConfigParser(cluster.config_db).build_lineage(namespace)
+    assert len(lineage) == len(model)
+
+    def path(node):
+        nodes = []
+        while node is not None:
+            nodes.append(node)
+            node = node['parent']
+        return nodes
+
+    for (chunk_range, shard), node in current.items():
+        chunk = lineage.find(chunk_range)
+        assert chunk.shard == shard and lineage.created(chunk) == node['created']
+
+        # ancestors, from the parent to the chunk that existed from the start
+        expected = path(node)[1:]
+        assert [ (ancestor.range, ancestor.shard) for ancestor in lineage.ancestors(chunk) ] == [ (n['range'], n['shard']) for n in expected ]
+        assert [ lineage.created(ancestor) for ancestor in lineage.ancestors(chunk) ] == [ n['created'] for n in expected ]
+
+        # shards the data was on, with the time it arrived there
+        expected = []
+        for n in reversed(path(node)):
+            if not expected or expected[-1][1] != n['shard']:
+                expected.append( (n['created'], n['shard']) )
+        assert lineage.migration_path(chunk_range) == expected
+
+    # all chunks ever created descend from the first one, each one after its parent
+    descendants = lineage.descendants(root['range'])
+    assert sorted( (chunk.key, chunk.shard) for chunk in descendants ) == \
+        sorted( (encode_range(n['range']), n['shard']) for n in model[1:] )
+    assert descendants[0].parent.range == root['range'] and descendants[0].parent.parent is None
+    seen = set([ id(descendants[0].parent) ])
+    for chunk in descendants:
+        assert id(chunk.parent) in seen
+        seen.add(id(chunk))
+
+    print 'ok'
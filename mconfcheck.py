@@ -5,14 +5,17 @@ from bson.max_key import MaxKey
 from bson import ObjectId, Timestamp
 
 from chunk import Chunk
-from chunk_distribution import ChunkDistribution
+from key_encoding import encode_key
 from config_parser import ConfigParser
+from snapshot import open_config
 
 from copy import copy, deepcopy
 from dateutil import parser
 from operator import itemgetter
-from itertools import izip_longest
+from itertools import chain, imap, islice, izip, izip_longest
+from multiprocessing.pool import ThreadPool
 
+import os
 import pprint
 import argparse
 import re
@@ -27,6 +30,34 @@ def all_equal(l):
 def argmax(l):
     return max(enumerate(l), key=itemgetter(1))[0]
 
+_DONE = object()
+
+def prefetched(iterator, pool):
+    """ returns an iterator over the items of iterator, computing the next item on pool in the background
+        while the current one is used. The first item is requested immediately. pool should only have a 
+        single worker, so that the iterator is never advanced by two threads at once.
+    """
+    pending = [ pool.apply_async(next, (iterator, _DONE)) ]
+
+    def items():
+        while True:
+            item = pending[0].get()
+            if item is _DONE:
+                return
+            pending[0] = pool.apply_async(next, (iterator, _DONE))
+            yield item
+
+    return items()
+
+
+def with_max_shard_version(distributions):
+    """ generates (distribution, max shard version) for distributions of a walk. The version is computed
+        before the walk moves on, as the next step updates the shard versions of chunks it shares with the
+        current distribution.
+    """
+    for chunk_dist in distributions:
+        yield chunk_dist, chunk_dist.max_shard_version()
+
 
 class MConfCheckTool(BaseCmdLineTool):
 
@@ -35,7 +66,8 @@ class MConfCheckTool(BaseCmdLineTool):
         BaseCmdLineTool.__init__(self)
 
         self.argparser.description = 'Performs a health check on config servers and compares them for inconsistencies.'
-        self.argparser.add_argument('config', action='store', nargs='*', metavar='URI', default=['mongodb://localhost:27017/config'], help='provide uri(s) to config server(s), default is mongodb://localhost:27017/config')
+        self.argparser.add_argument('config', action='store', nargs='*', metavar='URI', default=['mongodb://localhost:27017/config'], help='provide uri(s) to config server(s), or paths to config dumps or snapshot files, default is mongodb://localhost:27017/config')
+        self.argparser.add_argument('--jobs', '-j', action='store', type=int, default=1, metavar='N', help='number of namespaces to fetch and check concurrently, default is 1')
 
     def run(self, arguments=None):
         BaseCmdLineTool.run(self, arguments)
@@ -43,37 +75,40 @@ class MConfCheckTool(BaseCmdLineTool):
         # number of configs
         self.num_configs = len(self.args['config'])
 
+        # config dumps and snapshot files (see snapshot.py) are read offline, all other arguments are URIs
+        uris = [ uri for uri in self.args['config'] if not os.path.exists(uri) ]
+
         # parse config server URIs
         regex = re.compile(r'(?P<mongodb>mongodb://)?((?P<user>\w+):(?P<password>\w+)@)?(?P<host>\w+)(:(?P<port>\d+))?/(?P<database>\w+)')
-        matches = [ regex.match(uri) for uri in self.args['config'] ]
+        matches = [ regex.match(uri) for uri in uris ]
 
         # verify that all config URIs are parsed correctly and contain a database
         # TODO check for empty config dbs
         if not all(matches) or not all(m.groupdict()['database'] for m in matches):
             raise SystemExit('Unable to parse config server URIs, please check syntax: mongodb://[username:password@]host[:port]/database')
 
-        # for convenience mongodb:// can be omitted for this script, but MongoClient expects it
-        for i, uri in enumerate(self.args['config']):
-            if not uri.startswith('mongodb://'):
-                self.args['config'][i] = 'mongodb://' + uri
-
-        # add uri and short_uri to self.parsed_uri dicts
-        self.parsed_uris = [m.groupdict() for m in matches]
-        for i, (uri, puri) in enumerate(zip(self.args['config'], self.parsed_uris)):
-            self.parsed_uris[i]['uri'] = uri
+        # add uri and short_uri to self.parsed_uri dicts, and connect to databases
+        self.parsed_uris = []
+        self.config_dbs = []
+        matches = iter(matches)
+        for uri in self.args['config']:
+            if os.path.exists(uri):
+                self.parsed_uris.append( {'uri': uri, 'short_uri': uri} )
+                self.config_dbs.append( open_config(uri) )
+                continue
+
+            # for convenience mongodb:// can be omitted for this script, but MongoClient expects it
+            puri = next(matches).groupdict()
+            puri['uri'] = uri if uri.startswith('mongodb://') else 'mongodb://' + uri
             if puri['port'] == None:
-                self.parsed_uris[i]['port'] = '27017'
-            self.parsed_uris[i]['short_uri'] = '%s:%s/%s' % (puri['host'], puri['port'], puri['database'])
-
-        # connect to databases
-        self.config_dbs = [ MongoClient(puri['uri'])[puri['database']] for puri in self.parsed_uris ]
+                puri['port'] = '27017'
+            puri['short_uri'] = '%s:%s/%s' % (puri['host'], puri['port'], puri['database'])
+            self.parsed_uris.append(puri)
+            self.config_dbs.append( MongoClient(puri['uri'])[puri['database']] )
 
         print "\n>> individual health checks on all config servers"
         print   "   (verifies that for each namespace, the chunk ranges reach from MinKey to MaxKey without gaps or overlaps)\n"
-        for puri, database in zip(self.parsed_uris, self.config_dbs):
-            print puri['short_uri']
-            self._health_check(database)
-            print 
+        self._health_checks()
 
         if len(self.config_dbs) > 1:
             print "\n>> comparing config.collections collection for each config server"
@@ -86,26 +121,91 @@ class MConfCheckTool(BaseCmdLineTool):
             self._compare_chunks_and_reconstruct()
 
 
-    def _health_check(self, database):
-        # create config parser
-        cfg_parser = ConfigParser(database)
-
-        # get all collections
-        collections = [c['_id'] for c in database['collections'].find({'dropped': {'$ne': True}})]
-
-        # validate that for each collection, the corresponding chunks form a distribution from 
-        # MinKey to MaxKey without gaps or overlaps.
-        for namespace in collections:
-            print '    ', namespace, 
-            chunk_dist = cfg_parser.get_chunk_distribution(namespace)
-            ret, msgs = chunk_dist.check()
-            if ret: 
-                print '  ok'
+    def _health_checks(self):
+        """ checks all namespaces on all config servers and prints the results of each server as they come
+            in. With `--jobs` > 1, each config server reads its chunks on its own worker thread, one namespace
+            ahead of the checks, and the checks run on up to `--jobs` worker threads. The results are printed
+            in the same order as when checking them one after another.
+        """
+        jobs = self.args['jobs']
+        fetch_pools = [ ThreadPool(1) for database in self.config_dbs ] if jobs > 1 else None
+        pool = ThreadPool(jobs) if jobs > 1 else None
+
+        try:
+            # get all collections of each config server, their chunks are read in a single query per server
+            batches = []
+            counts = []
+            for i, database in enumerate(self.config_dbs):
+                cfg_parser = ConfigParser(database)
+                collections = sorted(c['_id'] for c in database['collections'].find({'dropped': {'$ne': True}}))
+                batch = cfg_parser.get_all_chunk_distributions(collections)
+                batches.append(prefetched(batch, fetch_pools[i]) if fetch_pools else batch)
+                counts.append(len(collections))
+
+            if pool:
+                # take the next namespace of each config server in turn, so that all servers are read at once
+                tasks = ( (server, namespace, chunk_dist) for step in izip_longest(*batches, fillvalue=(None, None)) 
+                          for server, (namespace, chunk_dist) in enumerate(step) if namespace is not None )
+
+                # imap returns the results in order of the tasks
+                self._print_checks(pool.imap(self._check_namespace, tasks), counts)
             else:
-                print '  failed\n'
-                for msg in msgs:
-                    print '       ! %s' % msg
+                tasks = ( (server, namespace, chunk_dist) for server, batch in enumerate(batches) for namespace, chunk_dist in batch )
+                self._print_checks(imap(self._check_namespace, tasks), counts)
+        finally:
+            for p in [pool] + (fetch_pools or []):
+                if p:
+                    p.close()
+
+
+    def _print_checks(self, results, counts):
+        """ prints the results of _check_namespace() grouped by config server, where server i has counts[i]
+            namespaces. The results of the server being printed are printed as they come in, those of later
+            servers are held back until it's their turn.
+        """
+        pending = [ [] for count in counts ]
+        printed = [0] * len(counts)
+        server, started = 0, False
+
+        # the trailing None prints the servers without namespaces at the end
+        for result in chain(results, [None]):
+            if result is not None:
+                pending[result[0]].append(result)
+
+            while server < len(counts):
+                if not started:
+                    print self.parsed_uris[server]['short_uri']
+                    started = True
+
+                for result_server, namespace, ret, msgs in pending[server]:
+                    self._print_check(namespace, ret, msgs)
+                printed[server] += len(pending[server])
+                pending[server] = []
+
+                if printed[server] < counts[server]:
+                    break
                 print
+                server, started = server + 1, False
+
+
+    def _check_namespace(self, task):
+        """ validates that the chunks of the namespace form a distribution from MinKey to MaxKey without 
+            gaps or overlaps. task is (server, namespace, chunk_dist), returns (server, namespace, ret, msgs).
+        """
+        server, namespace, chunk_dist = task
+        ret, msgs = chunk_dist.check()
+        return server, namespace, ret, msgs
+
+
+    def _print_check(self, namespace, ret, msgs):
+        print '    ', namespace, 
+        if ret: 
+            print '  ok'
+        else:
+            print '  failed\n'
+            for msg in msgs:
+                print '       ! %s' % msg
+            print
 
 
     def _compare_collections(self):
@@ -163,54 +263,103 @@ class MConfCheckTool(BaseCmdLineTool):
         config_parsers = [ ConfigParser(db) for db in self.config_dbs ]
         shorturi_len = max( len(puri['short_uri']) for puri in self.parsed_uris )
 
+        # one worker per config server, so that all servers are queried concurrently
+        pools = [ ThreadPool(1) for parser in config_parsers ]
+        try:
+            self._compare_chunks(config_parsers, pools, shorturi_len)
+        finally:
+            for pool in pools:
+                pool.close()
+
+
+    def _chunk_differences(self, chunk_dists):
+        """ returns a row for each chunk min where the distributions differ, with a cell for each config
+            server that shows range and shard of its chunk starting there (or is empty). The differences to 
+            the first config server are located with the distribution fingerprints, only that region is 
+            compared chunk by chunk.
+        """
+        # range of chunk keys that contains all differences
+        keys = []
+        for chunk_dist in chunk_dists[1:]:
+            mine, theirs = chunk_dists[0].differences(chunk_dist)
+            keys.extend( chunk.key for chunk in mine + theirs )
+        lo, hi = min(keys), max(keys)
+
+        # chunks of each config server in that range, aligned by their min
+        chunks_by_min = {}
+        for i, chunk_dist in enumerate(chunk_dists):
+            try:
+                start = chunk_dist.index( chunk_dist.find_ge(lo) )
+            except ValueError:
+                continue
+            for chunk in islice(chunk_dist, start, None):
+                if chunk.key > hi:
+                    break
+                chunks_by_min.setdefault(encode_key(chunk.min), [None] * len(chunk_dists))[i] = chunk
+
+        rows = []
+        for key in sorted(chunks_by_min):
+            chunks = chunks_by_min[key]
+            if all( ch is not None for ch in chunks ) and all_equal( [ (ch.key, ch.shard) for ch in chunks ] ):
+                continue
+            rows.append([ '%s - %s %s' % (dict(zip(ch.shardkey_fields, ch.min)), dict(zip(ch.shardkey_fields, ch.max)), ch.shard) if ch else '' 
+                          for ch in chunks ])
+        return rows
+
+
+    def _print_chunk_differences(self, chunk_dists, shorturi_len, title):
+        """ prints a header with the config servers and the differing chunks, aligned by chunk range. """
+        rows = self._chunk_differences(chunk_dists)
+        column_len = max([shorturi_len] + [ len(cell) for row in rows for cell in row ])
+
+        print '    ' + title.ljust(15),
+        print '    ' + '    '.join( puri['short_uri'].ljust(column_len) for puri in self.parsed_uris )
+        print
+
+        for row in rows:
+            print 'differ >'.rjust(19),
+            print '    ' + '    '.join( cell.ljust(column_len) for cell in row )
+        print
+
 
-        for collection in self.all_collections:
+    def _compare_chunks(self, config_parsers, pools, shorturi_len):
+
+        # each config server reads the chunks of all collections in a single query, sorted by namespace,
+        # and builds the distribution of the next collection in the background
+        collections = sorted(self.all_collections)
+        batches = [ prefetched(parser.get_all_chunk_distributions(collections), pool) for parser, pool in zip(config_parsers, pools) ]
+
+        for collection, batch in izip(collections, izip(*batches)):
             print collection, '\n'
-            chunk_dists = [ parser.get_chunk_distribution(collection) for parser in config_parsers ]
+            chunk_dists = [ chunk_dist for namespace, chunk_dist in batch ]
             diff_found = False
 
             # check if the chunk distributions disagree on the chunks collection
             if not all_equal( chunk_dists ):
                 diff_found = True
-                chunk_len = len( str(dict(zip(chunk_dists[0][0].shardkey_fields, chunk_dists[0][0].max))) )
-                shorturi_len = max(shorturi_len, chunk_len)
-
-                print '    ! chunks differ',
-                print '    ' + '    '.join( puri['short_uri'].ljust(shorturi_len) for puri in self.parsed_uris )
-                print
-            
-                # TODO: prints all chunk differences but doesn't align them anymore, once a difference is found
-                # all following chunks will also differ. needs to align them again.
-                
-                # for chunks in izip_longest(*chunk_dists, fillvalue=Chunk()):
-                #     if not all_equal(chunks):
-                #         print 'first diff >'.center(23),
-
-                #         for ch in chunks:
-                #             if ch.min:
-                #                 print str(dict(zip(ch.shardkey_fields, ch.min))).ljust(chunk_len) + '   ',
-                #             else:
-                #                 print ''.ljust(chunk_len) + '   ',
-                #         print
-                #         break
+                self._print_chunk_differences(chunk_dists, shorturi_len, '! chunks differ')
 
 
             if diff_found:
                 # now go backwards in time to find a point where all chunk distributions were the same
-                chunk_dist_generators = [ parser.walk_distributions(collection) for parser in config_parsers ]
+                # each generator computes its next step in the background, on the worker of its config server
+                chunk_dist_generators = [ prefetched(with_max_shard_version(parser.walk_distributions(collection)), pool) 
+                                          for parser, pool in zip(config_parsers, pools) ]
                 
                 # get first element of each generator
-                current_chunk_dists = [ generator.next() for generator in chunk_dist_generators ]
+                current = [ generator.next() for generator in chunk_dist_generators ]
+                current_chunk_dists = [ chunk_dist for chunk_dist, version in current ]
 
                 while not all_equal( current_chunk_dists ):
                     # find chunk distribution with highest chunk version
-                    highest_dist_index = argmax( [ dist.max_shard_version() if isinstance(dist, ChunkDistribution) else (-1, -1) for dist in current_chunk_dists ] )
+                    highest_dist_index = argmax( [ version for chunk_dist, version in current ] )
 
                     # let that generator generate the next chunk distribution and replace in current dists
                     try:
-                        current_chunk_dists[ highest_dist_index ] = chunk_dist_generators[ highest_dist_index ].next()
+                        current[ highest_dist_index ] = chunk_dist_generators[ highest_dist_index ].next()
                     except StopIteration:
-                        current_chunk_dists[ highest_dist_index ] = None
+                        current[ highest_dist_index ] = (None, (-1, -1))
+                    current_chunk_dists[ highest_dist_index ] = current[ highest_dist_index ][0]
 
 
                 if all_equal( current_chunk_dists ) and current_chunk_dists[0] != None:
@@ -0,0 +1,439 @@
+from random import random
+from itertools import islice
+
+from sorted_coll import SortedCollection, _check_sorted
+
+
+class _Node(object):
+    """ node of the persistent treap. Nodes are never modified once they are part of a tree,
+        all updates copy the path from the root to the changed node instead.
+    """
+    __slots__ = ('key', 'item', 'prio', 'left', 'right', 'size', 'weight', 'total')
+
+    def __init__(self, key, item, prio, left=None, right=None, weight=0):
+        self.key = key
+        self.item = item
+        self.prio = prio
+        self.left = left
+        self.right = right
+        self.size = 1 + _size(left) + _size(right)
+        self.weight = weight
+        self.total = weight + _total(left) + _total(right)
+
+
+def _size(node):
+    return node.size if node else 0
+
+def _total(node):
+    return node.total if node else 0
+
+def _with_children(node, left, right):
+    """ returns a copy of node with new children. """
+    return _Node(node.key, node.item, node.prio, left, right, node.weight)
+
+def _merge(a, b):
+    """ merges two treaps, where all keys in a are <= all keys in b. """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio >= b.prio:
+        return _with_children(a, a.left, _merge(a.right, b))
+    return _with_children(b, _merge(a, b.left), b.right)
+
+def _split_key(node, k, right):
+    """ splits a treap into keys < k and keys >= k (right=False), or keys <= k and keys > k (right=True). """
+    if node is None:
+        return None, None
+    if node.key < k or (right and node.key == k):
+        l, r = _split_key(node.right, k, right)
+        return _with_children(node, node.left, l), r
+    l, r = _split_key(node.left, k, right)
+    return l, _with_children(node, r, node.right)
+
+def _split_pos(node, i):
+    """ splits a treap into the first i items and the rest. """
+    if node is None:
+        return None, None
+    left_size = _size(node.left)
+    if i <= left_size:
+        l, r = _split_pos(node.left, i)
+        return l, _with_children(node, r, node.right)
+    l, r = _split_pos(node.right, i - left_size - 1)
+    return _with_children(node, node.left, l), r
+
+def _build(decorated, lo, hi, prios, weigh=None):
+    """ builds a balanced treap from the sorted (key, item) list decorated[lo:hi]. prios are
+        popped in breadth-first order, so they have to be sorted ascending to keep the heap property.
+        weigh(item) gives the weight of each node, if set.
+    """
+    if lo >= hi:
+        return None
+    levels = [[(lo, hi)]]
+    while levels[-1]:
+        nxt = []
+        for a, b in levels[-1]:
+            mid = (a + b) // 2
+            if a < mid:
+                nxt.append((a, mid))
+            if mid + 1 < b:
+                nxt.append((mid + 1, b))
+        levels.append(nxt)
+
+    # assign priorities top-down, create nodes bottom-up
+    prio_of = {}
+    for level in levels:
+        for a, b in level:
+            prio_of[(a, b)] = prios.pop()
+
+    nodes = {}
+    for level in reversed(levels):
+        for a, b in level:
+            mid = (a + b) // 2
+            k, item = decorated[mid]
+            nodes[(a, b)] = _Node(k, item, prio_of[(a, b)], nodes.pop((a, mid), None), nodes.pop((mid + 1, b), None),
+                                  weigh(item) if weigh else 0)
+    return nodes[(lo, hi)]
+
+
+class PersistentSortedCollection(SortedCollection):
+    '''SortedCollection backed by a persistent (path-copying) treap.
+
+    The API is identical to SortedCollection. The difference is in the cost model:
+    copy() is O(1), because a copy shares the whole tree with its original. insert()
+    and remove() are O(log n) and only copy the nodes on the path from the root to
+    the changed position, all other nodes remain shared between the versions. Finding
+    and indexing are O(log n), iteration is O(n).
+
+    This makes it cheap to keep many versions of a large collection around, where
+    each version only differs from its predecessor in a few items.
+
+    Subclasses can set _weigh to a function of an item.  Each node then keeps the
+    sum of the weights in its subtree, and _prefix_weight(i) returns the sum of the
+    weights of the first i items in O(log n).
+
+    >>> s = PersistentSortedCollection([5, 1, 3])
+    >>> t = s.copy()
+    >>> t.insert(4)
+    >>> t.remove(1)
+    >>> list(s), list(t)
+    ([1, 3, 5], [3, 4, 5])
+    >>> t.find_le(4), t.index(5), t[-1], t[1:]
+    (4, 2, 5, [4, 5])
+
+    '''
+
+    _weigh = None
+
+    def __init__(self, iterable=(), key=None):
+        self._given_key = key
+        key = (lambda x: x) if key is None else key
+        decorated = sorted(((key(item), item) for item in iterable), key=lambda d: d[0])
+        prios = sorted(random() for _ in decorated)
+        self._root = _build(decorated, 0, len(decorated), prios, self._weigh)
+        self._key = key
+
+    @classmethod
+    def from_sorted(cls, iterable, key=None):
+        'Create a collection from items already sorted by key.  Raise ValueError if they are not sorted'
+        coll = cls(key=key)
+        decorated = [(coll._key(item), item) for item in iterable]
+        _check_sorted([k for k, item in decorated])
+        coll._root = _build(decorated, 0, len(decorated), sorted(random() for _ in decorated), coll._weigh)
+        return coll
+
+    def _setkey(self, key):
+        if key is not self._key:
+            self.__init__(list(self), key=key)
+
+    key = property(SortedCollection._getkey, _setkey, SortedCollection._delkey, 'key function')
+
+    def clear(self):
+        self._root = None
+
+    def copy(self):
+        return self.__copy__()
+
+    def __copy__(self):
+        # create an empty instance (this calls subclass constructors), then share the tree
+        other = self.__class__(key=self._given_key)
+        other._root = self._root
+        other._key = self._key
+        return other
+
+    def __len__(self):
+        return _size(self._root)
+
+    def _node_at(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('list index out of range')
+        node = self._root
+        while True:
+            left_size = _size(node.left)
+            if i < left_size:
+                node = node.left
+            elif i == left_size:
+                return node
+            else:
+                i -= left_size + 1
+                node = node.right
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step > 0:
+                return list(islice(self._iter_from(start), 0, max(0, stop - start), step))
+            return list(self)[i]
+        return self._node_at(i).item
+
+    def _prefix_weight(self, i):
+        'Return the sum of the weights of the first i items'
+        total = 0
+        node = self._root
+        while node is not None and i > 0:
+            left_size = _size(node.left)
+            if i <= left_size:
+                node = node.left
+            else:
+                total += _total(node.left) + node.weight
+                i -= left_size + 1
+                node = node.right
+        return total
+
+    def _new_node(self, k, item):
+        return _Node(k, item, random(), weight=self._weigh(item) if self._weigh else 0)
+
+    def _iter_nodes(self, start=0, reverse=False):
+        """ in-order traversal over nodes, beginning at position start. """
+        stack = []
+        node = self._root
+        first, second = ('right', 'left') if reverse else ('left', 'right')
+        skip = start
+        while node is not None:
+            before = _size(getattr(node, first))
+            if skip < before:
+                stack.append(node)
+                node = getattr(node, first)
+            else:
+                skip -= before
+                if skip == 0:
+                    stack.append(node)
+                    break
+                skip -= 1
+                node = getattr(node, second)
+        else:
+            return
+
+        while stack:
+            node = stack.pop()
+            yield node
+            node = getattr(node, second)
+            while node is not None:
+                stack.append(node)
+                node = getattr(node, first)
+
+    def _iter_from(self, start):
+        return (node.item for node in self._iter_nodes(start))
+
+    def __iter__(self):
+        return self._iter_from(0)
+
+    def __reversed__(self):
+        return (node.item for node in self._iter_nodes(0, reverse=True))
+
+    def __repr__(self):
+        return '%s(%r, key=%s)' % (
+            self.__class__.__name__,
+            list(self),
+            getattr(self._given_key, '__name__', repr(self._given_key))
+        )
+
+    def __reduce__(self):
+        return self.__class__, (list(self), self._given_key)
+
+    def _bisect_left(self, k):
+        i = 0
+        node = self._root
+        while node is not None:
+            if node.key < k:
+                i += _size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return i
+
+    def _bisect_right(self, k):
+        i = 0
+        node = self._root
+        while node is not None:
+            if k < node.key:
+                node = node.left
+            else:
+                i += _size(node.left) + 1
+                node = node.right
+        return i
+
+    def _equal_range(self, item):
+        k = self._key(item)
+        i = self._bisect_left(k)
+        j = self._bisect_right(k)
+        return i, [node.item for node in islice(self._iter_nodes(i), j - i)]
+
+    def __contains__(self, item):
+        return item in self._equal_range(item)[1]
+
+    def index(self, item):
+        'Find the position of an item.  Raise ValueError if not found.'
+        i, items = self._equal_range(item)
+        return items.index(item) + i
+
+    def count(self, item):
+        'Return number of occurrences of item'
+        return self._equal_range(item)[1].count(item)
+
+    def insert(self, item):
+        'Insert a new item.  If equal keys are found, add to the left'
+        k = self._key(item)
+        l, r = _split_key(self._root, k, right=False)
+        self._root = _merge(_merge(l, self._new_node(k, item)), r)
+
+    def insert_right(self, item):
+        'Insert a new item.  If equal keys are found, add to the right'
+        k = self._key(item)
+        l, r = _split_key(self._root, k, right=True)
+        self._root = _merge(_merge(l, self._new_node(k, item)), r)
+
+    def remove(self, item):
+        'Remove first occurence of item.  Raise ValueError if not found'
+        i = self.index(item)
+        l, r = _split_pos(self._root, i)
+        self._root = _merge(l, _split_pos(r, 1)[1])
+
+    def update(self, remove=(), insert=()):
+        '''Remove and insert several items, O(log n) each.  Raise ValueError if an
+        item to remove is not found, in which case the collection is unchanged.'''
+        root = self._root
+        try:
+            for item in remove:
+                self.remove(item)
+        except ValueError:
+            self._root = root
+            raise
+        for item in insert:
+            self.insert(item)
+
+    def find(self, k):
+        'Return first item with a key == k.  Raise ValueError if not found.'
+        i = self._bisect_left(k)
+        if i != len(self):
+            node = self._node_at(i)
+            if node.key == k:
+                return node.item
+        raise ValueError('No item found with key equal to: %r' % (k,))
+
+    def find_le(self, k):
+        'Return last item with a key <= k.  Raise ValueError if not found.'
+        i = self._bisect_right(k)
+        if i:
+            return self[i-1]
+        raise ValueError('No item found with key at or below: %r' % (k,))
+
+    def find_lt(self, k):
+        'Return last item with a key < k.  Raise ValueError if not found.'
+        i = self._bisect_left(k)
+        if i:
+            return self[i-1]
+        raise ValueError('No item found with key below: %r' % (k,))
+
+    def find_ge(self, k):
+        'Return first item with a key >= equal to k.  Raise ValueError if not found'
+        i = self._bisect_left(k)
+        if i != len(self):
+            return self[i]
+        raise ValueError('No item found with key at or above: %r' % (k,))
+
+    def find_gt(self, k):
+        'Return first item with a key > k.  Raise ValueError if not found'
+        i = self._bisect_right(k)
+        if i != len(self):
+            return self[i]
+        raise ValueError('No item found with key above: %r' % (k,))
+
+
+if __name__ == '__main__':
+
+    from random import choice
+
+    # compare against the list based SortedCollection, including old versions staying intact
+    pool = [1.5, 2, 2.0, 3, 3.0, 3.5, 4, 4.0, 4.5]
+    for i in range(300):
+        ref = SortedCollection()
+        per = PersistentSortedCollection()
+        versions = []
+        for n in range(12):
+            item = choice(pool)
+            if ref and choice([True, False]):
+                item = choice(list(ref))
+                ref.remove(item)
+                per.remove(item)
+            elif choice([True, False]):
+                ref.insert(item)
+                per.insert(item)
+            else:
+                ref.insert_right(item)
+                per.insert_right(item)
+            versions.append((list(map(repr, ref)), per))
+            per = per.copy()
+
+            assert list(map(repr, per)) == list(map(repr, ref))
+            assert list(map(repr, reversed(per))) == list(map(repr, reversed(ref)))
+            assert len(per) == len(ref)
+            for probe in pool:
+                for f in ('find', 'find_le', 'find_lt', 'find_ge', 'find_gt', 'index', 'count'):
+                    try:
+                        r1 = repr(getattr(ref, f)(probe))
+                    except ValueError:
+                        r1 = 'ValueError'
+                    try:
+                        r2 = repr(getattr(per, f)(probe))
+                    except ValueError:
+                        r2 = 'ValueError'
+                    assert r1 == r2, (f, probe, r1, r2)
+                assert (probe in per) == (probe in ref)
+            for s in (slice(None), slice(1, None), slice(None, -1), slice(2, 5), slice(None, None, 2), slice(None, None, -1)):
+                assert list(map(repr, per[s])) == list(map(repr, ref[s]))
+
+        for items, version in versions:
+            assert list(map(repr, version)) == items
+
+        # test from_sorted() and update()
+        per = PersistentSortedCollection.from_sorted(list(ref))
+        remove = list(ref)[::3]
+        insert = [choice(pool) for n in range(3)]
+        ref.update(remove, insert)
+        per.update(remove, insert)
+        assert list(map(repr, per)) == list(map(repr, ref))
+
+    # subtree weights need to stay correct through inserts, removes and bulk loading
+    class Weighted(PersistentSortedCollection):
+        _weigh = staticmethod(lambda item: int(item * 2))
+
+    for i in range(100):
+        items = [choice(pool) for n in range(20)]
+        per = Weighted.from_sorted(sorted(items[:10]))
+        for item in items[10:]:
+            per.insert(item)
+        for item in items[:5]:
+            per.remove(item)
+        before = per.copy()
+        per.update(list(per)[::4], [choice(pool) for n in range(3)])
+        for version in (before, per):
+            weights = [int(item * 2) for item in version]
+            for n in range(len(version) + 1):
+                assert version._prefix_weight(n) == sum(weights[:n])
+
+    import doctest
+    print(doctest.testmod())
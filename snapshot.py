@@ -0,0 +1,584 @@
+""" Offline access to config server data, without a running mongod.
+
+    open_config(path) returns a database-like object that ConfigParser and mconfcheck accept instead of
+    a pymongo database. path can be
+
+      - a mongodump directory, either the dump root (containing a `config` directory) or the `config`
+        directory itself, with one BSON file per collection (chunks.bson, changelog.bson, ...), or
+      - a snapshot file written by write_snapshot(), which stores the documents of each collection
+        grouped by namespace, followed by an index of these groups.
+
+    Files are memory-mapped and documents are only decoded when a query reads them. For dumps, the first
+    query on a collection scans its file once to index the document offsets by namespace, without decoding
+    the documents. Snapshot files already contain that index, so a query for
+    one namespace, or a list of them with $in, decodes exactly the documents of these namespaces.
+
+    The supported queries are the ones used on the config db: equality, $in, $nin, $ne, $gt, $gte, $lt,
+    $lte and $exists on (dotted) fields, and sort() in BSON order.
+"""
+
+import os
+import mmap
+import struct
+import heapq
+from array import array
+from itertools import islice
+
+import bson
+from bson.son import SON
+
+from key_encoding import encode_value
+
+try:
+    from bson.codec_options import CodecOptions
+    _DECODE_ARGS = (CodecOptions(document_class=SON),)
+except ImportError:
+    # pymongo 2.x: as_class, tz_aware
+    _DECODE_ARGS = (SON, False)
+
+
+SNAPSHOT_MAGIC = 'CFGSNAP\x01'
+
+# collections that write_snapshot() copies by default
+SNAPSHOT_COLLECTIONS = ('chunks', 'changelog', 'collections', 'databases', 'shards', 'settings', 'tags', 'version')
+
+ASCENDING = 1
+DESCENDING = -1
+
+_INT32 = struct.Struct('<i')
+_UINT64 = struct.Struct('<Q')
+
+def _decode(data):
+    return bson.decode_all(data, *_DECODE_ARGS)
+
+def _scan(buf, start, end):
+    """ yields the offsets of the BSON documents stored back to back in buf[start:end]. """
+    pos = start
+    while pos < end:
+        yield pos
+        pos += _INT32.unpack_from(buf, pos)[0]
+
+
+def _get_field(doc, path):
+    """ returns the values at the dotted path, descending into arrays like MongoDB does. """
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    found.extend(v[part] for v in value if isinstance(v, dict) and part in v)
+        values = found
+    return values
+
+def _candidates(values):
+    """ a field matches if one of its values matches, or for arrays one of their elements. """
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for element in value:
+                yield element
+
+def _compare(op, value, target):
+    # like MongoDB, range operators only match values of the same type as the target
+    a, b = encode_value(value), encode_value(target)
+    if a[0] != b[0]:
+        return False
+    return {'$gt': a > b, '$gte': a >= b, '$lt': a < b, '$lte': a <= b}[op]
+
+def _equal(value, target):
+    return encode_value(value) == encode_value(target)
+
+def _is_operator(condition):
+    return isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition)
+
+
+class _EncodedValues(object):
+    """ the targets of an $in or $nin condition, encoded once per query instead of once per document. """
+
+    def __init__(self, targets):
+        self.keys = frozenset( encode_value(t) for t in targets )
+        self.has_none = any( t is None for t in targets )
+
+    def match(self, values):
+        return any(encode_value(v) in self.keys for v in _candidates(values)) or (not values and self.has_none)
+
+
+def _compile(query):
+    """ returns a copy of query where the targets of $in and $nin conditions are encoded for match(). 
+        Lists with operator targets are kept as they are.
+    """
+    compiled = {}
+    for field, condition in query.iteritems():
+        if field in ('$and', '$or'):
+            condition = [ _compile(q) for q in condition ]
+        elif _is_operator(condition):
+            condition = dict(condition)
+            for op in ('$in', '$nin'):
+                if op in condition and not any(_is_operator(t) for t in condition[op]):
+                    condition[op] = _EncodedValues(condition[op])
+        compiled[field] = condition
+    return compiled
+
+
+def _match_condition(values, condition):
+    if not _is_operator(condition):
+        return any(_equal(v, condition) for v in _candidates(values)) or (not values and condition is None)
+
+    for op, target in condition.iteritems():
+        if op == '$in':
+            if isinstance(target, _EncodedValues):
+                ok = target.match(values)
+            else:
+                ok = any(_match_condition(values, t) for t in target)
+        elif op == '$nin':
+            if isinstance(target, _EncodedValues):
+                ok = not target.match(values)
+            else:
+                ok = not any(_match_condition(values, t) for t in target)
+        elif op == '$ne':
+            ok = not _match_condition(values, target)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            ok = any(_compare(op, v, target) for v in _candidates(values))
+        elif op == '$exists':
+            ok = bool(values) == bool(target)
+        else:
+            raise ValueError('Unsupported query operator %s.' % op)
+        if not ok:
+            return False
+    return True
+
+def _namespaces(query):
+    """ returns the namespaces a query is restricted to by its ns field (a string or an $in list of 
+        strings), or None if it isn't.
+    """
+    ns = query.get('ns')
+    if isinstance(ns, basestring):
+        return [ns]
+    if isinstance(ns, dict) and ns.keys() == ['$in'] and all(isinstance(t, basestring) for t in ns['$in']):
+        return sorted(set(ns['$in']))
+    return None
+
+
+def match(doc, query):
+    """ returns True if doc matches the query document, which can be compiled with _compile(). """
+    for field, condition in query.iteritems():
+        if field == '$and':
+            ok = all(match(doc, q) for q in condition)
+        elif field == '$or':
+            ok = any(match(doc, q) for q in condition)
+        else:
+            ok = _match_condition(_get_field(doc, field), condition)
+        if not ok:
+            return False
+    return True
+
+def _project(doc, fields):
+    if fields is None:
+        return doc
+    if isinstance(fields, dict):
+        fields = [ f for f, include in fields.iteritems() if include ]
+    return SON( (k, v) for k, v in doc.iteritems() if k == '_id' or k in fields )
+
+
+class SnapshotCursor(object):
+    """ lazy cursor over the matching documents of a query, with the parts of the pymongo cursor API
+        that ConfigParser uses: sort(), limit(), batch_size() and iteration.
+    """
+
+    def __init__(self, docs, groups=None):
+        self._docs = docs
+        # for queries restricted to namespaces, a function that returns the matching documents of each
+        # namespace in ascending ns order, so that a sort by ns first only sorts one namespace at a time
+        self._groups = groups
+        self._sort = None
+        self._limit = 0
+        self._iter = None
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        # documents are decoded one at a time anyway
+        return self
+
+    def _sorted(self, docs, sort):
+        docs = list(docs)
+        # stable sorts, least significant key first
+        for field, direction in reversed(sort):
+            docs.sort(key=lambda doc: encode_value((_get_field(doc, field) or [None])[0]), reverse=(direction == DESCENDING))
+        return docs
+
+    def _sorted_groups(self):
+        groups = self._groups()
+        if self._sort[0][1] == DESCENDING:
+            groups = reversed(list(groups))
+        for docs in groups:
+            for doc in self._sorted(docs, self._sort[1:]):
+                yield doc
+
+    def _results(self):
+        docs = self._docs
+        if self._sort and self._groups is not None and self._sort[0][0] == 'ns':
+            docs = self._sorted_groups()
+        elif self._sort:
+            docs = self._sorted(docs, self._sort)
+        if self._limit:
+            docs = islice(docs, self._limit)
+        return iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iter is None:
+            self._iter = self._results()
+        return next(self._iter)
+
+    def count(self, with_limit_and_skip=False):
+        return sum(1 for doc in self._results())
+
+
+class _SnapshotCollection(object):
+    """ base class of collections read from a memory-mapped file. Subclasses implement _offsets(namespaces). """
+
+    def __init__(self, name, buf):
+        self.name = name
+        self._buf = buf
+
+    def _decode_at(self, offset):
+        length = _INT32.unpack_from(self._buf, offset)[0]
+        return _decode(self._buf[offset : offset + length])[0]
+
+    def _decode_docs(self, namespaces):
+        for offset in self._offsets(namespaces):
+            yield self._decode_at(offset)
+
+    def _matching(self, compiled, namespaces):
+        for doc in self._decode_docs(namespaces):
+            if match(doc, compiled):
+                yield doc
+
+    def _docs(self, query):
+        # only the documents of the queried namespaces are decoded, and the query is compiled once for all
+        return self._matching(_compile(query), _namespaces(query))
+
+    def _namespace_docs(self, query, fields):
+        """ yields the matching documents of each namespace of the query, in ascending ns order. """
+        compiled = _compile(query)
+        for ns in sorted(_namespaces(query), key=encode_value):
+            docs = self._matching(compiled, [ns])
+            yield docs if fields is None else (_project(doc, fields) for doc in docs)
+
+    def find(self, spec=None, fields=None, projection=None, **kwargs):
+        fields = projection if projection is not None else fields
+        spec = spec or {}
+        docs = self._docs(spec)
+        if fields is not None:
+            docs = (_project(doc, fields) for doc in docs)
+        groups = (lambda: self._namespace_docs(spec, fields)) if _namespaces(spec) is not None else None
+        return SnapshotCursor(docs, groups)
+
+    def find_one(self, spec=None, **kwargs):
+        for doc in self.find(spec, **kwargs):
+            return doc
+        return None
+
+    def count(self):
+        return sum(1 for offset in self._offsets(None))
+
+    def distinct(self, field):
+        values = {}
+        for doc in self._docs({}):
+            for value in _candidates(_get_field(doc, field)):
+                values.setdefault(encode_value(value), value)
+        return [ values[k] for k in sorted(values) ]
+
+
+class DumpCollection(_SnapshotCollection):
+    """ collection backed by a mongodump BSON file. The offsets of the documents of each namespace are
+        indexed on first use.
+    """
+
+    def __init__(self, name, buf):
+        _SnapshotCollection.__init__(self, name, buf)
+        self._index = None
+
+    def _build_index(self):
+        # the ns field of config documents is a top-level string in front of all embedded documents, so the
+        # first string element named ns in a document is the one to index by
+        index = {}
+        buf = self._buf
+        find = buf.find
+        unpack_from = _INT32.unpack_from
+        for offset in _scan(buf, 0, len(buf)):
+            pos = find('\x02ns\x00', offset + 4, offset + unpack_from(buf, offset)[0])
+            if pos < 0:
+                ns = None
+            else:
+                length = unpack_from(buf, pos + 4)[0]
+                ns = buf[pos + 8 : pos + 7 + length]
+            offsets = index.get(ns)
+            if offsets is None:
+                offsets = index[ns] = array('L')
+            offsets.append(offset)
+
+        self._index = dict( (ns.decode('utf-8') if ns is not None else None, offsets) for ns, offsets in index.iteritems() )
+
+    def _raw_groups(self):
+        if self._index is None:
+            self._build_index()
+        for ns in sorted(self._index):
+            yield ns, ( self._buf[offset : offset + _INT32.unpack_from(self._buf, offset)[0]] for offset in self._index[ns] )
+
+    def _offsets(self, namespaces):
+        if namespaces is None:
+            return _scan(self._buf, 0, len(self._buf))
+        if self._index is None:
+            self._build_index()
+        offsets = [ self._index[ns] for ns in namespaces if ns in self._index ]
+        if len(offsets) == 1:
+            return offsets[0]
+        # the union of the namespaces, in file order
+        return heapq.merge(*offsets)
+
+
+class SnapshotFileCollection(_SnapshotCollection):
+    """ collection of a snapshot file, where the documents of each namespace are stored contiguously. """
+
+    def __init__(self, name, buf, groups):
+        _SnapshotCollection.__init__(self, name, buf)
+        # ns -> (offset, length)
+        self._groups = dict( (ns, (offset, length)) for ns, offset, length in groups )
+
+    def _groups_of(self, namespaces):
+        if namespaces is None:
+            return sorted(self._groups.values())
+        return sorted( self._groups[ns] for ns in namespaces if ns in self._groups )
+
+    def _offsets(self, namespaces):
+        for offset, length in self._groups_of(namespaces):
+            for pos in _scan(self._buf, offset, offset + length):
+                yield pos
+
+    def _raw_groups(self):
+        for ns, (offset, length) in sorted(self._groups.iteritems()):
+            yield ns, [ self._buf[offset : offset + length] ]
+
+    def _decode_docs(self, namespaces):
+        if namespaces is None:
+            for doc in _SnapshotCollection._decode_docs(self, None):
+                yield doc
+            return
+
+        # decode the whole group of each namespace at once
+        for offset, length in self._groups_of(namespaces):
+            for doc in _decode(self._buf[offset : offset + length]):
+                yield doc
+
+
+class SnapshotDatabase(object):
+    """ database-like object over snapshot or dump collections. Missing collections are empty. """
+
+    def __init__(self, name, collections, files=()):
+        self.name = name
+        self._collections = collections
+        self._files = list(files)
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            return DumpCollection(name, '')
+        return self._collections[name]
+
+    def collection_names(self):
+        return sorted(self._collections)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+    def __repr__(self):
+        return 'SnapshotDatabase( %s, collections=%s )' % (self.name, ', '.join(self.collection_names()))
+
+
+def _map(path):
+    f = open(path, 'rb')
+    if os.path.getsize(path) == 0:
+        return f, ''
+    return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_dump(path):
+    """ opens a mongodump directory, either the dump root or its `config` directory. """
+    if os.path.isdir(os.path.join(path, 'config')):
+        path = os.path.join(path, 'config')
+
+    collections = {}
+    files = []
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith('.bson'):
+            f, buf = _map(os.path.join(path, filename))
+            files.append(f)
+            name = filename[:-len('.bson')]
+            collections[name] = DumpCollection(name, buf)
+
+    return SnapshotDatabase(path, collections, files)
+
+
+def open_snapshot(path):
+    """ opens a snapshot file written by write_snapshot(). """
+    f, buf = _map(path)
+    if buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or buf[-len(SNAPSHOT_MAGIC):] != SNAPSHOT_MAGIC:
+        f.close()
+        raise ValueError('%s is not a config snapshot file.' % path)
+
+    index_offset = _UINT64.unpack_from(buf, len(buf) - len(SNAPSHOT_MAGIC) - 8)[0]
+    index = _decode(buf[index_offset : len(buf) - len(SNAPSHOT_MAGIC) - 8])[0]
+
+    collections = {}
+    for name, groups in index['collections'].iteritems():
+        collections[name] = SnapshotFileCollection(name, buf, groups)
+    return SnapshotDatabase(path, collections, [f])
+
+
+def open_config(path):
+    """ opens a mongodump directory or a snapshot file, whichever path is. """
+    if os.path.isdir(path):
+        return open_dump(path)
+    return open_snapshot(path)
+
+
+def _raw_groups(collection):
+    """ yields (ns, encoded documents) for each namespace of the collection. Dumps and snapshots are 
+        copied without decoding, other sources are queried one namespace at a time.
+    """
+    if isinstance(collection, _SnapshotCollection):
+        for group in collection._raw_groups():
+            yield group
+        return
+
+    namespaces = [ ns for ns in collection.distinct('ns') if isinstance(ns, basestring) ]
+    queries = [ (ns, {'ns': ns}) for ns in namespaces ] + [ (None, {'ns': {'$exists': False}}) ]
+    for ns, query in queries:
+        yield ns, ( bson.BSON.encode(doc) for doc in collection.find(query) )
+
+
+def write_snapshot(config_db, path, collections=SNAPSHOT_COLLECTIONS):
+    """ writes the given collections of config_db (a pymongo database, or a dump opened with open_dump())
+        to a snapshot file. Documents are grouped by namespace, one namespace at a time is read from
+        config_db.
+    """
+    index = SON()
+    with open(path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        offset = len(SNAPSHOT_MAGIC)
+
+        for name in collections:
+            groups = []
+            for ns, raw_docs in _raw_groups(config_db[name]):
+                length = 0
+                for data in raw_docs:
+                    f.write(data)
+                    length += len(data)
+                if length:
+                    groups.append([ns, offset, length])
+                    offset += length
+            if groups:
+                index[name] = groups
+
+        f.write(bson.BSON.encode({'collections': index}))
+        f.write(_UINT64.pack(offset))
+        f.write(SNAPSHOT_MAGIC)
+
+
+if __name__ == '__main__':
+
+    from config_parser import ConfigParser
+    from fake_cluster import FakeCluster
+    from datetime import timedelta
+    import shutil
+    import tempfile
+
+    cluster = FakeCluster(seed=4)
+    namespaces = [ 'mydb.coll%i' % i for i in range(5) ]
+    for namespace in namespaces:
+        cluster.shard_collection(namespace)
+    for k in range(10):
+        for namespace in namespaces[k % 2::2]:
+            cluster.random_changes(namespace, 3)
+    cluster.move(namespaces[0], abort=True)
+    cluster.drop(namespaces[4])
+    fake_db = cluster.config_db
+
+    directory = tempfile.mkdtemp()
+    try:
+        # a mongodump directory with one BSON file per collection, and snapshots of it and of the fake db
+        os.makedirs(os.path.join(directory, 'dump', 'config'))
+        for name in fake_db.collection_names():
+            with open(os.path.join(directory, 'dump', 'config', name + '.bson'), 'wb') as f:
+                for doc in fake_db[name].docs:
+                    f.write(bson.BSON.encode(doc))
+
+        dump = open_config(os.path.join(directory, 'dump'))
+        write_snapshot(fake_db, os.path.join(directory, 'fake.snapshot'))
+        write_snapshot(dump, os.path.join(directory, 'dump.snapshot'))
+        databases = [ dump, open_config(os.path.join(directory, 'fake.snapshot')), open_config(os.path.join(directory, 'dump.snapshot')) ]
+
+        # queries, compared with the documents of the fake db filtered in Python
+        changelog = fake_db['changelog'].docs
+        middle = changelog[len(changelog) // 2]['time']
+        queries = [ ('changelog', {'ns': namespaces[1]}, lambda doc: doc['ns'] == namespaces[1]),
+                    ('changelog', {'ns': {'$in': namespaces[2:4] + ['other.ns']}}, lambda doc: doc['ns'] in namespaces[2:4]),
+                    ('changelog', {'ns': {'$nin': namespaces[:2]}}, lambda doc: doc['ns'] not in namespaces[:2]),
+                    ('changelog', {'ns': namespaces[0], 'what': {'$in': ['split', 'multi-split']}, 'time': {'$gt': middle}},
+                     lambda doc: doc['ns'] == namespaces[0] and doc['what'] in ('split', 'multi-split') and doc['time'] > middle),
+                    ('changelog', {'time': {'$gte': middle, '$lt': middle + timedelta(seconds=30)}}, lambda doc: middle <= doc['time'] < middle + timedelta(seconds=30)),
+                    ('changelog', {'details.note': {'$exists': True}}, lambda doc: 'note' in doc['details']),
+                    ('changelog', {'details.note': 'aborted'}, lambda doc: doc['details'].get('note') == 'aborted'),
+                    ('collections', {'dropped': {'$ne': True}}, lambda doc: not doc['dropped']),
+                    ('chunks', {'ns': namespaces[2], 'shard': 'shard0001'}, lambda doc: doc['ns'] == namespaces[2] and doc['shard'] == 'shard0001'),
+                    ('chunks', {}, lambda doc: True) ]
+
+        for db in databases:
+            for name, query, predicate in queries:
+                expected = [ doc['_id'] for doc in fake_db[name].docs if predicate(doc) ]
+                assert sorted(doc['_id'] for doc in db[name].find(query)) == sorted(expected), (db, name, query)
+                assert db[name].find(query).count() == len(expected)
+
+            newest = [ doc['_id'] for doc in sorted(changelog, key=lambda doc: doc['time'], reverse=True) if doc['ns'] == namespaces[3] ]
+            assert [ doc['_id'] for doc in db['changelog'].find({'ns': namespaces[3]}).sort([('time', DESCENDING)]) ] == newest
+            assert db['changelog'].find({'ns': namespaces[3]}).sort([('time', DESCENDING)]).limit(5).count() == 5
+            assert db['chunks'].distinct('ns') == fake_db['chunks'].distinct('ns')
+            assert db['missing'].find_one({}) is None
+
+        # the walks over each database equal the walks over the fake db
+        def chunks(walk):
+            return [ (chunk_dist.time, [ (chunk.min, chunk.max, chunk.shard) for chunk in chunk_dist ]) for chunk_dist in walk ]
+
+        cfg_parser = ConfigParser(fake_db)
+        walks = dict( (namespace, chunks(cfg_parser.walk_distributions(namespace))) for namespace in namespaces[:4] )
+        for db in databases:
+            parser = ConfigParser(db)
+            assert sorted(parser.sharded_namespaces()) == namespaces[:4]
+            for namespace in namespaces[:4]:
+                assert chunks(parser.walk_distributions(namespace)) == walks[namespace]
+                assert chunks(parser.walk_distributions(namespace, stream=True, lookahead=20)) == walks[namespace]
+            assert dict( (namespace, chunks(walk)) for namespace, walk in parser.walk_all_distributions(namespaces[:4]) ) == walks
+
+        for db in databases:
+            db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    print 'ok'
@@ -1,4 +1,5 @@
 from bisect import bisect_left, bisect_right
+from itertools import islice, chain
 
 class SortedCollection(object):
     '''Sequence sorted by a key function.
@@ -22,7 +23,10 @@ class SortedCollection(object):
     checking, item counts, item removal, and a nice looking repr.
 
     Finding and indexing are O(log n) operations while iteration and insertion
-    are O(n).  The initial sort is O(n log n).
+    are O(n).  The initial sort is O(n log n).  Input that is already sorted
+    can be loaded in O(n) with from_sorted(), and update() removes and inserts
+    k items in a single O(n + k log n) pass.  BlockedSortedCollection has the
+    same API with sub-linear insertion and removal, for large collections.
 
     The key function is stored in the 'key' attibute for easy introspection or
     so that you can assign a new key function (triggering an automatic re-sort).
@@ -77,6 +81,17 @@ class SortedCollection(object):
         self._items = [item for k, item in decorated]
         self._key = key
 
+    @classmethod
+    def from_sorted(cls, iterable, key=None):
+        'Create a collection from items already sorted by key.  Raise ValueError if they are not sorted'
+        coll = cls(key=key)
+        items = list(iterable)
+        keys = [coll._key(item) for item in items]
+        _check_sorted(keys)
+        coll._keys = keys
+        coll._items = items
+        return coll
+
     def _getkey(self):
         return self._key
 
@@ -157,6 +172,45 @@ class SortedCollection(object):
         del self._keys[i]
         del self._items[i]
 
+    def update(self, remove=(), insert=()):
+        '''Remove and insert several items in a single pass over the sequence.
+        Same result as calling remove() and insert() for each item, but the
+        lists are only rebuilt once.  Raise ValueError if an item to remove is
+        not found, in which case the collection is unchanged.'''
+        drop = set()
+        for item in remove:
+            k = self._key(item)
+            i = bisect_left(self._keys, k)
+            j = bisect_right(self._keys, k)
+            for p in range(i, j):
+                if p not in drop and self._items[p] == item:
+                    drop.add(p)
+                    break
+            else:
+                raise ValueError('No item found to remove: %r' % (item,))
+
+        # new items sorted by key, with their position in the old sequence. Items with equal keys
+        # end up in reverse order, like after repeated insert() calls.
+        decorated = sorted(((self._key(item), item) for item in reversed(list(insert))), key=lambda d: d[0])
+        positions = [bisect_left(self._keys, k) for k, item in decorated]
+
+        keys, items = [], []
+        start = 0
+        d = 0
+        for cut in sorted(drop.union(positions)):
+            keys.extend(self._keys[start:cut])
+            items.extend(self._items[start:cut])
+            while d < len(decorated) and positions[d] == cut:
+                keys.append(decorated[d][0])
+                items.append(decorated[d][1])
+                d += 1
+            start = cut + 1 if cut in drop else cut
+        keys.extend(self._keys[start:])
+        items.extend(self._items[start:])
+
+        self._keys = keys
+        self._items = items
+
     def find(self, k):
         'Return first item with a key == k.  Raise ValueError if not found.'
         i = bisect_left(self._keys, k)
@@ -193,6 +247,264 @@ class SortedCollection(object):
         raise ValueError('No item found with key above: %r' % (k,))
 
 
+def _check_sorted(keys):
+    'Raise ValueError if keys are not in ascending order'
+    for i in range(1, len(keys)):
+        if keys[i] < keys[i-1]:
+            raise ValueError('Items are not sorted, key %r follows %r' % (keys[i], keys[i-1]))
+
+
+class BlockedSortedCollection(SortedCollection):
+    '''SortedCollection backed by a list of bounded sorted sublists.
+
+    The API is identical to SortedCollection. Keys and items are stored in blocks
+    of at most 2 * load entries.  A list with the last key of each block and a list
+    with the position of each block's first item form the index over the blocks:
+    a bisect on the block maxima finds the block for a key, a bisect on the block
+    positions finds the block for an index.
+
+    insert() and remove() only shift the entries of a single block and update the
+    positions of the blocks after it, which is O(load + n / load) instead of O(n).
+    Finding and indexing are O(log n), iteration is O(n).
+
+    >>> s = BlockedSortedCollection(range(10), key=lambda x: -x)
+    >>> s.insert(4.5)
+    >>> s.remove(7)
+    >>> s[:4], s.find_ge(-5), s.index(4.5)
+    ([9, 8, 6, 5], 5, 4)
+
+    '''
+
+    load = 1000
+
+    def __init__(self, iterable=(), key=None):
+        self._given_key = key
+        key = (lambda x: x) if key is None else key
+        decorated = sorted((key(item), item) for item in iterable)
+        self._key = key
+        self._load_blocks([k for k, item in decorated], [item for k, item in decorated])
+
+    @classmethod
+    def from_sorted(cls, iterable, key=None):
+        'Create a collection from items already sorted by key.  Raise ValueError if they are not sorted'
+        coll = cls(key=key)
+        items = list(iterable)
+        keys = [coll._key(item) for item in items]
+        _check_sorted(keys)
+        coll._load_blocks(keys, items)
+        return coll
+
+    def _load_blocks(self, keys, items):
+        load = self.load
+        self._key_blocks = [keys[i:i+load] for i in range(0, len(keys), load)]
+        self._item_blocks = [items[i:i+load] for i in range(0, len(items), load)]
+        self._maxes = [block[-1] for block in self._key_blocks]
+        self._reindex()
+
+    def _reindex(self, b=0):
+        'Recompute the positions of all blocks from block b onwards'
+        positions = self._positions = self._positions[:b] if b else []
+        pos = positions[-1] + len(self._key_blocks[b-1]) if b else 0
+        for block in self._key_blocks[b:]:
+            positions.append(pos)
+            pos += len(block)
+        self._len = pos
+
+    def _setkey(self, key):
+        if key is not self._key:
+            self.__init__(list(self), key=key)
+
+    key = property(SortedCollection._getkey, _setkey, SortedCollection._delkey, 'key function')
+
+    @property
+    def _keys(self):
+        return [k for block in self._key_blocks for k in block]
+
+    @property
+    def _items(self):
+        return [item for block in self._item_blocks for item in block]
+
+    def clear(self):
+        self._load_blocks([], [])
+
+    def copy(self):
+        other = self.__class__(key=self._given_key)
+        other._key = self._key
+        other._load_blocks(self._keys, self._items)
+        return other
+
+    def __len__(self):
+        return self._len
+
+    def _locate(self, i):
+        'Return (block, offset) of position i'
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('list index out of range')
+        b = bisect_right(self._positions, i) - 1
+        return b, i - self._positions[b]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step > 0:
+                return list(islice(self._iter_from(start), 0, max(0, stop - start), step))
+            return list(self)[i]
+        b, j = self._locate(i)
+        return self._item_blocks[b][j]
+
+    def _iter_from(self, start):
+        if start >= len(self):
+            return iter(())
+        b, j = self._locate(start)
+        return chain(islice(self._item_blocks[b], j, None), *self._item_blocks[b+1:])
+
+    def __iter__(self):
+        return chain(*self._item_blocks)
+
+    def __reversed__(self):
+        return (item for block in reversed(self._item_blocks) for item in reversed(block))
+
+    def __repr__(self):
+        return '%s(%r, key=%s)' % (
+            self.__class__.__name__,
+            list(self),
+            getattr(self._given_key, '__name__', repr(self._given_key))
+        )
+
+    def __reduce__(self):
+        return self.__class__, (list(self), self._given_key)
+
+    def _bisect_left(self, k):
+        b = bisect_left(self._maxes, k)
+        if b == len(self._maxes):
+            return len(self)
+        return self._positions[b] + bisect_left(self._key_blocks[b], k)
+
+    def _bisect_right(self, k):
+        b = bisect_right(self._maxes, k)
+        if b == len(self._maxes):
+            return len(self)
+        return self._positions[b] + bisect_right(self._key_blocks[b], k)
+
+    def _equal_range(self, item):
+        k = self._key(item)
+        i = self._bisect_left(k)
+        j = self._bisect_right(k)
+        return i, list(islice(self._iter_from(i), j - i))
+
+    def __contains__(self, item):
+        return item in self._equal_range(item)[1]
+
+    def index(self, item):
+        'Find the position of an item.  Raise ValueError if not found.'
+        i, items = self._equal_range(item)
+        return items.index(item) + i
+
+    def count(self, item):
+        'Return number of occurrences of item'
+        return self._equal_range(item)[1].count(item)
+
+    def _insert(self, k, item, bisect_block, bisect_key):
+        if not self._maxes:
+            self._load_blocks([k], [item])
+            return
+        b = min(bisect_block(self._maxes, k), len(self._maxes) - 1)
+        keys, items = self._key_blocks[b], self._item_blocks[b]
+        j = bisect_key(keys, k)
+        keys.insert(j, k)
+        items.insert(j, item)
+        self._maxes[b] = keys[-1]
+
+        if len(keys) > 2 * self.load:
+            # split the block in halves
+            half = len(keys) // 2
+            self._key_blocks[b+1:b+1] = [keys[half:]]
+            self._item_blocks[b+1:b+1] = [items[half:]]
+            del keys[half:], items[half:]
+            self._maxes[b:b+1] = [keys[-1], self._key_blocks[b+1][-1]]
+        self._reindex(b)
+
+    def insert(self, item):
+        'Insert a new item.  If equal keys are found, add to the left'
+        self._insert(self._key(item), item, bisect_left, bisect_left)
+
+    def insert_right(self, item):
+        'Insert a new item.  If equal keys are found, add to the right'
+        self._insert(self._key(item), item, bisect_right, bisect_right)
+
+    def _delete(self, i):
+        b, j = self._locate(i)
+        keys, items = self._key_blocks[b], self._item_blocks[b]
+        del keys[j], items[j]
+        if keys:
+            self._maxes[b] = keys[-1]
+        else:
+            del self._key_blocks[b], self._item_blocks[b], self._maxes[b]
+        self._reindex(b)
+
+    def remove(self, item):
+        'Remove first occurence of item.  Raise ValueError if not found'
+        self._delete(self.index(item))
+
+    def update(self, remove=(), insert=()):
+        '''Remove and insert several items, O(log n) block lookups each.  Raise ValueError
+        if an item to remove is not found, in which case the collection is unchanged.'''
+        # find all positions first, so that nothing is changed if an item is missing
+        drop = set()
+        for item in remove:
+            i, items = self._equal_range(item)
+            for j, other in enumerate(items):
+                if i + j not in drop and other == item:
+                    drop.add(i + j)
+                    break
+            else:
+                raise ValueError('No item found to remove: %r' % (item,))
+        for i in sorted(drop, reverse=True):
+            self._delete(i)
+        for item in insert:
+            self.insert(item)
+
+    def find(self, k):
+        'Return first item with a key == k.  Raise ValueError if not found.'
+        i = self._bisect_left(k)
+        if i != len(self):
+            b, j = self._locate(i)
+            if self._key_blocks[b][j] == k:
+                return self._item_blocks[b][j]
+        raise ValueError('No item found with key equal to: %r' % (k,))
+
+    def find_le(self, k):
+        'Return last item with a key <= k.  Raise ValueError if not found.'
+        i = self._bisect_right(k)
+        if i:
+            return self[i-1]
+        raise ValueError('No item found with key at or below: %r' % (k,))
+
+    def find_lt(self, k):
+        'Return last item with a key < k.  Raise ValueError if not found.'
+        i = self._bisect_left(k)
+        if i:
+            return self[i-1]
+        raise ValueError('No item found with key below: %r' % (k,))
+
+    def find_ge(self, k):
+        'Return first item with a key >= equal to k.  Raise ValueError if not found'
+        i = self._bisect_left(k)
+        if i != len(self):
+            return self[i]
+        raise ValueError('No item found with key at or above: %r' % (k,))
+
+    def find_gt(self, k):
+        'Return first item with a key > k.  Raise ValueError if not found'
+        i = self._bisect_right(k)
+        if i != len(self):
+            return self[i]
+        raise ValueError('No item found with key above: %r' % (k,))
+
+
 # ---------------------------  Simple demo and tests  -------------------------
 if __name__ == '__main__':
 
@@ -245,67 +557,113 @@ if __name__ == '__main__':
                 return item
         return -1
 
-    from random import choice
-    pool = [1.5, 2, 2.0, 3, 3.0, 3.5, 4, 4.0, 4.5]
-    for i in range(500):
-        for n in range(6):
-            s = [choice(pool) for i in range(n)]
-            sc = SortedCollection(s)
-            s.sort()
-            for probe in pool:
-                assert repr(ve2no(sc.index, probe)) == repr(slow_index(s, probe))
-                assert repr(ve2no(sc.find, probe)) == repr(slow_find(s, probe))
-                assert repr(ve2no(sc.find_le, probe)) == repr(slow_find_le(s, probe))
-                assert repr(ve2no(sc.find_lt, probe)) == repr(slow_find_lt(s, probe))
-                assert repr(ve2no(sc.find_ge, probe)) == repr(slow_find_ge(s, probe))
-                assert repr(ve2no(sc.find_gt, probe)) == repr(slow_find_gt(s, probe))
-            for i, item in enumerate(s):
-                assert repr(item) == repr(sc[i])        # test __getitem__
-                assert item in sc                       # test __contains__ and __iter__
-                assert s.count(item) == sc.count(item)  # test count()
-            assert len(sc) == n                         # test __len__
-            assert list(map(repr, reversed(sc))) == list(map(repr, reversed(s)))    # test __reversed__
-            assert list(sc.copy()) == list(sc)          # test copy()
-            sc.clear()                                  # test clear()
-            assert len(sc) == 0
-
-    sd = SortedCollection('The quick Brown Fox jumped'.split(), key=str.lower)
-    assert sd._keys == ['brown', 'fox', 'jumped', 'quick', 'the']
-    assert sd._items == ['Brown', 'Fox', 'jumped', 'quick', 'The']
-    assert sd._key == str.lower
-    assert repr(sd) == "SortedCollection(['Brown', 'Fox', 'jumped', 'quick', 'The'], key=lower)"
-    sd.key = str.upper
-    assert sd._key == str.upper
-    assert len(sd) == 5
-    assert list(reversed(sd)) == ['The', 'quick', 'jumped', 'Fox', 'Brown']
-    for item in sd:
-        assert item in sd
-    for i, item in enumerate(sd):
-        assert item == sd[i]
-    sd.insert('jUmPeD')
-    sd.insert_right('QuIcK')
-    assert sd._keys ==['BROWN', 'FOX', 'JUMPED', 'JUMPED', 'QUICK', 'QUICK', 'THE']
-    assert sd._items == ['Brown', 'Fox', 'jUmPeD', 'jumped', 'quick', 'QuIcK', 'The']
-    assert sd.find_le('JUMPED') == 'jumped', sd.find_le('JUMPED')
-    assert sd.find_ge('JUMPED') == 'jUmPeD'
-    assert sd.find_le('GOAT') == 'Fox'
-    assert sd.find_ge('GOAT') == 'jUmPeD'
-    assert sd.find('FOX') == 'Fox'
-    assert sd[3] == 'jumped'
-    assert sd[3:5] ==['jumped', 'quick']
-    assert sd[-2] == 'QuIcK'
-    assert sd[-4:-2] == ['jumped', 'quick']
-    for i, item in enumerate(sd):
-        assert sd.index(item) == i
-    try:
-        sd.index('xyzpdq')
-    except ValueError:
-        pass
-    else:
-        assert 0, 'Oops, failed to notify of missing value'
-    sd.remove('jumped')
-    assert list(sd) == ['Brown', 'Fox', 'jUmPeD', 'quick', 'QuIcK', 'The']
+    from random import choice, sample
+
+    def test_backend(SortedCollection):
+        'Run the tests against SortedCollection or one of its subclasses'
+        pool = [1.5, 2, 2.0, 3, 3.0, 3.5, 4, 4.0, 4.5]
+        for i in range(500):
+            for n in range(6):
+                s = [choice(pool) for i in range(n)]
+                sc = SortedCollection(s)
+                s.sort()
+                for probe in pool:
+                    assert repr(ve2no(sc.index, probe)) == repr(slow_index(s, probe))
+                    assert repr(ve2no(sc.find, probe)) == repr(slow_find(s, probe))
+                    assert repr(ve2no(sc.find_le, probe)) == repr(slow_find_le(s, probe))
+                    assert repr(ve2no(sc.find_lt, probe)) == repr(slow_find_lt(s, probe))
+                    assert repr(ve2no(sc.find_ge, probe)) == repr(slow_find_ge(s, probe))
+                    assert repr(ve2no(sc.find_gt, probe)) == repr(slow_find_gt(s, probe))
+                for i, item in enumerate(s):
+                    assert repr(item) == repr(sc[i])        # test __getitem__
+                    assert item in sc                       # test __contains__ and __iter__
+                    assert s.count(item) == sc.count(item)  # test count()
+                assert len(sc) == n                         # test __len__
+                assert list(map(repr, reversed(sc))) == list(map(repr, reversed(s)))    # test __reversed__
+                assert list(sc.copy()) == list(sc)          # test copy()
+                sc.clear()                                  # test clear()
+                assert len(sc) == 0
+
+        for i in range(500):
+            for n in range(8):
+                s = [choice(pool) for i in range(n)]
+                sc = SortedCollection(s)
+                su = SortedCollection.from_sorted(sorted(s))   # test from_sorted()
+                assert list(map(repr, su)) == list(map(repr, sc))
+                remove = [sc[p] for p in sample(range(n), choice(range(n + 1)))]
+                insert = [choice(pool) for i in range(choice(range(4)))]
+                for item in remove:
+                    sc.remove(item)
+                for item in insert:
+                    sc.insert(item)
+                su.update(remove, insert)                      # test update()
+                assert list(map(repr, su)) == list(map(repr, sc))
+                assert su._keys == sc._keys
+        try:
+            SortedCollection.from_sorted([2, 1])
+        except ValueError:
+            pass
+        else:
+            assert 0, 'Oops, failed to notify of unsorted input'
+        try:
+            sc = SortedCollection([1, 2, 3])
+            sc.update([2, 4], [5])
+        except ValueError:
+            assert list(sc) == [1, 2, 3]
+        else:
+            assert 0, 'Oops, failed to notify of missing value'
+
+        sd = SortedCollection('The quick Brown Fox jumped'.split(), key=str.lower)
+        assert sd._keys == ['brown', 'fox', 'jumped', 'quick', 'the']
+        assert sd._items == ['Brown', 'Fox', 'jumped', 'quick', 'The']
+        assert sd._key == str.lower
+        assert repr(sd) == "%s(['Brown', 'Fox', 'jumped', 'quick', 'The'], key=lower)" % SortedCollection.__name__
+        sd.key = str.upper
+        assert sd._key == str.upper
+        assert len(sd) == 5
+        assert list(reversed(sd)) == ['The', 'quick', 'jumped', 'Fox', 'Brown']
+        for item in sd:
+            assert item in sd
+        for i, item in enumerate(sd):
+            assert item == sd[i]
+        sd.insert('jUmPeD')
+        sd.insert_right('QuIcK')
+        assert sd._keys ==['BROWN', 'FOX', 'JUMPED', 'JUMPED', 'QUICK', 'QUICK', 'THE']
+        assert sd._items == ['Brown', 'Fox', 'jUmPeD', 'jumped', 'quick', 'QuIcK', 'The']
+        assert sd.find_le('JUMPED') == 'jumped', sd.find_le('JUMPED')
+        assert sd.find_ge('JUMPED') == 'jUmPeD'
+        assert sd.find_le('GOAT') == 'Fox'
+        assert sd.find_ge('GOAT') == 'jUmPeD'
+        assert sd.find('FOX') == 'Fox'
+        assert sd[3] == 'jumped'
+        assert sd[3:5] ==['jumped', 'quick']
+        assert sd[-2] == 'QuIcK'
+        assert sd[-4:-2] == ['jumped', 'quick']
+        for i, item in enumerate(sd):
+            assert sd.index(item) == i
+        try:
+            sd.index('xyzpdq')
+        except ValueError:
+            pass
+        else:
+            assert 0, 'Oops, failed to notify of missing value'
+        sd.remove('jumped')
+        assert list(sd) == ['Brown', 'Fox', 'jUmPeD', 'quick', 'QuIcK', 'The']
+
+    class SmallBlocks(BlockedSortedCollection):
+        'Tiny blocks, so that the tests split and drop blocks'
+        load = 2
+
+    for backend in (SortedCollection, BlockedSortedCollection, SmallBlocks):
+        test_backend(backend)
 
     import doctest
     from operator import itemgetter
-    print(doctest.testmod())
\ No newline at end of file
+    print(doctest.testmod())
+
+    # the SortedCollection examples have to give the same results with the blocked backend
+    for backend in (BlockedSortedCollection, SmallBlocks):
+        runner = doctest.DocTestRunner()
+        for test in doctest.DocTestFinder().find(SortedCollection, globs={'SortedCollection': backend}):
+            runner.run(test)
+        print(runner.summarize(verbose=False))
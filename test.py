@@ -17,6 +17,11 @@ mc = MongoClient(port=27017)
 # specify the config database ( here I imported all 3 config servers to 1 mongod, hence config[1,2,3] )
 config_db = mc['config']
 
+# alternatively, read a mongodump directory or a snapshot file directly, without a mongod
+# from snapshot import open_config, write_snapshot
+# config_db = open_config('dump/')
+# write_snapshot(config_db, 'config.snapshot')
+
 # create config parser object with the config_db as parameter
 cfg_parser = ConfigParser(config_db)
 
@@ -38,13 +43,63 @@ namespace = "attribute.attribute"
 for chunk_dist in cfg_parser.walk_distributions(namespace):
     print chunk_dist.applied_change['what'] if chunk_dist.applied_change else '-', chunk_dist.time, len(chunk_dist), chunk_dist.max_shard_version()
 
+# number of chunks per shard after each change, for all sharded collections, without keeping the distributions
+# series = cfg_parser.chunk_count_series()
+# print series[namespace], series[namespace].at(parser.parse("2013-11-24 16:13"))
+# for shard in series[namespace].shard_names:
+#     print shard, series[namespace].drain_start(shard)
+
+# walk all sharded collections, config.chunks and config.changelog are only read once
+# for ns, walk in cfg_parser.walk_all_distributions():
+#     print ns, sum(1 for chunk_dist in walk)
+
+# trace a chunk through its splits and migrations
+# lineage = cfg_parser.build_lineage(namespace)
+# chunk = cfg_parser.get_chunk_distribution(namespace)[0]
+# print lineage.ancestors(lineage.find(chunk.range))
+# print lineage.migration_path(chunk.range)
+
 # now build full history of ChunkDistribution objects over time (slow, expensive)
 history = cfg_parser.build_full_history(namespace)
 print history
 
+# for long histories, only store a full checkpoint every 100 steps and the deltas in between
+# history = cfg_parser.build_full_history(namespace, checkpoint_interval=100)
+
+# or keep the history on disk, later runs then only process the changelog entries added since
+# from history_cache import HistoryCache
+# history = HistoryCache('history_cache/').get(cfg_parser, namespace)
+
+# replay the changelog forwards from the initial chunk, the result must match config.chunks
+# for chunk_dist in cfg_parser.replay_distributions(namespace):
+#     print chunk_dist.time, len(chunk_dist)
+# print cfg_parser.check_replay(namespace)
+
+# or replay from the distribution of an older snapshot file
+# old_parser = ConfigParser(open_config('old.cfgsnap'))
+# start = old_parser.get_chunk_distribution(namespace)
+# start.time = old_parser.last_change_time(namespace)
+# print cfg_parser.check_replay(namespace, start)
+
+# keep the current distributions in memory and update them from new changelog entries
+# from watch import DistributionWatcher
+# watcher = DistributionWatcher(cfg_parser.config_db, [namespace])
+# print watcher.poll(), watcher.stats(namespace), watcher.migration_rate(namespace)
+
 # find the distribution as it was at a specific date and time, use SortedCollection's "find less than or equal": find_le()
 # t = "2013-11-24 16:13"
 # chunk_dist = history.find_le(parser.parse(t))
 # print "last change was a %s at %s" % (chunk_dist.what, chunk_dist.time)
 # print chunk_dist
 
+# the distribution at a time, all changes within a time window, and one distribution per hour
+# from datetime import timedelta
+# chunk_dist = history.at(parser.parse(t))
+# for chunk_dist in history.window(parser.parse("2013-11-24 16:00"), parser.parse("2013-11-24 17:00")):
+#     print chunk_dist.time, chunk_dist.what
+# for t, chunk_dist in history.sample(timedelta(hours=1)):
+#     print t, len(chunk_dist)
+
+# find out which shard owned a document at that time, and which chunks covered a range of shard keys
+# print chunk_dist.route({'_id': 12345}).shard
+# print chunk_dist.overlapping({'_id': 10000}, {'_id': 20000})
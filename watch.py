@@ -0,0 +1,312 @@
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.uri_parser import parse_uri
+
+from chunk_distribution import PersistentChunkDistribution
+from config_parser import ConfigParser
+from snapshot import open_config
+
+from collections import Counter, deque
+from datetime import timedelta
+
+import os
+import time
+
+from mtools.util.cmdlinetool import BaseCmdLineTool
+
+
+class DistributionWatcher(object):
+    """ Keeps the current ChunkDistribution of sharded namespaces in memory and updates it from the
+        config.changelog collection. Each poll() only reads the changelog entries newer than the high-water
+        mark (the time of the newest entry seen so far) and applies them forwards with
+        ConfigParser.apply_change(). A namespace is only read from config.chunks again (resynced) when a
+        change doesn't fit its distribution, or when it was sharded again or dropped.
+
+        The number of chunks per shard is updated with each change, and migrations are counted per shard
+        over the last `window` of changelog time. `config_db` can be any config database, e.g. a pymongo
+        Database or a snapshot opened with snapshot.open_config(). Without `namespaces`, all sharded
+        collections are watched, including ones sharded later.
+    """
+
+    # changelog entries that change the chunks of a namespace
+    changes = ['split', 'multi-split', 'moveChunk.commit']
+
+    # changelog entries after which a namespace needs to be read from config.chunks again
+    resync_changes = ['shardCollection', 'shardCollection.end', 'dropCollection']
+
+    def __init__(self, config_db, namespaces=None, window=timedelta(minutes=10), distribution_class=PersistentChunkDistribution):
+        self.config_db = config_db
+        self.config_parser = ConfigParser(config_db)
+        self.namespaces = namespaces
+        self.window = window
+        self.distribution_class = distribution_class
+
+        self.distributions = {}
+        self.chunk_counts = {}
+        self.resyncs = Counter()
+
+        # committed migrations per namespace within the window, as (time, from shard, to shard)
+        self.migrations = {}
+
+        # documents of multi-splits that are not complete yet, per (namespace, _multi_split_key())
+        self._multi_splits = {}
+
+        # the high-water mark and the _ids of the entries with exactly that time, which were already applied
+        self.high_water = None
+        self._seen = set()
+        for chl in self.config_db['changelog'].find().sort([('time', DESCENDING)]).limit(1):
+            self.high_water = chl['time']
+            self._seen = set( doc['_id'] for doc in self.config_db['changelog'].find({'time': self.high_water}) )
+
+        if namespaces is None:
+            namespaces = self.config_parser.sharded_namespaces()
+        for namespace in namespaces:
+            self.resync(namespace)
+
+        # start with the migrations that are already within the window
+        if self.high_water is not None:
+            query = {'what': 'moveChunk.commit', 'time': {'$gt': self.high_water - window}}
+            for chl in self.config_db['changelog'].find(query).sort([('time', ASCENDING)]):
+                if chl['ns'] in self.migrations:
+                    self.migrations[chl['ns']].append( (chl['time'], chl['details']['from'], chl['details']['to']) )
+
+
+    def resync(self, namespace):
+        """ reads the distribution of namespace from config.chunks. Namespaces without chunks (e.g. dropped
+            collections) are not kept.
+        """
+        chunk_dist = self.config_parser.get_chunk_distribution(namespace, self.distribution_class)
+
+        if not len(chunk_dist):
+            self.distributions.pop(namespace, None)
+            self.chunk_counts.pop(namespace, None)
+            return
+
+        if namespace in self.distributions:
+            self.resyncs[namespace] += 1
+
+        chunk_dist.time = self.high_water
+        self.distributions[namespace] = chunk_dist
+        self.chunk_counts[namespace] = Counter( chunk.shard for chunk in chunk_dist )
+        self.migrations.setdefault(namespace, deque())
+
+
+    def poll(self):
+        """ reads and applies all new changelog entries. Returns the sorted list of namespaces that changed. """
+        query = {'what': {'$in': self.changes + self.resync_changes}}
+        if self.namespaces is not None:
+            query['ns'] = {'$in': list(self.namespaces)}
+
+        # entries with the same time as the high-water mark may have been written after the last poll
+        if self.high_water is not None:
+            query['time'] = {'$gte': self.high_water}
+
+        changed = set()
+        for chl in self.config_db['changelog'].find(query).sort([('time', ASCENDING)]):
+            if chl['_id'] in self._seen:
+                continue
+            if chl['time'] != self.high_water:
+                self.high_water = chl['time']
+                self._seen = set()
+            self._seen.add(chl['_id'])
+
+            namespace = chl['ns']
+            if chl['what'] in self.resync_changes:
+                self.resync(namespace)
+                changed.add(namespace)
+            elif namespace in self.distributions:
+                if self._apply(namespace, chl):
+                    changed.add(namespace)
+
+        # forget migrations that left the window
+        if self.high_water is not None:
+            for migrations in self.migrations.itervalues():
+                while migrations and migrations[0][0] <= self.high_water - self.window:
+                    migrations.popleft()
+
+        return sorted(changed)
+
+
+    def _apply(self, namespace, chl):
+        """ applies a single changelog entry to the distribution of namespace, resyncs it if the entry
+            doesn't fit. Returns False for entries of multi-splits that are not complete yet.
+        """
+        multi_split_docs = None
+        if chl['what'] == 'multi-split':
+            key = (namespace, self.config_parser._multi_split_key(chl))
+            multi_split_docs = self._multi_splits.setdefault(key, [])
+            multi_split_docs.append(chl)
+            if len(multi_split_docs) < chl['details'].get('of', 1):
+                return False
+            del self._multi_splits[key]
+
+        try:
+            new_dist = self.config_parser.apply_change(chl, self.distributions[namespace], multi_split_docs)
+        except ValueError:
+            self.resync(namespace)
+            return True
+
+        removed, inserted = new_dist.delta
+        counts = self.chunk_counts[namespace]
+        counts.subtract( chunk.shard for chunk in removed )
+        counts.update( chunk.shard for chunk in inserted )
+
+        if chl['what'] == 'moveChunk.commit':
+            self.migrations[namespace].append( (chl['time'], chl['details']['from'], chl['details']['to']) )
+
+        self.distributions[namespace] = new_dist
+        return True
+
+
+    def stats(self, namespace):
+        """ returns a dict mapping each shard to a dict with its number of `chunks`, and the number of
+            migrations `in` and `out` of that shard within the window.
+        """
+        shards = {}
+        for shard, count in self.chunk_counts[namespace].iteritems():
+            if count:
+                shards[shard] = {'chunks': count, 'in': 0, 'out': 0}
+
+        for t, from_shard, to_shard in self.migrations[namespace]:
+            shards.setdefault(from_shard, {'chunks': 0, 'in': 0, 'out': 0})['out'] += 1
+            shards.setdefault(to_shard, {'chunks': 0, 'in': 0, 'out': 0})['in'] += 1
+
+        return shards
+
+
+    def migration_rate(self, namespace):
+        """ returns the number of migrations of namespace per minute within the window. """
+        return len(self.migrations[namespace]) / (self.window.total_seconds() / 60.)
+
+
+
+class MConfWatchTool(BaseCmdLineTool):
+
+    def __init__(self):
+        """ Constructor: add description to argparser. """
+        BaseCmdLineTool.__init__(self)
+
+        self.argparser.description = 'Watches the config.changelog of a config server and prints the number of chunks per shard and the migration rate of each namespace as they change.'
+        self.argparser.add_argument('config', action='store', nargs='?', metavar='URI', default='mongodb://localhost:27017/config', help='provide uri to a config server, or the path to a config dump or snapshot file, default is mongodb://localhost:27017/config')
+        self.argparser.add_argument('--ns', action='store', nargs='*', metavar='NS', help='namespaces to watch, default is all sharded collections')
+        self.argparser.add_argument('--interval', action='store', type=float, default=5., metavar='SECONDS', help='seconds between polls of config.changelog, default is 5')
+        self.argparser.add_argument('--window', action='store', type=float, default=10., metavar='MINUTES', help='migration rates are computed over the last MINUTES of the changelog, default is 10')
+        self.argparser.add_argument('--self-test', action='store_true', default=False, help='run the self-test against an in-memory config database and exit')
+
+    def run(self, arguments=None):
+        BaseCmdLineTool.run(self, arguments)
+
+        if self.args['self_test']:
+            self_test()
+            return
+
+        uri = self.args['config']
+        if os.path.exists(uri):
+            config_db = open_config(uri)
+        else:
+            # for convenience mongodb:// can be omitted for this script, but MongoClient expects it
+            uri = uri if uri.startswith('mongodb://') else 'mongodb://' + uri
+            config_db = MongoClient(uri)[parse_uri(uri)['database'] or 'config']
+
+        watcher = DistributionWatcher(config_db, self.args['ns'], timedelta(minutes=self.args['window']))
+        self._print_stats(watcher, sorted(watcher.distributions))
+
+        while True:
+            time.sleep(self.args['interval'])
+            self._print_stats(watcher, watcher.poll())
+
+
+    def _print_stats(self, watcher, namespaces):
+        for namespace in namespaces:
+            if namespace not in watcher.distributions:
+                print watcher.high_water, namespace, 'dropped'
+                continue
+
+            shards = watcher.stats(namespace)
+            print watcher.high_water, namespace, '  '.join( '%s: %i chunks (+%i/-%i)' % (shard, shards[shard]['chunks'], shards[shard]['in'], shards[shard]['out'])
+                for shard in sorted(shards) ), '  migrations: %.2f/min' % watcher.migration_rate(namespace)
+
+
+
+def self_test():
+    """ drives a DistributionWatcher over the changelog of a simulated cluster, and checks after each poll
+        that it agrees with config.chunks.
+    """
+    from fake_cluster import FakeCluster
+
+    cluster = FakeCluster(seed=1)
+    config_db = cluster.config_db
+    namespaces = ['mydb.coll1', 'mydb.coll2']
+    for namespace in namespaces:
+        cluster.shard_collection(namespace)
+        cluster.random_changes(namespace, 20)
+
+    def chunks(chunk_dist):
+        return [ (chunk.min, chunk.max, chunk.shard) for chunk in chunk_dist ]
+
+    def check(watcher, namespace):
+        assert chunks(watcher.distributions[namespace]) == cluster.current(namespace), namespace
+        counts = Counter( shard for chunk_min, chunk_max, shard in cluster.current(namespace) )
+        assert dict( (shard, count) for shard, count in watcher.chunk_counts[namespace].iteritems() if count ) == counts, namespace
+
+    watcher = DistributionWatcher(config_db, window=timedelta(minutes=1))
+    assert sorted(watcher.distributions) == namespaces
+    for namespace in namespaces:
+        check(watcher, namespace)
+
+    # polls after a few changes each, all of them fit
+    for i in range(30):
+        for namespace in namespaces[: i % 3]:
+            cluster.random_changes(namespace, i % 4)
+        changed = watcher.poll()
+        assert set(changed) <= set(namespaces)
+        for namespace in namespaces:
+            check(watcher, namespace)
+    assert not watcher.resyncs
+
+    # the migrations within the window are counted in and out
+    stats = watcher.stats(namespaces[0])
+    assert sum( shard['in'] for shard in stats.itervalues() ) == sum( shard['out'] for shard in stats.itervalues() ) == len(watcher.migrations[namespaces[0]])
+    assert watcher.migration_rate(namespaces[0]) == len(watcher.migrations[namespaces[0]])
+
+    # a multi-split whose entries span two polls is only applied once it is complete
+    before = chunks(watcher.distributions[namespaces[0]])
+    cluster.multi_split(namespaces[0], parts=4, hold=2)
+    assert watcher.poll() == []
+    assert chunks(watcher.distributions[namespaces[0]]) == before
+    cluster.flush()
+    assert watcher.poll() == [namespaces[0]]
+    check(watcher, namespaces[0])
+
+    # entries with the same time as the high-water mark, written after the last poll, are still applied
+    cluster.step = timedelta(0)
+    cluster.split(namespaces[1])
+    assert watcher.poll() == [namespaces[1]]
+    cluster.split(namespaces[1])
+    cluster.move(namespaces[1])
+    assert watcher.poll() == [namespaces[1]]
+    assert watcher.poll() == []
+    check(watcher, namespaces[1])
+    cluster.step = timedelta(seconds=1)
+
+    # a split that doesn't fit the distribution leads to a resync
+    bogus = dict(config_db['changelog'].find_one({'ns': namespaces[0], 'what': 'split'}), _id='bogus', time=cluster._tick())
+    config_db['changelog'].insert(bogus)
+    assert watcher.poll() == [namespaces[0]] and watcher.resyncs[namespaces[0]] == 1
+    check(watcher, namespaces[0])
+
+    # dropped collections are resynced (and forgotten), sharding them again brings them back
+    cluster.drop(namespaces[1])
+    assert watcher.poll() == [namespaces[1]]
+    assert namespaces[1] not in watcher.distributions
+    cluster.shard_collection(namespaces[1], 'shard0002')
+    cluster.random_changes(namespaces[1], 5)
+    assert watcher.poll() == [namespaces[1]]
+    check(watcher, namespaces[1])
+
+    print 'ok'
+
+
+
+if __name__ == '__main__':
+    tool = MConfWatchTool()
+    tool.run()